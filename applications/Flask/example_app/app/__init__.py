@@ -5,6 +5,14 @@ from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_pagedown import PageDown
+from .fragments import FragmentCache
+from .hashing import PasswordHasher
+from .metrics import Metrics
+from .profiling import StackSampler
+from .queries import QueryRecorder
+from .rendering import Renderer
+from .replicas import ReplicaRouter, RoutingSession
+from .sqlite import SQLiteTuning
 
 
 from config import config
@@ -13,10 +21,18 @@ from config import config
 bootstrap = Bootstrap()
 moment = Moment()
 mail = Mail()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})  # 读写分离
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 pagedown = PageDown()
+renderer = Renderer()
+queries = QueryRecorder()
+metrics = Metrics()
+profiler = StackSampler()
+fragment_cache = FragmentCache()
+hasher = PasswordHasher()
+replica_router = ReplicaRouter()
+sqlite_tuning = SQLiteTuning()
 
 
 def create_app(config_name):
@@ -34,8 +50,16 @@ def create_app(config_name):
   moment.init_app(app)
   mail.init_app(app)
   db.init_app(app)
+  sqlite_tuning.init_app(app)
+  replica_router.init_app(app)
   login_manager.init_app(app)
   pagedown.init_app(app)
+  renderer.init_app(app)
+  queries.init_app(app)
+  metrics.init_app(app)
+  profiler.init_app(app)
+  fragment_cache.init_app(app)
+  hasher.init_app(app)
 
   # 注册blueprints
   from .main import main as main_blueprint
@@ -2,5 +2,5 @@ from flask import Blueprint
 api = Blueprint('api', __name__)
 
 # autopep8: off
-from . import authentication, posts, users, comments, errors
+from . import authentication, posts, users, comments, search, errors
 # autopep8: on
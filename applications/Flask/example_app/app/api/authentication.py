@@ -1,29 +1,92 @@
-from flask import g, jsonify
+import hashlib
+import os
+
+from flask import current_app, g, jsonify
 from flask_httpauth import HTTPBasicAuth
-from ..models import User
+from .. import db
+from ..cache import TTLCache
+from ..identity import identity_cache
+from ..metrics import timed
+from ..models import Permission, User
 from . import api
+from .decorators import permission_required
 from .errors import unauthorized, forbidden
 
 auth = HTTPBasicAuth()
 
+# Basic认证缓存键的盐: 每个进程随机, 缓存中不保存可还原的口令
+_salt = os.urandom(16)
+
+
+def auth_caches():
+    """当前应用的认证缓存: 令牌 -> 用户id, Basic认证摘要 -> 用户id
+
+    用户的快照来自identity_cache, 用户修改提交后失效; Basic认证的条目也随
+    用户失效(修改密码, 邮箱). 其他进程不知道本进程的提交, 旧密码在那里最多
+    还能用APP_AUTH_BASIC_CACHE_TTL秒, 快照最多延迟APP_USER_CACHE_TTL秒.
+    """
+    caches = current_app.extensions.get('auth_caches')
+    if caches is None:
+        config = current_app.config
+        size = config['APP_AUTH_TOKEN_CACHE_SIZE']
+        new = {
+            'token': TTLCache(size, config['APP_AUTH_TOKEN_CACHE_TTL']),
+            'basic': TTLCache(size, config['APP_AUTH_BASIC_CACHE_TTL']),
+        }
+        caches = current_app.extensions.setdefault('auth_caches', new)
+        if caches is new:
+            # 令牌只依赖签名和有效期, 不需要随用户失效
+            identity_cache().track(caches['basic'])
+    return caches
+
+
+def verify_token(token):
+    """校验令牌, 签名校验的结果按令牌缓存到过期为止"""
+    cache = auth_caches()['token']
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    user_id = cache.get(key)
+    if user_id is None:
+        loaded = User.load_auth_token(token)
+        if loaded is None:
+            return None
+        user_id, remaining = loaded
+        cache.set(key, user_id, ttl=min(cache.ttl, remaining))
+    return identity_cache().get(user_id)
+
+
+def verify_credentials(email, password):
+    """校验邮箱和密码, 成功结果按加盐摘要短时间缓存"""
+    cache = auth_caches()['basic']
+    identities = identity_cache()
+    key = hashlib.sha256(
+        _salt + (email + '\0' + password).encode('utf-8')).digest()
+    user_id = cache.get(key)
+    if user_id is not None:
+        return identities.get(user_id)
+    version = identities.version
+    user = User.query.filter_by(email=email).first()
+    if not user or not user.verify_password(password):
+        return None
+    db.session.commit()  # 可能升级了密码哈希
+    identities.remember(cache, key, user.id, version)
+    return identities.get(user.id)
+
 
 @auth.verify_password  # Flask-HttpAuth验证回调
 def verify_password(email_or_token, password):
     if email_or_token == '':
         return False
-    # 密码为空: 校验token
-    if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
-        g.token_used = True
-        return g.current_user is not None
+    with timed('auth'):
+        # 密码为空: 校验token
+        if password == '':
+            g.current_user = verify_token(email_or_token)
+            g.token_used = True
+            return g.current_user is not None
 
-    # 校验密码
-    user = User.query.filter_by(email=email_or_token.lower()).first()
-    if not user:
-        return False
-    g.current_user = user
-    g.token_used = False
-    return user.verify_password(password)
+        # 校验密码
+        g.current_user = verify_credentials(email_or_token.lower(), password)
+        g.token_used = False
+        return g.current_user is not None
 
 
 @auth.error_handler  # 错误处理
@@ -47,3 +110,11 @@ def get_token():
         'token': g.current_user.generate_auth_token(expiration=3600),
         'expiration': 3600
     })
+
+
+@api.route('/tokens/stats')
+@permission_required(Permission.ADMIN)
+def get_token_stats():
+    """认证缓存的命中率等指标"""
+    return jsonify({name: cache.stats()
+                    for name, cache in auth_caches().items()})
@@ -0,0 +1,126 @@
+# API响应缓存
+#
+# 轮询的客户端大多拿到的是没有变化的数据:
+# - ETag由本页各行决定JSON的值(id, 行版本, 计数器)和分页信息计算,
+#   If-None-Match匹配时直接返回304, 不序列化
+# - 序列化后的JSON按(路径, ETag)保存在有界的共享缓存中, 其他客户端直接使用
+# - 帖子/评论提交修改后删除带有其标签的缓存条目
+
+import hashlib
+
+from flask import current_app, has_app_context, request
+from .. import db
+from ..cache import TTLCache
+from ..models import Comment, Post
+
+
+def response_cache():
+  """当前应用的API响应缓存"""
+  cache = current_app.extensions.get('api_response_cache')
+  if cache is None:
+    config = current_app.config
+    cache = current_app.extensions.setdefault(
+        'api_response_cache',
+        TTLCache(config['APP_API_CACHE_SIZE'], config['APP_API_CACHE_TTL']))
+  return cache
+
+
+def etag_for(*parts):
+  """强ETag(不带引号)"""
+  return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def item_etag(item):
+  return etag_for(type(item).__name__, item.etag_parts())
+
+
+def page_etag(pagination):
+  """分页结果的ETag: 各行的值, 总数, 是否有前后页"""
+  return etag_for(pagination.total, pagination.has_prev, pagination.has_next,
+                  [item.etag_parts() for item in pagination.items])
+
+
+class CachedBody:
+  """缓存的JSON和它依赖的行的标签"""
+
+  __slots__ = ('body', 'tags')
+
+  def __init__(self, body, tags):
+    self.body = body
+    self.tags = tags
+
+
+def conditional_json(etag, build, tags=()):
+  """按ETag返回304, 缓存的JSON, 或调用build()序列化
+
+  tags: 响应依赖的行, 如('post', 1), 修改后缓存条目失效
+  """
+  if request.if_none_match.contains(etag):
+    response = current_app.response_class(status=304)
+  else:
+    cache = response_cache()
+    key = (request.full_path, etag)
+    cached = cache.get(key)
+    if cached is None:
+      body = current_app.json.dumps(build())
+      cached = CachedBody(body, frozenset(tags))
+      cache.set(key, cached)
+    response = current_app.response_class(cached.body,
+                                          mimetype='application/json')
+  response.set_etag(etag)
+  # 客户端可以缓存, 但每次都要验证
+  response.cache_control.private = True
+  response.cache_control.no_cache = True
+  response.vary.add('Authorization')
+  return response
+
+
+def tag(item):
+  return (type(item).__name__.lower(), item.id)
+
+
+def item_json(item, build):
+  """单个对象的条件响应"""
+  return conditional_json(item_etag(item), build, tags=[tag(item)])
+
+
+def page_json(pagination, build):
+  """分页结果的条件响应"""
+  return conditional_json(page_etag(pagination), build,
+                          tags=[tag(item) for item in pagination.items])
+
+
+################################################################################
+# 失效
+################################################################################
+
+def mark_changed(tags):
+  """记录修改的行的标签, 提交后使缓存失效(也用于不触发模型事件的批量UPDATE)"""
+  db.session.info.setdefault('api_cache_tags', set()).update(tags)
+
+
+def on_changed(mapper, connection, target):
+  tags = [tag(target)]
+  # 评论的增删改变了帖子的评论数
+  if isinstance(target, Comment):
+    tags.append(('post', target.post_id))
+  mark_changed(tags)
+
+
+def on_after_commit(session):
+  tags = session.info.pop('api_cache_tags', None)
+  if tags and has_app_context() and \
+          'api_response_cache' in current_app.extensions:
+    current_app.extensions['api_response_cache'].delete_where(
+        lambda cached: not cached.tags.isdisjoint(tags))
+
+
+def on_after_rollback(session):
+  session.info.pop('api_cache_tags', None)
+
+
+for model in (Post, Comment):
+  for event in ('after_insert', 'after_update', 'after_delete'):
+    db.event.listen(model, event, on_changed)
+db.event.listen(db.session, 'after_commit', on_after_commit)
+db.event.listen(db.session, 'after_rollback', on_after_rollback)
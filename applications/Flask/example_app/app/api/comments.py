@@ -1,25 +1,25 @@
 from flask import jsonify, request, g, url_for, current_app
-from .. import db
+from .. import db, moderation
 from ..models import Post, Permission, Comment
 from . import api
+from .caching import item_json, page_json
 from .decorators import permission_required
+from ..pagination import paginate
 
 
 @api.route('/comments/')
 def get_comments():
-  page = request.args.get('page', 1, type=int)
-  pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-      page=page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(Comment.query, (Comment.timestamp, Comment.id),
+                        current_app.config['APP_COMMENTS_PER_PAGE'])
   comments = pagination.items
   prev = None
   if pagination.has_prev:
-    prev = url_for('api.get_comments', page=page-1)
+    prev = url_for('api.get_comments', cursor=pagination.prev_cursor)
   next = None
   if pagination.has_next:
-    next = url_for('api.get_comments', page=page+1)
-  return jsonify({
-      'comments': [comment.to_json() for comment in comments],
+    next = url_for('api.get_comments', cursor=pagination.next_cursor)
+  return page_json(pagination, lambda: {
+      'comments': Comment.to_json_list(comments),
       'prev': prev,
       'next': next,
       'count': pagination.total
@@ -29,25 +29,26 @@ def get_comments():
 @api.route('/comments/<int:id>')
 def get_comment(id):
   comment = Comment.query.get_or_404(id)
-  return jsonify(comment.to_json())
+  return item_json(comment, comment.to_json)
 
 
 @api.route('/posts/<int:id>/comments/')
 def get_post_comments(id):
   post = Post.query.get_or_404(id)
-  page = request.args.get('page', 1, type=int)
-  pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-      page=page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(post.comments, (Comment.timestamp, Comment.id),
+                        current_app.config['APP_COMMENTS_PER_PAGE'],
+                        desc=False, total=post.comment_count)
   comments = pagination.items
   prev = None
   if pagination.has_prev:
-    prev = url_for('api.get_post_comments', id=id, page=page-1)
+    prev = url_for('api.get_post_comments', id=id,
+                   cursor=pagination.prev_cursor)
   next = None
   if pagination.has_next:
-    next = url_for('api.get_post_comments', id=id, page=page+1)
-  return jsonify({
-      'comments': [comment.to_json() for comment in comments],
+    next = url_for('api.get_post_comments', id=id,
+                   cursor=pagination.next_cursor)
+  return page_json(pagination, lambda: {
+      'comments': Comment.to_json_list(comments),
       'prev': prev,
       'next': next,
       'count': pagination.total
@@ -59,9 +60,21 @@ def get_post_comments(id):
 def new_post_comment(id):
   post = Post.query.get_or_404(id)
   comment = Comment.from_json(request.json)
-  comment.author = g.current_user
+  # g.current_user是用户快照, 只设置外键
+  comment.author_id = g.current_user.id
   comment.post = post
   db.session.add(comment)
   db.session.commit()
   return jsonify(comment.to_json()), 201, \
       {'Location': url_for('api.get_comment', id=comment.id)}
+
+
+@api.route('/comments/moderation', methods=['POST'])
+@permission_required(Permission.MODERATE)
+def moderate_comments():
+  """批量取消/恢复评论: {"disabled": true, "ids": [...]}, 或按条件
+  {"disabled": true, "author": "name", "post_id": 1, "since": "...",
+  "until": "..."}"""
+  kwargs = moderation.from_json(request.json)
+  return jsonify({'disabled': kwargs['disabled'],
+                  'updated': moderation.set_disabled(**kwargs)})
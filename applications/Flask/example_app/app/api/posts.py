@@ -2,25 +2,25 @@ from flask import jsonify, request, g, url_for, current_app
 from .. import db
 from ..models import Post, Permission
 from . import api
+from .caching import item_json, page_json
 from .decorators import permission_required
 from .errors import forbidden
+from ..pagination import paginate
 
 
 @api.route('/posts/')
 def get_posts():
-  page = request.args.get('page', 1, type=int)
-  pagination = Post.query.paginate(
-      page=page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(Post.query, (Post.timestamp, Post.id),
+                        current_app.config['APP_POSTS_PER_PAGE'])
   posts = pagination.items
   prev = None
   if pagination.has_prev:
-    prev = url_for('api.get_posts', page=page-1)
+    prev = url_for('api.get_posts', cursor=pagination.prev_cursor)
   next = None
   if pagination.has_next:
-    next = url_for('api.get_posts', page=page+1)
-  return jsonify({
-      'posts': [post.to_json() for post in posts],
+    next = url_for('api.get_posts', cursor=pagination.next_cursor)
+  return page_json(pagination, lambda: {
+      'posts': Post.to_json_list(posts),
       'prev': prev,
       'next': next,
       'count': pagination.total
@@ -30,14 +30,15 @@ def get_posts():
 @api.route('/posts/<int:id>')
 def get_post(id):
   post = Post.query.get_or_404(id)
-  return jsonify(post.to_json())
+  return item_json(post, post.to_json)
 
 
 @api.route('/posts/', methods=['POST'])
 @permission_required(Permission.WRITE)
 def new_post():
   post = Post.from_json(request.json)
-  post.author = g.current_user
+  # g.current_user是用户快照, 只设置外键
+  post.author_id = g.current_user.id
   db.session.add(post)
   db.session.commit()
   return jsonify(post.to_json()), 201, \
@@ -48,7 +49,7 @@ def new_post():
 @permission_required(Permission.WRITE)
 def edit_post(id):
   post = Post.query.get_or_404(id)
-  if g.current_user != post.author and \
+  if g.current_user.id != post.author_id and \
           not g.current_user.can(Permission.ADMIN):
     return forbidden('Insufficient permissions')
   post.body = request.json.get('body', post.body)
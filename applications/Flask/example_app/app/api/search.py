@@ -0,0 +1,39 @@
+from flask import current_app, request, url_for
+from ..models import Comment, Post
+from . import api
+from .caching import conditional_json, etag_for, tag
+from .errors import bad_request
+from ..pagination import paginate
+from ..search import key_values, search_query
+
+SEARCH_MODELS = {'posts': Post, 'comments': Comment}
+
+
+@api.route('/search')
+def search():
+  """全文搜索: q, type(posts或comments), 按相关性排序, 没有总数"""
+  q = request.args.get('q', '')
+  type = request.args.get('type', 'posts')
+  model = SEARCH_MODELS.get(type)
+  if model is None:
+    return bad_request('invalid search type')
+  query, keys = search_query(model, q)
+  pagination = paginate(query, keys, current_app.config['APP_POSTS_PER_PAGE'],
+                        desc=False, key_values=key_values)
+  results = [row[0] for row in pagination.items]
+  prev = None
+  if pagination.has_prev:
+    prev = url_for('api.search', q=q, type=type,
+                   cursor=pagination.prev_cursor)
+  next = None
+  if pagination.has_next:
+    next = url_for('api.search', q=q, type=type,
+                   cursor=pagination.next_cursor)
+  # 不使用page_etag: 总数需要统计所有匹配的行
+  etag = etag_for(pagination.has_prev, pagination.has_next,
+                  [item.etag_parts() for item in results])
+  return conditional_json(etag, lambda: {
+      type: model.to_json_list(results),
+      'prev': prev,
+      'next': next
+  }, tags=[tag(item) for item in results])
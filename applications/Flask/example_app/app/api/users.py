@@ -1,53 +1,77 @@
-from flask import jsonify, request, current_app, url_for
+from flask import request, current_app, stream_with_context, url_for
 from . import api
+from .caching import item_json, page_json
+from .errors import bad_request
+from ..export import EXPORT_MODELS, export
 from ..models import User, Post
+from ..pagination import paginate
 
 
 @api.route('/users/<int:id>')
 def get_user(id):
   user = User.query.get_or_404(id)
-  return jsonify(user.to_json())
+  return item_json(user, user.to_json)
 
 
 @api.route('/users/<int:id>/posts/')
 def get_user_posts(id):
   user = User.query.get_or_404(id)
-  page = request.args.get('page', 1, type=int)
-  pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-      page=page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(user.posts, (Post.timestamp, Post.id),
+                        current_app.config['APP_POSTS_PER_PAGE'],
+                        total=user.post_count)
   posts = pagination.items
   prev = None
   if pagination.has_prev:
-    prev = url_for('api.get_user_posts', id=id, page=page-1)
+    prev = url_for('api.get_user_posts', id=id,
+                   cursor=pagination.prev_cursor)
   next = None
   if pagination.has_next:
-    next = url_for('api.get_user_posts', id=id, page=page+1)
-  return jsonify({
-      'posts': [post.to_json() for post in posts],
+    next = url_for('api.get_user_posts', id=id,
+                   cursor=pagination.next_cursor)
+  return page_json(pagination, lambda: {
+      'posts': Post.to_json_list(posts),
       'prev': prev,
       'next': next,
       'count': pagination.total
   })
 
 
-# @api.route('/users/<int:id>/timeline/')
-# def get_user_followed_posts(id):
-#   user = User.query.get_or_404(id)
-#   page = request.args.get('page', 1, type=int)
-#   pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-#       page=page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-#       error_out=False)
-#   posts = pagination.items
-#   prev = None
-#   if pagination.has_prev:
-#     prev = url_for('api.get_user_followed_posts', id=id, page=page-1)
-#   next = None
-#   if pagination.has_next:
-#     next = url_for('api.get_user_followed_posts', id=id, page=page+1)
-#   return jsonify({
-#       'posts': [post.to_json() for post in posts],
-#       'prev': prev,
-#       'next': next,
-#       'count': pagination.total
-#   })
+@api.route('/users/<int:id>/timeline/')
+def get_user_followed_posts(id):
+  user = User.query.get_or_404(id)
+  query, keys = user.timeline
+  pagination = paginate(query, keys, current_app.config['APP_POSTS_PER_PAGE'])
+  posts = pagination.items
+  prev = None
+  if pagination.has_prev:
+    prev = url_for('api.get_user_followed_posts', id=id,
+                   cursor=pagination.prev_cursor)
+  next = None
+  if pagination.has_next:
+    next = url_for('api.get_user_followed_posts', id=id,
+                   cursor=pagination.next_cursor)
+  return page_json(pagination, lambda: {
+      'posts': Post.to_json_list(posts),
+      'prev': prev,
+      'next': next,
+      'count': pagination.total
+  })
+
+
+@api.route('/users/<int:id>/export')
+def export_user(id):
+  """流式导出帖子或评论(NDJSON): ?type=posts|comments&after=<id>,
+  Accept-Encoding: gzip时压缩"""
+  user = User.query.get_or_404(id)
+  type = request.args.get('type', 'posts')
+  if type not in EXPORT_MODELS:
+    return bad_request('type must be one of: %s' % ', '.join(EXPORT_MODELS))
+  after = request.args.get('after', 0, type=int)
+  compress = 'gzip' in request.accept_encodings
+  response = current_app.response_class(
+      stream_with_context(export(type, user.id, after, compress)),
+      mimetype='application/x-ndjson')
+  if compress:
+    response.headers['Content-Encoding'] = 'gzip'
+  response.vary.add('Accept-Encoding')
+  return response
@@ -1,4 +1,4 @@
-from flask import render_template, url_for, request, redirect, flash
+from flask import current_app, render_template, url_for, request, redirect, flash
 from flask_login import login_user, logout_user, login_required, current_user
 
 from . import auth  # auth blueprint
@@ -64,6 +64,7 @@ def login():
   if form.validate_on_submit():
     user = User.query.filter_by(email=form.email.data).first()
     if user is not None and user.verify_password(form.password.data):
+      db.session.commit()  # 可能升级了密码哈希
       login_user(user, form.remember_me.data)  # 登录用户: 使用模型User
       next = request.args.get('next')
       if next is None or not next.startswith('/'):
@@ -96,6 +97,14 @@ def before_request():
       return redirect(url_for('auth.unconfirmed'))
 
 
+@auth.teardown_app_request
+def teardown_request(exc):
+  """没有后台写入线程时, 请求结束时写入最后访问时间"""
+  buffer = current_app.extensions.get('last_seen')
+  if buffer is not None and buffer.interval <= 0:
+    buffer.flush()
+
+
 @auth.route('/unconfirmed')
 def unconfirmed():
   """未确认账户页面"""
@@ -0,0 +1,72 @@
+# 进程内缓存
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+  """有容量上限的LRU缓存, 每个条目有过期时间
+
+  hits/misses/evictions/expirations用于监控.
+  """
+
+  def __init__(self, maxsize=1024, ttl=60):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key, default=None):
+    now = time.monotonic()
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      if entry[0] <= now:
+        del self.entries[key]
+        self.expirations += 1
+        self.misses += 1
+        return default
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value, ttl=None):
+    if ttl is None:
+      ttl = self.ttl
+    if ttl <= 0:
+      return
+    with self.lock:
+      self.entries[key] = (time.monotonic() + ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def delete(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def delete_where(self, predicate):
+    """删除值满足predicate的条目"""
+    with self.lock:
+      for key in [k for k, (_, v) in self.entries.items() if predicate(v)]:
+        del self.entries[key]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def stats(self):
+    return {'size': len(self.entries), 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions,
+            'expirations': self.expirations}
@@ -1,7 +1,10 @@
 from functools import wraps
-from flask import abort
+from flask import abort, current_app, make_response, request
 from flask_login import current_user
+from flask_wtf.csrf import ValidationError, generate_csrf, validate_csrf
+from .exceptions import QueryBudgetExceeded
 from .models import Permission
+from .queries import request_queries
 
 
 def permission_required(permission):
@@ -18,3 +21,53 @@ def permission_required(permission):
 
 def admin_required(f):
   return permission_required(Permission.ADMIN)(f)
+
+
+def csrf_required(f):
+  """修改状态的请求(非GET/HEAD)需要X-CSRFToken请求头, 没有表单的JSON视图用
+
+  GET的响应在X-CSRFToken头中返回令牌(与表单的csrf_token相同, 保存在会话中).
+  WTF_CSRF_ENABLED为False(测试)时不检查.
+  """
+  @wraps(f)
+  def decorated_function(*args, **kwargs):
+    if request.method in ('GET', 'HEAD'):
+      response = make_response(f(*args, **kwargs))
+      response.headers['X-CSRFToken'] = generate_csrf()
+      return response
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+      try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+      except ValidationError:
+        abort(400)
+    return f(*args, **kwargs)
+  return decorated_function
+
+
+def use_primary(f):
+  """视图的读也使用主库: GET中写入, 或读取后马上编辑, 不能接受复制延迟"""
+  f.use_primary = True
+  return f
+
+
+def query_budget(max_queries):
+  """声明请求(到视图返回为止)最多执行的查询数
+
+  超过时写日志; APP_QUERY_BUDGET_STRICT(测试)时抛出QueryBudgetExceeded.
+  需要开启APP_QUERY_RECORDER.
+  """
+  def decorator(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+      rv = f(*args, **kwargs)
+      queries = request_queries()
+      if len(queries) > max_queries:
+        message = '%s executed %d queries, budget is %d:\n%s' % (
+            request.endpoint, len(queries), max_queries,
+            '\n'.join(statement for statement, _ in queries))
+        if current_app.config['APP_QUERY_BUDGET_STRICT']:
+          raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+      return rv
+    return decorated_function
+  return decorator
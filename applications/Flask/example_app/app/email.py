@@ -1,24 +1,278 @@
 # 邮件功能
+#
+# 邮件放入有界队列, 由固定数量的工作线程发送:
+# - 每个工作线程复用一个SMTP连接(mail.connect()), 空闲一段时间后关闭
+# - 一次取出多封邮件在同一连接上发送
+# - 发送失败按指数退避重试
+# - APP_MAIL_BACKEND: smtp, file(写入.eml文件), debug(写日志), 用于开发和测试
+
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import deque
 
-from threading import Thread
 from flask import current_app, render_template
 from flask_mail import Message
 from . import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class SMTPBackend:
+    """通过Flask-Mail发送"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def connect(self):
+        return mail.connect()
+
+
+class FileBackend:
+    """每封邮件写入APP_MAIL_FILE_DIR下的一个.eml文件"""
+
+    def __init__(self, app):
+        self.directory = app.config['APP_MAIL_FILE_DIR']
+        os.makedirs(self.directory, exist_ok=True)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def send(self, msg):
+        with self.lock:
+            self.counter += 1
+            name = '%d-%d-%d.eml' % (time.time_ns(), os.getpid(),
+                                     self.counter)
+        with open(os.path.join(self.directory, name), 'w',
+                  encoding='utf-8') as f:
+            f.write(msg.as_string())
+
+
+class DebugBackend(FileBackend):
+    """只写日志"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def send(self, msg):
+        self.app.logger.info('Mail to %s: %s', ', '.join(msg.recipients),
+                             msg.subject)
+
+
+backends = {
+    'smtp': SMTPBackend,
+    'file': FileBackend,
+    'debug': DebugBackend,
+}
+
+
+class MailQueue:
+    """邮件发送队列和工作线程池"""
+
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.backend = backends[config['APP_MAIL_BACKEND']](app)
+        self.queue = queue.Queue(maxsize=config['APP_MAIL_QUEUE_SIZE'])
+        self.workers = config['APP_MAIL_WORKERS']
+        self.batch_size = config['APP_MAIL_BATCH_SIZE']
+        self.max_retries = config['APP_MAIL_MAX_RETRIES']
+        self.retry_delay = config['APP_MAIL_RETRY_DELAY']
+        self.idle_timeout = config['APP_MAIL_IDLE_TIMEOUT']
+        self.threads = []
+        # 保护计数器: 请求线程, 工作线程和重试定时器都会修改
+        self.lock = threading.Lock()
+        # 正在等待重试的邮件数
+        self.retrying = 0
+        # 指标
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=1000)
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run,
+                                          name='mail-worker-%d' % i,
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        atexit.register(self.shutdown)
+
+    def put(self, msg, timeout=None):
+        """放入队列, 队列满时等待timeout秒后放弃并返回False"""
+        self.start()
+        try:
+            self.queue.put((msg, time.monotonic(), 0), timeout=timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            self.app.logger.error('Mail queue full, dropped mail to %s',
+                                  ', '.join(msg.recipients))
+            return False
+        with self.lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self):
+        with self.app.app_context():
+            conn = None
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    # 空闲: 关闭连接
+                    conn = self._close(conn)
+                    continue
+                if item is None:
+                    self.queue.task_done()
+                    self._close(conn)
+                    return
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        # 结束标记放回, 处理完这一批再退出
+                        self.queue.task_done()
+                        self.queue.put(None)
+                        break
+                    batch.append(item)
+                conn = self._send_batch(conn, batch)
+
+    def _send_batch(self, conn, batch):
+        with self.lock:
+            self.batches += 1
+        for msg, enqueued_at, attempts in batch:
+            try:
+                if conn is None:
+                    conn = self.backend.connect()
+                    conn.__enter__()
+                conn.send(msg)
+            except Exception as e:
+                self.app.logger.warning('Mail to %s failed: %s',
+                                        ', '.join(msg.recipients), e)
+                conn = self._close(conn)
+                self._retry(msg, enqueued_at, attempts)
+            else:
+                with self.lock:
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - enqueued_at)
+            finally:
+                self.queue.task_done()
+        return conn
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def _retry(self, msg, enqueued_at, attempts):
+        if attempts >= self.max_retries:
+            with self.lock:
+                self.failed += 1
+            self.app.logger.error('Mail to %s dropped after %d attempts',
+                                  ', '.join(msg.recipients), attempts + 1)
+            return
+        with self.lock:
+            self.retried += 1
+            self.retrying += 1
+
+        def requeue():
+            # 先放入队列再减少计数, drain()不会在中间误判为已清空
+            self.queue.put((msg, enqueued_at, attempts + 1))
+            with self.lock:
+                self.retrying -= 1
+        timer = threading.Timer(self.retry_delay * 2 ** attempts, requeue)
+        timer.daemon = True
+        timer.start()
+
+    def drain(self, timeout=None):
+        """等待队列(包括等待重试的邮件)清空, 返回是否已清空"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.queue.unfinished_tasks == 0 and self.retrying == 0:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def shutdown(self, timeout=10):
+        """发送完队列中的邮件后停止工作线程"""
+        self.drain(timeout)
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counters = {
+                'retrying': self.retrying,
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'rejected': self.rejected,
+                'batches': self.batches,
+            }
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * p))]
+        return dict(counters, depth=self.queue.qsize(),
+                    latency_p50=percentile(0.5),
+                    latency_p99=percentile(0.99))
+
+
+_lock = threading.Lock()
+
+
+def mail_queue(app=None):
+    """应用的邮件队列, 第一次使用时创建"""
+    app = app or current_app._get_current_object()
+    with _lock:
+        if 'mail_queue' not in app.extensions:
+            app.extensions['mail_queue'] = MailQueue(app)
+    return app.extensions['mail_queue']
 
 
 def send_email(recipient, subject, template, **kwargs):
+    """渲染邮件并放入发送队列
+
+    返回是否已放入队列(队列满时为False). 以前每封邮件一个线程并返回
+    Thread; 现在由工作线程发送, 等待发送完成用mail_queue().drain().
+    """
     app = current_app._get_current_object()
     # 使用配置: app.config
     msg = Message(app.config['APP_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
                   sender=app.config['APP_MAIL_SENDER'], recipients=[recipient])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    # 开启线程异步发送
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    # 放入队列异步发送
+    return mail_queue(app).put(msg,
+                               timeout=app.config['APP_MAIL_ENQUEUE_TIMEOUT'])
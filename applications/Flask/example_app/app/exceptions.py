@@ -1,3 +1,13 @@
 class ValidationError(ValueError):
   """校验错误"""
   pass
+
+
+class QueryBudgetExceeded(AssertionError):
+  """视图的查询数超过声明的预算"""
+  pass
+
+
+class PasswordHashingBusy(RuntimeError):
+  """同时进行的密码哈希达到上限, 请求被拒绝(503)"""
+  pass
@@ -0,0 +1,65 @@
+# 导出用户的帖子/评论
+#
+# NDJSON(每行一个JSON对象, 与API的表示相同, 另加id), 按id升序:
+# - 服务器端游标(yield_per)分批读取, 序列化后按块输出, 内存与总行数无关
+# - after: 从id大于它的行继续, 中断后用最后收到的id恢复
+# - gzip: 同一个压缩流, 每块flush一次, 客户端可以边收边解压
+
+import zlib
+
+from flask import current_app
+
+from . import db
+from .models import Comment, Post, UrlTemplates
+
+EXPORT_MODELS = {'posts': Post, 'comments': Comment}
+
+
+def export_rows(model, author_id, after=0, batch_size=None):
+  """作者的行(ORM对象), id升序"""
+  batch_size = batch_size or current_app.config['APP_EXPORT_BATCH_SIZE']
+  query = db.select(model).where(model.author_id == author_id,
+                                 model.id > after) \
+      .order_by(model.id).execution_options(yield_per=batch_size)
+  for row in db.session.scalars(query):
+    yield row
+  # 长时间的读事务结束, 不保留快照
+  db.session.rollback()
+
+
+def ndjson_lines(rows):
+  url = UrlTemplates()
+  dumps = current_app.json.dumps
+  for row in rows:
+    item = row.to_json(url=url)
+    item['id'] = row.id
+    yield dumps(item) + '\n'
+
+
+def chunks(lines, chunk_bytes=None, compress=False):
+  """把行合并成约chunk_bytes的块(bytes); compress时输出gzip流"""
+  chunk_bytes = chunk_bytes or current_app.config['APP_EXPORT_CHUNK_BYTES']
+  gzip = zlib.compressobj(wbits=31) if compress else None
+  buffer = []
+  size = 0
+  for line in lines:
+    data = line.encode('utf-8')
+    buffer.append(data)
+    size += len(data)
+    if size >= chunk_bytes:
+      data = b''.join(buffer)
+      yield gzip.compress(data) + gzip.flush(zlib.Z_SYNC_FLUSH) \
+          if gzip else data
+      buffer = []
+      size = 0
+  data = b''.join(buffer)
+  if gzip:
+    yield gzip.compress(data) + gzip.flush()
+  elif data:
+    yield data
+
+
+def export(type, author_id, after=0, compress=False):
+  """导出的块"""
+  rows = export_rows(EXPORT_MODELS[type], author_id, after)
+  return chunks(ndjson_lines(rows), compress=compress)
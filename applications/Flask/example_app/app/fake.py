@@ -2,40 +2,234 @@
 # 生成测试用户和帖子数据
 ################################################################################
 
-from email.quoprimime import body_check
-from random import randint
-from sqlalchemy.exc import IntegrityError
+import bisect
+import itertools
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from werkzeug.security import generate_password_hash
 from faker import Faker
 from . import db
-from .models import User, Post
+from .models import User, Post, Comment, Follow
+from .rendering import render
+from .roles import role_cache
 
 
-def users(count=100):
-  fake = Faker()
-  i = 0
-  while i < count:
-    u = User(email=fake.email(),
-             username=fake.user_name(),
-             password='password',
-             confirmed=True,
-             name=fake.name(),
-             location=fake.city(),
-             about_me=fake.text(),
-             member_since=fake.past_date())
-    db.session.add(u)
-    try:
-      db.session.commit()
-      i += 1
-    except IntegrityError:
-      db.session.rollback()
+def users(count=100, seed=None):
+  """生成count个用户, 密码都是password
+
+  使用bulk的用户生成: 名称加id后缀保证唯一, 每批一次executemany,
+  不需要逐行提交和IntegrityError重试.
+  """
+  return bulk(users=count, posts=0, comments=0, follows=0, seed=seed,
+              log=None)['users']
 
 
 def posts(count=100):
   fake = Faker()
-  user_count = User.query.count()
+  # 一次取出所有用户id, 不再每个帖子做一次OFFSET查询
+  user_ids = db.session.scalars(db.select(User.id)).all()
   for i in range(count):
-    u = User.query.offset(randint(0, user_count - 1)).first()
     p = Post(body=fake.text(), timestamp=fake.past_date(),
-             author=u)
+             author_id=random.choice(user_ids))
     db.session.add(p)
   db.session.commit()
+
+
+################################################################################
+# 批量生成: 用于压测的大数据量
+#
+# - 用户名, 邮箱加上id后缀保证唯一, 不需要重试
+# - 所有用户使用同一个密码hash
+# - 行数据在进程池中生成(包括Markdown渲染), 主进程按批executemany插入
+# - 帖子作者, 评论, 关注按幂律分布: 少数用户/帖子占大部分
+# - 插入绕过模型事件, 结束后重建计数器
+################################################################################
+
+class PowerLaw:
+  """在0..n-1上按权重1/(k+1)^alpha抽样"""
+
+  def __init__(self, n, alpha=1.0):
+    self.n = n
+    self.cumulative = list(itertools.accumulate(
+        1.0 / (k + 1) ** alpha for k in range(n)))
+
+  def sample(self, rng):
+    x = rng.random() * self.cumulative[-1]
+    return min(bisect.bisect_left(self.cumulative, x), self.n - 1)
+
+
+# 工作进程中的Faker和抽样器
+_fake = None
+_samplers = {}
+
+
+def _sampler(n, alpha):
+  key = (n, alpha)
+  if key not in _samplers:
+    _samplers[key] = PowerLaw(n, alpha)
+  return _samplers[key]
+
+
+def _worker_fake(seed):
+  global _fake
+  if _fake is None:
+    _fake = Faker()
+  _fake.seed_instance(seed)
+  return _fake
+
+
+def _timestamp(rng, now, days):
+  return now - timedelta(seconds=rng.randrange(days * 24 * 3600))
+
+
+def _user_rows(task):
+  start, count, seed, password_hash, role_id, now = task
+  fake = _worker_fake(seed)
+  rng = random.Random(seed)
+  rows = []
+  for id in range(start, start + count):
+    name = fake.user_name()[:40]
+    rows.append({
+        'id': id,
+        'username': '%s_%d' % (name, id),
+        'email': '%s_%d@%s' % (name, id, fake.free_email_domain()),
+        'password_hash': password_hash,
+        'confirmed': True,
+        'name': fake.name(),
+        'location': fake.city(),
+        'about_me': fake.sentence(),
+        'member_since': _timestamp(rng, now, 3 * 365),
+        'last_seen': _timestamp(rng, now, 30),
+        'role_id': role_id,
+    })
+  return rows
+
+
+def _post_rows(task):
+  start, count, seed, first_user, user_count, alpha, now = task
+  fake = _worker_fake(seed)
+  rng = random.Random(seed)
+  authors = _sampler(user_count, alpha)
+  rows = []
+  for id in range(start, start + count):
+    body = fake.text()
+    rows.append({
+        'id': id,
+        'body': body,
+        'body_html': render(body, Post.ALLOWED_TAGS),
+        'timestamp': _timestamp(rng, now, 365),
+        'author_id': first_user + authors.sample(rng),
+    })
+  return rows
+
+
+def _comment_rows(task):
+  start, count, seed, first_user, user_count, first_post, post_count, \
+      alpha, now = task
+  fake = _worker_fake(seed)
+  rng = random.Random(seed)
+  authors = _sampler(user_count, alpha)
+  posts = _sampler(post_count, alpha)
+  rows = []
+  for id in range(start, start + count):
+    body = fake.sentence()
+    rows.append({
+        'id': id,
+        'body': body,
+        'body_html': render(body, Comment.ALLOWED_TAGS),
+        'timestamp': _timestamp(rng, now, 365),
+        'disabled': False,
+        'author_id': first_user + authors.sample(rng),
+        'post_id': first_post + posts.sample(rng),
+    })
+  return rows
+
+
+def _follow_rows(task):
+  start, count, seed, first_user, user_count, follows, alpha, now = task
+  rng = random.Random(seed)
+  popular = _sampler(user_count, alpha)
+  rows = []
+  for follower in range(start, start + count):
+    # 自己关注自己
+    rows.append({'follower_id': follower, 'followed_id': follower,
+                 'timestamp': now})
+    # 关注数: 帕累托分布, 平均约为follows; 长尾截断在100倍
+    k = min(user_count - 1, follows * 100,
+            int(rng.paretovariate(2.0) * follows / 2))
+    # 被关注者按幂律抽样, 冷门用户很难抽中, 限制尝试次数
+    followed = set()
+    for _ in range(k * 10):
+      if len(followed) >= k:
+        break
+      target = first_user + popular.sample(rng)
+      if target != follower:
+        followed.add(target)
+    rows.extend({'follower_id': follower, 'followed_id': target,
+                 'timestamp': _timestamp(rng, now, 365)}
+                for target in followed)
+  return rows
+
+
+def _next_id(model):
+  return (db.session.scalar(db.select(db.func.max(model.id))) or 0) + 1
+
+
+def _insert(executor, table, worker, tasks, log):
+  """在进程池中生成行, 按批插入"""
+  count = 0
+  started = time.monotonic()
+  for rows in executor.map(worker, tasks):
+    db.session.execute(table.insert(), rows)
+    db.session.commit()
+    count += len(rows)
+    if log:
+      log('%s: %d rows (%.0f rows/s)' % (
+          table.name, count, count / (time.monotonic() - started)))
+  return count
+
+
+def bulk(users=1000, posts=10000, comments=10000, follows=10,
+         batch_size=5000, processes=None, alpha=1.0, seed=None, log=print):
+  """批量生成用户, 帖子, 评论和关注, 返回各自插入的行数"""
+  seed = random.randrange(2 ** 32) if seed is None else seed
+  now = datetime.now(timezone.utc).replace(tzinfo=None)
+  password_hash = generate_password_hash('password')
+  role_id = role_cache().default_id()
+
+  def chunks(phase, start, total):
+    # 每个阶段, 每批不同的种子: 用户和关注的批次起点相同, 不能共用种子
+    for offset in range(0, total, batch_size):
+      yield start + offset, min(batch_size, total - offset), \
+          random.Random('%s:%d:%d' % (phase, seed, offset)).getrandbits(32)
+
+  counts = {}
+  if users <= 0:
+    return counts
+  with ProcessPoolExecutor(max_workers=processes) as executor:
+    first_user = _next_id(User)
+    counts['users'] = _insert(
+        executor, User.__table__, _user_rows,
+        [(s, c, sd, password_hash, role_id, now)
+         for s, c, sd in chunks('users', first_user, users)], log)
+    counts['follows'] = _insert(
+        executor, Follow.__table__, _follow_rows,
+        [(s, c, sd, first_user, users, follows, alpha, now)
+         for s, c, sd in chunks('follows', first_user, users)], log)
+    first_post = _next_id(Post)
+    counts['posts'] = _insert(
+        executor, Post.__table__, _post_rows,
+        [(s, c, sd, first_user, users, alpha, now)
+         for s, c, sd in chunks('posts', first_post, posts)], log)
+    if posts:
+      counts['comments'] = _insert(
+          executor, Comment.__table__, _comment_rows,
+          [(s, c, sd, first_user, users, first_post, posts, alpha, now)
+           for s, c, sd in chunks('comments', _next_id(Comment),
+                                  comments)], log)
+  # 批量插入没有触发计数器事件
+  User.recount()
+  Post.recount()
+  return counts
@@ -0,0 +1,144 @@
+# 关注关系
+#
+# 关注/取消关注, 以及当前用户与一组用户的关注关系:
+# - following_set(viewer, ids)/followers_set(viewer, ids): 一次IN查询回答
+#   一整页的检查
+# - 结果记在应用上下文(一个请求)的备忘中, 同一请求中重复的检查不再查询;
+#   Follow的插入/删除事件更新备忘, 回滚时清空
+
+from flask import g, has_app_context
+
+from . import db
+
+# 方向: viewer关注的, 关注viewer的
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+
+
+def _memo(viewer_id, direction):
+  """请求内的备忘: 用户id -> 是否有关注关系"""
+  if not has_app_context():
+    return {}
+  memo = g.get('_follow_memo')
+  if memo is None:
+    memo = g._follow_memo = {}
+  return memo.setdefault((viewer_id, direction), {})
+
+
+def _remember(follower_id, followed_id, value):
+  _memo(follower_id, FOLLOWING)[followed_id] = value
+  _memo(followed_id, FOLLOWERS)[follower_id] = value
+
+
+def _viewer_id(viewer):
+  if viewer is None or not viewer.is_authenticated:
+    return None
+  return viewer.id
+
+
+def _lookup(viewer, candidate_ids, direction):
+  from .models import Follow
+  viewer_id = _viewer_id(viewer)
+  ids = {id for id in candidate_ids if id is not None}
+  if viewer_id is None or not ids:
+    return set()
+  known = _memo(viewer_id, direction)
+  missing = ids.difference(known)
+  if missing:
+    if direction == FOLLOWING:
+      mine, other = Follow.follower_id, Follow.followed_id
+    else:
+      mine, other = Follow.followed_id, Follow.follower_id
+    found = set(db.session.scalars(
+        db.select(other).where(mine == viewer_id, other.in_(missing))))
+    for id in missing:
+      known[id] = id in found
+  return {id for id in ids if known[id]}
+
+
+def following_set(viewer, candidate_ids):
+  """candidate_ids中viewer关注的用户id"""
+  return _lookup(viewer, candidate_ids, FOLLOWING)
+
+
+def followers_set(viewer, candidate_ids):
+  """candidate_ids中关注viewer的用户id"""
+  return _lookup(viewer, candidate_ids, FOLLOWERS)
+
+
+def prefetch(viewer, candidate_ids):
+  """一次查询两个方向, 之后的following_set/followers_set使用备忘"""
+  from .models import Follow
+  viewer_id = _viewer_id(viewer)
+  if viewer_id is None:
+    return
+  following = _memo(viewer_id, FOLLOWING)
+  followers = _memo(viewer_id, FOLLOWERS)
+  ids = {id for id in candidate_ids
+         if id is not None and (id not in following or id not in followers)}
+  if not ids:
+    return
+  rows = db.session.execute(
+      db.select(Follow.follower_id, Follow.followed_id).where(
+          db.or_(
+              db.and_(Follow.follower_id == viewer_id,
+                      Follow.followed_id.in_(ids)),
+              db.and_(Follow.followed_id == viewer_id,
+                      Follow.follower_id.in_(ids))))).all()
+  for id in ids:
+    following[id] = False
+    followers[id] = False
+  for follower_id, followed_id in rows:
+    if follower_id == viewer_id:
+      following[followed_id] = True
+    if followed_id == viewer_id:
+      followers[follower_id] = True
+
+
+def is_following(follower, followed):
+  """follower是否关注followed"""
+  if follower.id is None or followed.id is None:
+    return False
+  return bool(following_set(follower, [followed.id]))
+
+
+def follow(follower, followed):
+  """关注, 已关注时不做任何事; 返回是否新建了关注关系"""
+  from .models import Follow
+  if is_following(follower, followed):
+    return False
+  db.session.add(Follow(follower=follower, followed=followed))
+  if follower.id is not None and followed.id is not None:
+    _remember(follower.id, followed.id, True)
+  return True
+
+
+def unfollow(follower, followed):
+  """取消关注, 未关注时不做任何事; 返回是否删除了关注关系"""
+  from .models import Follow
+  if follower.id is None or followed.id is None:
+    return False
+  f = db.session.get(Follow, (follower.id, followed.id))
+  if f is None:
+    _remember(follower.id, followed.id, False)
+    return False
+  db.session.delete(f)
+  _remember(follower.id, followed.id, False)
+  return True
+
+
+################################################################################
+# 事件: 保持备忘与数据库一致
+################################################################################
+
+def on_follow_inserted(mapper, connection, target):
+  _remember(target.follower_id, target.followed_id, True)
+
+
+def on_follow_deleted(mapper, connection, target):
+  _remember(target.follower_id, target.followed_id, False)
+
+
+def on_after_rollback(session):
+  if has_app_context():
+    g.pop('_follow_memo', None)
@@ -0,0 +1,152 @@
+# 模板片段缓存
+#
+#   {% cache 'post', post.id, post.version, viewer_class(post.author) %}
+#   ...
+#   {% endcache %}
+#
+# 第一个参数是片段名称(按名称统计命中率), 所有参数组成缓存键. 键中包含行版本,
+# 修改后的行不会命中旧的片段; 修改body时(模型的set事件)删除该行的片段.
+# LRU按字节数限制内存(APP_FRAGMENT_CACHE_BYTES, 0表示不缓存).
+
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+
+from flask import current_app, has_app_context
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentStore:
+  """片段键 -> 渲染结果, 按字节数的LRU"""
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.entries = OrderedDict()
+    # (名称, id) -> 键, 用于按行删除
+    self.index = defaultdict(set)
+    self.lock = threading.Lock()
+    # 名称 -> [命中, 未命中, 淘汰]
+    self.counters = defaultdict(lambda: [0, 0, 0])
+
+  def get(self, name, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.counters[name][1] += 1
+        return None
+      self.entries.move_to_end(key)
+      self.counters[name][0] += 1
+      return entry[0]
+
+  def set(self, name, key, value, tag=None):
+    size = sys.getsizeof(value)
+    if size > self.max_bytes:
+      return
+    with self.lock:
+      self._remove(key)
+      self.entries[key] = (value, size, name, tag)
+      self.bytes += size
+      if tag is not None:
+        self.index[tag].add(key)
+      while self.bytes > self.max_bytes:
+        old = next(iter(self.entries))
+        self.counters[self.entries[old][2]][2] += 1
+        self._remove(old)
+
+  def _remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return
+    self.bytes -= entry[1]
+    tag = entry[3]
+    if tag is not None:
+      keys = self.index[tag]
+      keys.discard(key)
+      if not keys:
+        del self.index[tag]
+
+  def invalidate(self, name, id):
+    """删除一行的所有片段"""
+    with self.lock:
+      for key in list(self.index.get((name, id), ())):
+        self._remove(key)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.index.clear()
+      self.bytes = 0
+
+  def stats(self):
+    fragments = {}
+    for name, (hits, misses, evictions) in list(self.counters.items()):
+      fragments[name] = {
+          'hits': hits, 'misses': misses, 'evictions': evictions,
+          'hit_rate': hits / (hits + misses) if hits + misses else None}
+    return {'entries': len(self.entries), 'bytes': self.bytes,
+            'max_bytes': self.max_bytes, 'fragments': fragments}
+
+
+class FragmentCacheExtension(Extension):
+  """Jinja扩展: {% cache name, key... %}...{% endcache %}"""
+
+  tags = {'cache'}
+
+  def parse(self, parser):
+    lineno = next(parser.stream).lineno
+    args = [parser.parse_expression()]
+    while parser.stream.skip_if('comma'):
+      args.append(parser.parse_expression())
+    body = parser.parse_statements(('name:endcache',), drop_needle=True)
+    return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]),
+                           [], [], body).set_lineno(lineno)
+
+  def _render(self, args, caller):
+    store = current_app.extensions.get('fragment_cache')
+    if store is None or store.max_bytes <= 0:
+      return caller()
+    name = args[0]
+    key = repr(args)
+    rv = store.get(name, key)
+    if rv is None:
+      rv = caller()
+      # 第二个参数是行id时可以按行删除
+      store.set(name, key, rv, tag=(name, args[1]) if len(args) > 1 else None)
+    return rv
+
+
+def viewer_class(author=None):
+  """当前用户相对于作者的权限分类, 用作片段缓存键"""
+  if not current_user.is_authenticated:
+    return 'anonymous'
+  if author is not None and current_user.id == author.id:
+    return 'author'
+  if current_user.is_administrator():
+    return 'admin'
+  return 'user'
+
+
+class FragmentCache:
+  """片段缓存扩展: app.extensions['fragment_cache']"""
+
+  def __init__(self, app=None):
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.extensions['fragment_cache'] = FragmentStore(
+        app.config['APP_FRAGMENT_CACHE_BYTES'])
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals['viewer_class'] = viewer_class
+
+
+def invalidate(name, id):
+  """模型事件中调用: 删除一行的片段"""
+  if id is None or not has_app_context():
+    return
+  store = current_app.extensions.get('fragment_cache')
+  if store is not None:
+    store.invalidate(name, id)
@@ -0,0 +1,194 @@
+# 密码哈希
+#
+# scrypt/PBKDF2每次上百毫秒CPU, 撞库时每个worker都被登录请求占满:
+# - 准入限制: 同时进行(执行+排队)的哈希不超过APP_PASSWORD_MAX_PENDING,
+#   超过时立即抛出PasswordHashingBusy(503), 不排队
+# - APP_PASSWORD_OFFLOAD时在进程池(APP_PASSWORD_WORKERS个进程)中计算,
+#   CPU占用有上限, 请求线程只等待结果; 名额在计算结束时才释放(超时的
+#   请求返回503, 但进程中的计算仍然占用名额). 进程用forkserver启动, 不从
+#   已经有后台线程(last_seen, 邮件)的worker中fork
+# - 登录成功且哈希的方法/成本不是APP_PASSWORD_METHOD时用明文重新哈希
+#
+# flask hashing bench: 并发登录时的吞吐量和延迟
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    TimeoutError as FutureTimeout
+
+from flask import current_app, has_app_context
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, \
+    check_password_hash, generate_password_hash
+
+from .exceptions import PasswordHashingBusy
+from .metrics import timed
+from .queries import percentile
+
+
+def method_of(pwhash):
+  """哈希字符串的方法和参数, 如scrypt:32768:8:1"""
+  return (pwhash or '').split('$', 1)[0]
+
+
+def normalize_method(method):
+  """补全werkzeug的默认参数, 与哈希中保存的形式相同: scrypt -> scrypt:32768:8:1"""
+  parts = method.split(':')
+  if parts[0] == 'scrypt' and len(parts) == 1:
+    return 'scrypt:32768:8:1'
+  if parts[0] == 'pbkdf2' and len(parts) < 3:
+    return 'pbkdf2:%s:%d' % (parts[1] if len(parts) == 2 else 'sha256',
+                             DEFAULT_PBKDF2_ITERATIONS)
+  return method
+
+
+class PasswordHasher:
+  """密码哈希服务: app.extensions['password_hasher']"""
+
+  def __init__(self, app=None):
+    self.executor = None
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    config = app.config
+    self.configure(config['APP_PASSWORD_METHOD'],
+                   config['APP_PASSWORD_OFFLOAD'],
+                   config['APP_PASSWORD_WORKERS'],
+                   config['APP_PASSWORD_MAX_PENDING'],
+                   config['APP_PASSWORD_TIMEOUT'])
+    app.extensions['password_hasher'] = self
+
+  def configure(self, method, offload=False, workers=2, max_pending=None,
+                timeout=None):
+    """max_pending: None表示不限制"""
+    self.shutdown()
+    self.method = method
+    self.offload = offload
+    self.workers = workers
+    self.max_pending = max_pending
+    self.timeout = timeout
+    self.slots = threading.BoundedSemaphore(max_pending) \
+        if max_pending else None
+    # 指标
+    self.hashed = 0
+    self.rejected = 0
+    self.timeouts = 0
+
+  def get_executor(self):
+    if self.executor is None:
+      self.executor = ProcessPoolExecutor(
+          max_workers=self.workers,
+          mp_context=multiprocessing.get_context('forkserver'))
+    return self.executor
+
+  def _run(self, fn, *args):
+    slots = self.slots
+    if slots is not None and not slots.acquire(blocking=False):
+      self.rejected += 1
+      raise PasswordHashingBusy('too many concurrent password checks')
+
+    def release(future=None):
+      if slots is not None:
+        slots.release()
+
+    with timed('auth'):
+      if not self.offload:
+        try:
+          result = fn(*args)
+        finally:
+          release()
+      else:
+        try:
+          future = self.get_executor().submit(fn, *args)
+        except BaseException:
+          release()
+          raise
+        future.add_done_callback(release)
+        try:
+          result = future.result(self.timeout)
+        except FutureTimeout:
+          self.timeouts += 1
+          raise PasswordHashingBusy('password check timed out')
+    self.hashed += 1
+    return result
+
+  def hash(self, password):
+    return self._run(generate_password_hash, password, self.method)
+
+  def verify(self, pwhash, password):
+    if not pwhash:
+      return False
+    return self._run(check_password_hash, pwhash, password)
+
+  def needs_rehash(self, pwhash):
+    return method_of(pwhash) != normalize_method(self.method)
+
+  def stats(self):
+    return {'method': self.method, 'offload': self.offload,
+            'workers': self.workers, 'max_pending': self.max_pending,
+            'hashed': self.hashed, 'rejected': self.rejected,
+            'timeouts': self.timeouts}
+
+  def shutdown(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+
+
+# 没有应用上下文时(脚本): werkzeug的默认方法, 在当前线程计算
+_default = PasswordHasher()
+_default.configure('scrypt')
+
+
+def password_hasher():
+  """当前应用的哈希服务"""
+  if has_app_context():
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is not None:
+      return hasher
+  return _default
+
+
+################################################################################
+# 基准测试
+################################################################################
+
+def benchmark(hasher, concurrency=16, seconds=5.0, retry_delay=0.05):
+  """concurrency个客户端在seconds秒内不断登录, 被拒绝的等待retry_delay后重试
+
+  返回每秒成功的验证数, 拒绝数, 成功的验证和拒绝的p50/p99(秒).
+  """
+  pwhash = generate_password_hash('password', hasher.method)
+  # 预热进程池
+  if hasher.offload:
+    list(hasher.get_executor().map(abs, range(hasher.workers)))
+  deadline = time.perf_counter() + seconds
+
+  def client(_):
+    verified, rejected = [], []
+    while time.perf_counter() < deadline:
+      start = time.perf_counter()
+      try:
+        hasher.verify(pwhash, 'password')
+      except PasswordHashingBusy:
+        rejected.append(time.perf_counter() - start)
+        time.sleep(retry_delay)
+        continue
+      verified.append(time.perf_counter() - start)
+    return verified, rejected
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    results = list(executor.map(client, range(concurrency)))
+  elapsed = time.perf_counter() - start
+  verified = sorted(d for v, _ in results for d in v)
+  rejected = sorted(d for _, r in results for d in r)
+  return {
+      'verified': len(verified),
+      'rejected': len(rejected),
+      'per_second': len(verified) / elapsed,
+      'p50': percentile(verified, 0.5),
+      'p99': percentile(verified, 0.99),
+      'rejected_p99': percentile(rejected, 0.99),
+  }
@@ -0,0 +1,99 @@
+# 当前用户的缓存
+#
+# Flask-Login的load_user每个请求按主键查询一次users:
+# - 用户的快照(UserSnapshot)在进程中按id缓存APP_USER_CACHE_TTL秒,
+#   current_user是每个请求一个的CurrentUser, 模板只读快照的属性
+# - 本进程提交的User修改(资料, 确认, 邮箱, 角色, 密码)在提交后删除条目;
+#   其他进程(gunicorn worker)最多延迟TTL
+# - 版本: 每次失效加1, 加载期间发生过失效的快照不放入缓存, 避免并发的
+#   请求用旧值覆盖
+# - 值为用户id的其他缓存(API的Basic认证缓存)用track登记, 随用户一起失效
+
+import threading
+
+from flask import current_app, has_app_context
+
+from .cache import TTLCache
+
+
+class IdentityCache:
+  """用户id -> UserSnapshot"""
+
+  def __init__(self, maxsize, ttl):
+    self.cache = TTLCache(maxsize, ttl)
+    self.lock = threading.Lock()
+    self.version = 0
+    self.tracked = []  # 值为用户id的缓存
+
+  def get(self, user_id):
+    """用户的快照, 用户不存在时为None"""
+    snapshot = self.cache.get(user_id)
+    if snapshot is not None:
+      return snapshot
+    from . import db
+    from .models import User, UserSnapshot
+    version = self.version
+    user = db.session.get(User, user_id)
+    if user is None:
+      return None
+    snapshot = UserSnapshot.from_user(user)
+    with self.lock:
+      if self.version == version:
+        self.cache.set(user_id, snapshot)
+    return snapshot
+
+  def track(self, cache):
+    """登记值为用户id的缓存: 用户修改提交后删除对应的条目"""
+    with self.lock:
+      self.tracked.append(cache)
+
+  def remember(self, cache, key, user_id, version, ttl=None):
+    """cache[key] = user_id; version之后发生过失效时不放入"""
+    with self.lock:
+      if self.version == version:
+        cache.set(key, user_id, ttl=ttl)
+
+  def invalidate(self, user_ids):
+    with self.lock:
+      self.version += 1
+      for user_id in user_ids:
+        self.cache.delete(user_id)
+      for cache in self.tracked:
+        cache.delete_where(lambda user_id: user_id in user_ids)
+
+  def stats(self):
+    stats = self.cache.stats()
+    stats['version'] = self.version
+    return stats
+
+
+def identity_cache():
+  """当前应用的用户缓存"""
+  cache = current_app.extensions.get('identity_cache')
+  if cache is None:
+    config = current_app.config
+    cache = current_app.extensions.setdefault(
+        'identity_cache',
+        IdentityCache(config['APP_USER_CACHE_SIZE'],
+                      config['APP_USER_CACHE_TTL']))
+  return cache
+
+
+################################################################################
+# 模型事件
+################################################################################
+
+def on_user_changed(mapper, connection, target):
+  """用户有修改: 提交后失效"""
+  from . import db
+  db.session.info.setdefault('users_changed', set()).add(target.id)
+
+
+def on_after_commit(session):
+  user_ids = session.info.pop('users_changed', None)
+  if user_ids and has_app_context():
+    identity_cache().invalidate(user_ids)
+
+
+def on_after_rollback(session):
+  session.info.pop('users_changed', None)
@@ -0,0 +1,133 @@
+# 用户最后访问时间的延迟写入
+#
+# User.ping()不再每个请求UPDATE + commit一次:
+# - 访问时间先记在内存中, 同一用户每APP_LAST_SEEN_RESOLUTION秒最多写一次
+# - 后台线程每APP_LAST_SEEN_FLUSH_INTERVAL秒用一条executemany UPDATE写入;
+#   间隔为0时在请求结束时写入
+# - 进程退出时(atexit)停止后台线程并写入剩余的时间
+
+import atexit
+import threading
+import time
+
+from flask import current_app
+
+
+class LastSeenBuffer:
+  """用户id -> 待写入的最后访问时间"""
+
+  def __init__(self, app):
+    self.app = app
+    self.resolution = app.config['APP_LAST_SEEN_RESOLUTION']
+    self.interval = app.config['APP_LAST_SEEN_FLUSH_INTERVAL']
+    self.lock = threading.Lock()
+    self.pending = {}
+    # 用户id -> 上次写入的时间(monotonic), 用于合并
+    self.written = {}
+    self.pruned = time.monotonic()
+    self.thread = None
+    self.stopped = threading.Event()
+    # 指标
+    self.touches = 0
+    self.coalesced = 0
+    self.flushes = 0
+    self.rows = 0
+
+  def touch(self, user_id, when):
+    """记录一次访问, 返回是否会写入数据库"""
+    now = time.monotonic()
+    with self.lock:
+      self.touches += 1
+      if user_id in self.pending:
+        self.pending[user_id] = when
+        self.coalesced += 1
+        return False
+      written = self.written.get(user_id)
+      if written is not None and now - written < self.resolution:
+        self.coalesced += 1
+        return False
+      self.pending[user_id] = when
+      self.written[user_id] = now
+    if self.interval > 0:
+      self.start()
+    return True
+
+  def flush(self):
+    """一次批量写入所有待写入的时间, 返回行数"""
+    with self.lock:
+      pending, self.pending = self.pending, {}
+      self._prune()
+    if not pending:
+      return 0
+    from . import db
+    from .models import User
+    table = User.__table__
+    try:
+      with self.app.app_context():
+        with db.engine.begin() as conn:
+          conn.execute(
+              table.update()
+              .where(table.c.id == db.bindparam('user_id'))
+              .values(last_seen=db.bindparam('last_seen')),
+              [{'user_id': id, 'last_seen': when}
+               for id, when in pending.items()])
+    except Exception as e:
+      self.app.logger.error('Flush last_seen of %d users failed: %s',
+                            len(pending), e)
+      # 放回, 下次再写(不覆盖之后的访问)
+      with self.lock:
+        for id, when in pending.items():
+          self.pending.setdefault(id, when)
+      return 0
+    self.flushes += 1
+    self.rows += len(pending)
+    return len(pending)
+
+  def _prune(self):
+    # 丢弃已经超过合并时间的写入记录
+    now = time.monotonic()
+    if now - self.pruned < self.resolution:
+      return
+    self.pruned = now
+    self.written = {id: written for id, written in self.written.items()
+                    if now - written < self.resolution}
+
+  def start(self):
+    if self.thread is not None:
+      return
+    with self.lock:
+      if self.thread is not None:
+        return
+      self.thread = threading.Thread(target=self._run,
+                                     name='last-seen-flusher', daemon=True)
+      self.thread.start()
+    atexit.register(self.shutdown)
+
+  def _run(self):
+    while not self.stopped.wait(self.interval):
+      self.flush()
+
+  def shutdown(self, timeout=10):
+    """停止后台线程, 写入剩余的时间"""
+    self.stopped.set()
+    thread = self.thread
+    if thread is not None and thread is not threading.current_thread():
+      thread.join(timeout)
+    self.flush()
+
+  def stats(self):
+    return {'pending': len(self.pending), 'touches': self.touches,
+            'coalesced': self.coalesced, 'flushes': self.flushes,
+            'rows': self.rows}
+
+
+_lock = threading.Lock()
+
+
+def last_seen_buffer(app=None):
+  """应用的最后访问时间缓冲, 第一次使用时创建"""
+  app = app or current_app._get_current_object()
+  with _lock:
+    if 'last_seen' not in app.extensions:
+      app.extensions['last_seen'] = LastSeenBuffer(app)
+  return app.extensions['last_seen']
@@ -0,0 +1,47 @@
+# 列表页面的加载配置
+#
+# 模板会访问每一行的作者(post.author.username, gravatar()), 默认的延迟加载
+# 每行一次查询(N+1). 视图按名称选择加载配置, 在列表查询中一起加载:
+# - 多对一的作者: JOIN
+# - 计数: 使用计数器列(post_count, comment_count等), 不需要查询
+# - 与当前用户相关的标记(是否关注作者): ViewerFlags一次查询整页(follows模块)
+
+from . import db
+from .follows import followers_set, following_set, prefetch
+from .models import Comment, Post
+
+# 名称 -> 返回加载选项的函数(backref在映射配置后才有)
+PROFILES = {
+    # 帖子列表: 作者
+    'posts': lambda: (db.joinedload(Post.author),),
+    # 评论列表: 作者
+    'comments': lambda: (db.joinedload(Comment.author),),
+    # 管理评论: 作者, 所属帖子
+    'moderation': lambda: (db.joinedload(Comment.author),
+                           db.joinedload(Comment.post)),
+}
+
+
+def load(query, profile):
+  """按名称给查询加上加载选项"""
+  return query.options(*PROFILES[profile]())
+
+
+class ViewerFlags:
+  """当前用户与一页中的用户的关注关系"""
+
+  def __init__(self, viewer, users):
+    ids = {user.id for user in users
+           if user.id != getattr(viewer, 'id', None)}
+    # 一次查询两个方向, 结果在请求内的备忘中
+    prefetch(viewer, ids)
+    self.following = following_set(viewer, ids)
+    self.followers = followers_set(viewer, ids)
+
+  def follows(self, user):
+    """当前用户是否关注user"""
+    return user.id in self.following
+
+  def followed_by(self, user):
+    """user是否关注当前用户"""
+    return user.id in self.followers
@@ -0,0 +1,436 @@
+# 负载测试
+#
+# flask loadtest seed: 按规模生成数据(用户的密码都是password)
+# flask loadtest run: 启动本地gunicorn(或使用--url指定的服务), 多个并发的
+#   客户端按比例执行场景, 统计每个端点的RPS和延迟分位数, 结果保存为JSON
+# flask loadtest compare: 比较两次的结果(如两个提交), 有退化时退出码为1
+#
+# 场景:
+# - browse: 匿名浏览首页, 翻页, 用户页, 帖子页
+# - api: 令牌认证, 轮询时间线和帖子列表
+# - post: 通过API发帖
+# - comment: 通过API评论
+# - follow: 登录网页, 关注/取消关注
+#
+# 客户端是线程, 闭环(收到响应后才发下一个请求); 只用标准库.
+
+import base64
+import http.cookiejar
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from werkzeug.security import check_password_hash
+
+from .queries import percentile
+
+# 数据规模: 用户, 帖子, 评论, 每个用户平均关注数
+SIZES = {
+    'small': {'users': 1000, 'posts': 10000, 'comments': 10000,
+              'follows': 10},
+    'medium': {'users': 10000, 'posts': 100000, 'comments': 100000,
+               'follows': 20},
+    'large': {'users': 100000, 'posts': 1000000, 'comments': 1000000,
+              'follows': 50},
+}
+
+MIX = {'browse': 50, 'api': 25, 'post': 5, 'comment': 10, 'follow': 10}
+
+PASSWORD = 'password'
+
+_CSRF = re.compile(
+    r'<input[^>]*name="csrf_token"[^>]*value="([^"]+)"|'
+    r'<input[^>]*value="([^"]+)"[^>]*name="csrf_token"')
+
+
+def seed(size='small', log=print, **options):
+  """生成数据并重建时间线, options覆盖规模中的数量和fake.bulk的参数"""
+  from . import fake
+  from .models import TimelineEntry
+  counts = dict(SIZES[size])
+  counts.update({k: v for k, v in options.items() if v is not None})
+  inserted = fake.bulk(log=log, **counts)
+  inserted['timelines'] = TimelineEntry.rebuild()
+  return inserted
+
+
+def dataset(limit=1000, seed=None):
+  """客户端使用的数据: 随机的用户(id, email, username)和帖子id, 各表行数"""
+  from . import db
+  from .models import Comment, Follow, Post, User
+  rng = random.Random(seed)
+  # 批量生成的用户共用一个密码哈希, 只使用密码是PASSWORD的用户
+  pwhash = db.session.query(User.password_hash) \
+      .group_by(User.password_hash) \
+      .order_by(db.func.count().desc()).limit(1).scalar()
+  user_ids = []
+  if pwhash and check_password_hash(pwhash, PASSWORD):
+    user_ids = [id for id, in db.session.query(User.id)
+                .filter(User.password_hash == pwhash,
+                        User.confirmed.is_(True))]
+  users = []
+  for chunk in _chunks(rng.sample(user_ids, min(limit, len(user_ids))), 500):
+    users.extend(db.session.query(User.id, User.email, User.username)
+                 .filter(User.id.in_(chunk)))
+  post_ids = [id for id, in db.session.query(Post.id)]
+  posts = rng.sample(post_ids, min(limit, len(post_ids)))
+  counts = {model.__tablename__: db.session.query(model).count()
+            for model in (User, Post, Comment, Follow)}
+  db.session.rollback()
+  return {'users': [tuple(u) for u in users], 'posts': posts,
+          'counts': counts}
+
+
+def _chunks(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+
+################################################################################
+# 客户端
+################################################################################
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+  """重定向作为响应返回, 不再请求目标"""
+
+  def redirect_request(self, *args, **kwargs):
+    return None
+
+
+class Client:
+  """一个虚拟用户: 自己的cookie, 令牌; 记录(端点, 状态码, 开始, 耗时)"""
+
+  def __init__(self, url, user, data, rng, timeout=30):
+    self.url = url.rstrip('/')
+    self.user = user  # (id, email, username)
+    self.data = data
+    self.rng = rng
+    self.timeout = timeout
+    self.opener = urllib.request.build_opener(
+        _NoRedirect(),
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    self.token = None
+    self.logged_in = False
+    self.following = set()
+    self.samples = []
+
+  def request(self, label, path, method='GET', data=None, json_body=None,
+              headers=None):
+    """label: 统计用的端点名称; 返回(状态码, 响应体), 连接错误时状态码为0"""
+    headers = dict(headers or {})
+    if json_body is not None:
+      data = json.dumps(json_body).encode('utf-8')
+      headers['Content-Type'] = 'application/json'
+    elif data is not None:
+      data = urllib.parse.urlencode(data).encode('utf-8')
+    req = urllib.request.Request(self.url + path, data=data,
+                                 headers=headers, method=method)
+    start = time.perf_counter()
+    try:
+      with self.opener.open(req, timeout=self.timeout) as response:
+        status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+      status, body = e.code, e.read()
+    except OSError:
+      status, body = 0, b''
+    self.samples.append((label, status, start, time.perf_counter() - start))
+    return status, body
+
+  def auth_headers(self):
+    if self.token is None:
+      _, email, _ = self.user
+      status, body = self.request(
+          'POST /api/v1/tokens/', '/api/v1/tokens/', method='POST',
+          headers=_basic(email, PASSWORD))
+      if status != 200:
+        return None
+      self.token = json.loads(body)['token']
+    return _basic(self.token, '')
+
+  def login(self):
+    if not self.logged_in:
+      _, body = self.request('GET /auth/login', '/auth/login')
+      match = _CSRF.search(body.decode('utf-8', 'replace'))
+      form = {'email': self.user[1], 'password': PASSWORD}
+      if match:
+        form['csrf_token'] = match.group(1) or match.group(2)
+      status, _ = self.request('POST /auth/login', '/auth/login',
+                               method='POST', data=form)
+      self.logged_in = status == 302
+    return self.logged_in
+
+  def random_user(self):
+    return self.rng.choice(self.data['users'])
+
+  def random_post(self):
+    return self.rng.choice(self.data['posts'])
+
+
+def _basic(username, password):
+  credentials = ('%s:%s' % (username, password)).encode('utf-8')
+  return {'Authorization':
+          'Basic ' + base64.b64encode(credentials).decode('ascii')}
+
+
+################################################################################
+# 场景
+################################################################################
+
+def browse(client):
+  client.request('GET /', '/')
+  client.request('GET /?page=<n>', '/?page=%d' % client.rng.randint(2, 5))
+  client.request('GET /user/<username>',
+                 '/user/' + urllib.parse.quote(client.random_user()[2]))
+  client.request('GET /post/<id>', '/post/%d' % client.random_post())
+
+
+def api(client):
+  headers = client.auth_headers()
+  if headers is None:
+    return
+  client.request('GET /api/v1/users/<id>/timeline/',
+                 '/api/v1/users/%d/timeline/' % client.user[0],
+                 headers=headers)
+  client.request('GET /api/v1/posts/', '/api/v1/posts/', headers=headers)
+  client.request('GET /api/v1/posts/<id>/comments/',
+                 '/api/v1/posts/%d/comments/' % client.random_post(),
+                 headers=headers)
+
+
+def post(client):
+  headers = client.auth_headers()
+  if headers is None:
+    return
+  client.request('POST /api/v1/posts/', '/api/v1/posts/', method='POST',
+                 json_body={'body': _text(client.rng)}, headers=headers)
+
+
+def comment(client):
+  headers = client.auth_headers()
+  if headers is None:
+    return
+  client.request('POST /api/v1/posts/<id>/comments/',
+                 '/api/v1/posts/%d/comments/' % client.random_post(),
+                 method='POST', json_body={'body': _text(client.rng)},
+                 headers=headers)
+
+
+def follow(client):
+  if not client.login():
+    return
+  username = client.random_user()[2]
+  if username == client.user[2]:
+    return
+  quoted = urllib.parse.quote(username)
+  if username in client.following:
+    client.request('GET /unfollow/<username>', '/unfollow/' + quoted)
+    client.following.discard(username)
+  else:
+    client.request('GET /follow/<username>', '/follow/' + quoted)
+    client.following.add(username)
+  client.request('GET /followed', '/followed')
+  client.request('GET / (followed)', '/')
+
+
+SCENARIOS = {'browse': browse, 'api': api, 'post': post, 'comment': comment,
+             'follow': follow}
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def _text(rng):
+  words = [rng.choice(_WORDS) for _ in range(rng.randint(5, 40))]
+  if rng.random() < 0.3:
+    words[0] = '**%s**' % words[0]
+  return ' '.join(words)
+
+
+def parse_mix(text):
+  """'browse=50,api=25' -> {'browse': 50, 'api': 25}"""
+  mix = {}
+  for item in filter(None, (s.strip() for s in text.split(','))):
+    name, _, weight = item.partition('=')
+    if name not in SCENARIOS:
+      raise ValueError('unknown scenario: %s' % name)
+    mix[name] = float(weight or 1)
+  if not mix or sum(mix.values()) <= 0:
+    raise ValueError('empty mix')
+  return mix
+
+
+################################################################################
+# 运行
+################################################################################
+
+def run(url, data, clients=16, seconds=30.0, warmup=5.0, mix=None,
+        think=0.0, seed=None):
+  """clients个客户端在warmup + seconds秒内按mix执行场景, 返回结果
+
+  每个客户端是数据中的一个用户; 预热期间的请求不计入统计.
+  """
+  mix = mix or MIX
+  names = list(mix)
+  weights = [mix[name] for name in names]
+  rng = random.Random(seed)
+  # 在提交前按客户端顺序取种子: 线程的启动顺序不影响每个客户端的随机序列
+  seeds = [rng.random() for _ in range(clients)]
+  started = time.perf_counter()
+  measure_from = started + warmup
+  deadline = measure_from + seconds
+  stop = threading.Event()
+
+  def worker(i):
+    client = Client(url, data['users'][i % len(data['users'])], data,
+                    random.Random(seeds[i]))
+    while time.perf_counter() < deadline and not stop.is_set():
+      name = client.rng.choices(names, weights)[0]
+      SCENARIOS[name](client)
+      if think:
+        time.sleep(client.rng.expovariate(1.0 / think))
+    return client.samples
+
+  with ThreadPoolExecutor(max_workers=clients) as executor:
+    futures = [executor.submit(worker, i) for i in range(clients)]
+    try:
+      samples = [s for future in futures for s in future.result()]
+    except KeyboardInterrupt:
+      stop.set()
+      raise
+  ended = min(time.perf_counter(), deadline)
+  samples = [s for s in samples if s[2] >= measure_from]
+  return summarize(samples, max(ended - measure_from, 1e-9))
+
+
+def summarize(samples, elapsed):
+  """[(端点, 状态码, 开始, 耗时)] -> 总计和每个端点的统计(秒)"""
+  def stats(items):
+    latencies = sorted(d for _, _, _, d in items)
+    statuses = {}
+    for _, status, _, _ in items:
+      statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(n for status, n in statuses.items()
+                 if status == '0' or int(status) >= 400)
+    return {
+        'requests': len(items),
+        'errors': errors,
+        'statuses': statuses,
+        'rps': len(items) / elapsed,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+  endpoints = {}
+  for sample in samples:
+    endpoints.setdefault(sample[0], []).append(sample)
+  return {'seconds': elapsed, 'total': stats(samples),
+          'endpoints': {label: stats(items)
+                        for label, items in sorted(endpoints.items())}}
+
+
+def error_rate(r):
+  """错误请求的比例"""
+  return r['errors'] / r['requests'] if r and r['requests'] else 0.0
+
+
+def compare(base, new, threshold=0.1):
+  """比较两次结果: [(端点, 基准, 新), ...]和是否有退化
+
+  退化: 吞吐量下降, p99或错误率(errors / requests)上升超过threshold(比例),
+  或者基准中有的端点在新结果中没有请求.
+  """
+  rows = []
+  regressed = False
+  labels = ['total'] + sorted(set(base['endpoints']) | set(new['endpoints']))
+  for label in labels:
+    if label == 'total':
+      a, b = base['total'], new['total']
+    else:
+      a, b = base['endpoints'].get(label), new['endpoints'].get(label)
+    worse = bool(a) and not b
+    if a and b:
+      if a['rps'] and b['rps'] < a['rps'] * (1 - threshold):
+        worse = True
+      if a['p99'] and b['p99'] and b['p99'] > a['p99'] * (1 + threshold):
+        worse = True
+      if error_rate(b) > error_rate(a) * (1 + threshold):
+        worse = True
+    regressed = regressed or worse
+    rows.append((label, a, b, worse))
+  return rows, regressed
+
+
+@contextmanager
+def server(workers=4, port=None, timeout=30.0, args=(), cwd=None, log=print):
+  """启动本地gunicorn(main:app, 当前环境变量), 返回URL"""
+  port = port or _free_port()
+  command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+             '--bind', '127.0.0.1:%d' % port, '--log-level', 'warning']
+  command += list(args) + ['main:app']
+  log('Starting %s' % ' '.join(command[2:]))
+  process = subprocess.Popen(command, cwd=cwd)
+  url = 'http://127.0.0.1:%d' % port
+  try:
+    _wait_ready(url, process, timeout)
+    yield url
+  finally:
+    process.send_signal(signal.SIGTERM)
+    try:
+      process.wait(timeout)
+    except subprocess.TimeoutExpired:
+      process.kill()
+      process.wait()
+
+
+def _free_port():
+  import socket
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def _wait_ready(url, process, timeout):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError('gunicorn exited with %d' % process.returncode)
+    try:
+      with urllib.request.urlopen(url + '/', timeout=2):
+        return
+    except urllib.error.HTTPError:
+      return
+    except OSError:
+      time.sleep(0.2)
+  raise RuntimeError('gunicorn did not start in %.0f seconds' % timeout)
+
+
+def environment():
+  """结果中记录的环境: 提交, 时间, Python, CPU数"""
+  commit = None
+  try:
+    commit = subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+        text=True, timeout=5,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() \
+        or None
+  except (OSError, subprocess.SubprocessError):
+    pass
+  return {'commit': commit,
+          'started': datetime.now(timezone.utc).isoformat(),
+          'python': sys.version.split()[0],
+          'cpus': os.cpu_count()}
@@ -1,7 +1,15 @@
 # 错误处理
 
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, flash, redirect
 from . import main  # blueprint
+from ..exceptions import PasswordHashingBusy, ValidationError
+
+
+@main.errorhandler(ValidationError)
+def validation_error(e):
+  # 例如无效的分页游标: 回到第一页
+  flash(e.args[0])
+  return redirect(request.path)
 
 
 @main.app_errorhandler(403)
@@ -32,3 +40,14 @@ def internal_server_error(e):
     response.status_code = 500
     return response
   return render_template('500.html'), 500
+
+
+@main.app_errorhandler(PasswordHashingBusy)
+def service_unavailable(e):
+  # 登录请求过多: 立即拒绝, 客户端稍后重试
+  if request.accept_mimetypes.accept_json and \
+          not request.accept_mimetypes.accept_html:
+    response = jsonify({'error': 'service unavailable'})
+  else:
+    response = render_template('503.html')
+  return response, 503, {'Retry-After': '1'}
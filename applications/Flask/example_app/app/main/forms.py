@@ -2,8 +2,9 @@
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField, BooleanField, SelectField
-from wtforms.validators import DataRequired, Length, Email, Regexp, ValidationError
-from ..models import User, Role
+from wtforms.validators import AnyOf, DataRequired, Length, Email, Regexp, ValidationError
+from ..models import User
+from ..roles import role_cache
 from flask_pagedown.fields import PageDownField
 
 ################################################################################
@@ -42,8 +43,7 @@ class EditProfileAdminForm(FlaskForm):
 
   def __init__(self, user, *args, **kwargs):
     super(EditProfileAdminForm, self).__init__(*args, **kwargs)
-    self.role.choices = [(role.id, role.name)
-                         for role in Role.query.order_by(Role.name).all()]
+    self.role.choices = role_cache().choices()
     self.user = user
 
   def validate_email(self, field):
@@ -70,3 +70,8 @@ class PostForm(FlaskForm):
 class CommentForm(FlaskForm):
   body = StringField('', validators=[DataRequired()])
   submit = SubmitField('Submit')
+
+
+class BulkModerationForm(FlaskForm):
+  """批量审核: 提交按钮的值为action, 选中的评论为复选框ids(CSRF保护)"""
+  action = StringField('Action', validators=[AnyOf(['enable', 'disable'])])
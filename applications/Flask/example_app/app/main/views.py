@@ -1,27 +1,23 @@
 # 视图/路由
 
+import hmac
 from datetime import datetime
 from sqlite3.dbapi2 import Timestamp
-from flask import current_app, render_template, redirect, url_for, flash, request, abort
+from flask import current_app, render_template, redirect, url_for, flash, request, abort, make_response, jsonify
 from flask_login import current_user, login_required
 
-from ..decorators import admin_required, permission_required
+from ..decorators import admin_required, csrf_required, permission_required, \
+    query_budget, use_primary
 from . import main  # blueprint
-from .forms import EditProfileForm, NameForm, EditProfileAdminForm, PostForm, CommentForm
-from .. import db
-from ..models import Permission, User, Role, Post, Comment
-from flask_sqlalchemy.record_queries import get_recorded_queries
-
-
-@main.after_app_request
-def after_request(response):  # 请求后处理器
-  for query in get_recorded_queries():
-    # if query.duration >= current_app.config['APP_SLOW_DB_QUERY_TIME']:
-    current_app.logger.debug(
-        'Query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n'
-        % (query.statement, query.parameters, query.duration,
-           query.location))
-  return response
+from .forms import EditProfileForm, NameForm, EditProfileAdminForm, PostForm, CommentForm, \
+    BulkModerationForm
+from .. import db, moderation
+from ..models import Permission, User, Role, Post, Comment, Follow
+from ..identity import identity_cache
+from ..loading import ViewerFlags, load
+from ..pagination import KeysetPagination, paginate
+from ..search import key_values, search_query
+
 
 # deprecated: https://github.com/pallets/werkzeug/issues/1752
 #
@@ -41,47 +37,85 @@ def after_request(response):  # 请求后处理器
 
 
 @main.route('/', methods=['GET', 'POST'])  # 主页
+@query_budget(6)
 def index():
   form = PostForm()
   if current_user.can(Permission.WRITE) and form.validate_on_submit():
-    post = Post(body=form.body.data, author=current_user._get_current_object())
+    # current_user是缓存的快照, 只设置外键
+    post = Post(body=form.body.data, author_id=current_user.id)
     db.session.add(post)
     db.session.commit()
     return redirect(url_for('.index'))
+  # 全部帖子或关注的人的帖子(时间线)
+  show_followed = False
+  if current_user.is_authenticated:
+    show_followed = bool(request.cookies.get('show_followed', ''))
+  if show_followed:
+    query, keys = current_user.timeline
+  else:
+    query, keys = Post.query, (Post.timestamp, Post.id)
   # 分页
-  page = request.args.get('page', 1, type=int)
-  pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-      page=page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(load(query, 'posts'), keys,
+                        current_app.config['APP_POSTS_PER_PAGE'])
   posts = pagination.items
-  return render_template('index.html', form=form, posts=posts, pagination=pagination)
+  post_flags = ViewerFlags(current_user, [post.author for post in posts])
+  return render_template('index.html', form=form, posts=posts,
+                         show_followed=show_followed, pagination=pagination,
+                         post_flags=post_flags)
+
+
+@main.route('/all')  # 主页显示全部帖子
+@login_required
+def show_all():
+  resp = make_response(redirect(url_for('.index')))
+  resp.set_cookie('show_followed', '', max_age=30*24*60*60)  # 30天
+  return resp
+
+
+@main.route('/followed')  # 主页显示关注的人的帖子
+@login_required
+def show_followed():
+  resp = make_response(redirect(url_for('.index')))
+  resp.set_cookie('show_followed', '1', max_age=30*24*60*60)  # 30天
+  return resp
 
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])  # 帖子, 评论表单
+@query_budget(6)
 def post(id):
-  post = Post.query.get_or_404(id)
+  post = load(Post.query, 'posts').filter_by(id=id).first_or_404()
   form = CommentForm()
   if form.validate_on_submit():
     comment = Comment(body=form.body.data,
                       post=post,
-                      author=current_user._get_current_object())
+                      author_id=current_user.id)
     db.session.add(comment)
     db.session.commit()
     flash('Your comment has been published.')
     return redirect(url_for('.post', id=post.id, page=-1))
+  per_page = current_app.config['APP_COMMENTS_PER_PAGE']
   page = request.args.get('page', 1, type=int)
   if page == -1:
-    page = (post.comments.count() - 1) // \
-        current_app.config['APP_COMMENTS_PER_PAGE'] + 1
-  pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-      page=page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-      error_out=False)
+    # 最后一页
+    total = post.comment_count
+    pagination = KeysetPagination(load(post.comments, 'comments'),
+                                  (Comment.timestamp, Comment.id),
+                                  per_page, desc=False,
+                                  page=(total - 1) // per_page + 1,
+                                  total=total)
+  else:
+    pagination = paginate(load(post.comments, 'comments'),
+                          (Comment.timestamp, Comment.id),
+                          per_page, desc=False, total=post.comment_count)
   comments = pagination.items
+  post_flags = ViewerFlags(current_user, [post.author])
   return render_template('post.html', posts=[post], form=form,
-                         comments=comments, pagination=pagination)
+                         comments=comments, pagination=pagination,
+                         post_flags=post_flags)
 
 
 @main.route('/edit/<int:id>', methods=['GET', 'POST'])  # 编辑帖子
+@use_primary
 @login_required
 def edit_post(id):
   post = Post.query.get_or_404(id)
@@ -102,17 +136,19 @@ def edit_post(id):
 @main.route('/moderate')  # 修改评论
 @login_required
 @permission_required(Permission.MODERATE)
+@query_budget(5)
 def moderate():
-  page = request.args.get('page', 1, type=int)
-  pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-      page=page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(load(Comment.query, 'moderation'),
+                        (Comment.timestamp, Comment.id),
+                        current_app.config['APP_COMMENTS_PER_PAGE'])
   comments = pagination.items
   return render_template('moderate.html', comments=comments,
-                         pagination=pagination, page=page)
+                         pagination=pagination, page=pagination.page,
+                         form=BulkModerationForm())
 
 
 @main.route('/moderate/enable/<int:id>')  # 取消评论
+@use_primary
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate_enable(id):
@@ -124,6 +160,7 @@ def moderate_enable(id):
 
 
 @main.route('/moderate/disable/<int:id>')  # 开启评论
+@use_primary
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate_disable(id):
@@ -134,30 +171,80 @@ def moderate_disable(id):
   return redirect(url_for('.moderate', page=request.args.get('page', 1, type=int)))
 
 
+@main.route('/moderate/bulk', methods=['POST'])  # 批量取消/开启评论
+@login_required
+@permission_required(Permission.MODERATE)
+def moderate_bulk():
+  form = BulkModerationForm()
+  if not form.validate_on_submit():
+    abort(400)
+  action = form.action.data
+  ids = request.form.getlist('ids', type=int)
+  if ids:
+    count = moderation.set_disabled(action == 'disable', ids=ids)
+    flash('%d comments %sd.' % (count, action))
+  return redirect(url_for('.moderate', page=request.args.get('page', 1, type=int)))
+
+
+################################################################################
+# 搜索
+################################################################################
+
+SEARCH_MODELS = {'posts': Post, 'comments': Comment}
+
+
+@main.route('/search')  # 全文搜索帖子, 评论
+@query_budget(5)
+def search():
+  q = request.args.get('q', '').strip()
+  type = request.args.get('type', 'posts')
+  if type not in SEARCH_MODELS:
+    abort(404)
+  if not q:
+    return render_template('search.html', q=q, type=type)
+  model = SEARCH_MODELS[type]
+  query, keys = search_query(model, q)
+  # 按相关性升序, 不计算总数
+  pagination = paginate(load(query, type), keys,
+                        current_app.config['APP_POSTS_PER_PAGE'], desc=False,
+                        key_values=key_values)
+  results = [row[0] for row in pagination.items]
+  if model is Post:
+    post_flags = ViewerFlags(current_user, [post.author for post in results])
+    return render_template('search.html', q=q, type=type, posts=results,
+                           post_flags=post_flags, pagination=pagination)
+  return render_template('search.html', q=q, type=type, comments=results,
+                         pagination=pagination)
+
+
 ################################################################################
 # 用户的profile页面
 ################################################################################
 
 @main.route('/user/<username>')  # 按用户名称查询用户
+@query_budget(5)
 def user(username):
   user = User.query.filter_by(username=username).first_or_404()
-  page = request.args.get('page', 1, type=int)
-  pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-      page=page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-      error_out=False)
+  pagination = paginate(load(user.posts, 'posts'), (Post.timestamp, Post.id),
+                        current_app.config['APP_POSTS_PER_PAGE'],
+                        total=user.post_count)
   posts = pagination.items
-  return render_template('user.html', user=user, posts=posts, pagination=pagination)
+  viewer = ViewerFlags(current_user, [user])
+  return render_template('user.html', user=user, posts=posts,
+                         pagination=pagination, viewer=viewer)
 
 
 @main.route('/edit-profile', methods=['GET', 'POST'])  # profile表单
+@use_primary
 @login_required
 def edit_profile():
   form = EditProfileForm()
   if form.validate_on_submit():
-    current_user.name = form.name.data
-    current_user.location = form.location.data
-    current_user.about_me = form.about_me.data
-    db.session.add(current_user._get_current_object())
+    user = current_user.load()
+    user.name = form.name.data
+    user.location = form.location.data
+    user.about_me = form.about_me.data
+    db.session.add(user)
     db.session.commit()
     flash('Your profile has been update.')
     return redirect(url_for('.user', username=current_user.username))
@@ -168,6 +255,7 @@ def edit_profile():
 
 
 @main.route('/edit-profile/<int:id>', methods=['GET', 'POST'])  # 编辑某个profile
+@use_primary
 @login_required
 @admin_required
 def edit_profile_admin(id):
@@ -177,7 +265,7 @@ def edit_profile_admin(id):
     user.email = form.email.data
     user.username = form.username.data
     user.confirmed = form.confirmed.data
-    user.role = Role.query.get(form.role.data)
+    user.role_id = form.role.data
     user.name = form.name.data
     user.location = form.location.data
     user.about_me = form.about_me.data
@@ -199,12 +287,14 @@ def edit_profile_admin(id):
 # 关注
 ################################################################################
 @main.route('/follow/<username>')  # 关注
+@use_primary
 @login_required
 @permission_required(Permission.FOLLOW)
 def follow(username):
   user = User.query.filter_by(username=username).first()
   if user is None:
     flash('Invalid user.')
+    return redirect(url_for('.index'))
   if current_user.is_following(user):
     flash('You are already following this user.')
     return redirect(url_for('.user', username=username))
@@ -215,6 +305,7 @@ def follow(username):
 
 
 @main.route('/unfollow/<username>')  # 取消关注
+@use_primary
 @login_required
 @permission_required(Permission.FOLLOW)
 def unfollow(username):
@@ -232,33 +323,143 @@ def unfollow(username):
 
 
 @main.route('/followers/<username>')  # 关注xxx的
+@query_budget(5)
 def followers(username):
   user = User.query.filter_by(username=username).first()
   if user is None:
     flash('Invalid user.')
     return redirect(url_for('.index'))
-  page = request.args.get('page', 1, type=int)
-  pagination = user.followers.paginate(
-      page=page, per_page=current_app.config['APP_FOLLOWERS_PERPAGE'], error_out=False)
+  pagination = paginate(user.followers,
+                        (Follow.timestamp, Follow.follower_id),
+                        current_app.config['APP_FOLLOWERS_PERPAGE'],
+                        total=user.follower_count)
   follows = [{'user': item.follower, 'timestamp': item.timestamp}
              for item in pagination.items]
+  # 当前用户是否关注列表中的用户: 一次查询
+  viewer = ViewerFlags(current_user, [follow['user'] for follow in follows])
   return render_template('followers.html', user=user, title='Followers of',
                          endpoint='.followers', pagination=pagination,
-                         follows=follows)
+                         follows=follows, viewer=viewer)
 
 
 @main.route('/followed_by/<username>')  # xxx关注的
+@query_budget(5)
 def followed_by(username):
   user = User.query.filter_by(username=username).first()
   if user is None:
     flash('Invalid user.')
     return redirect(url_for('.index'))
-  page = request.args.get('page', 1, type=int)
-  pagination = user.followed.paginate(
-      page=page, per_page=current_app.config['APP_FOLLOWERS_PERPAGE'],
-      error_out=False)
+  pagination = paginate(user.followed,
+                        (Follow.timestamp, Follow.followed_id),
+                        current_app.config['APP_FOLLOWERS_PERPAGE'],
+                        total=user.followed_count)
   follows = [{'user': item.followed, 'timestamp': item.timestamp}
              for item in pagination.items]
+  # 当前用户是否关注列表中的用户: 一次查询
+  viewer = ViewerFlags(current_user, [follow['user'] for follow in follows])
   return render_template('followers.html', user=user, title="Followed by",
                          endpoint='.followed_by', pagination=pagination,
-                         follows=follows)
+                         follows=follows, viewer=viewer)
+
+
+################################################################################
+# 调试
+################################################################################
+
+QUERY_SORT_KEYS = ('total', 'count', 'p50', 'p99', 'max', 'n_plus_one')
+
+
+@main.route('/debug/queries', methods=['GET', 'DELETE'])  # 查询统计
+@login_required
+@admin_required
+@csrf_required
+def debug_queries():
+  recorder = current_app.extensions['queries']
+  if request.method == 'DELETE':
+    recorder.reset()
+    return jsonify(recorder.summary())
+  sort = request.args.get('sort', 'total')
+  if sort not in QUERY_SORT_KEYS:
+    abort(400)
+  queries = recorder.snapshot(endpoint=request.args.get('endpoint'),
+                              sort=sort,
+                              limit=request.args.get('limit', 50, type=int),
+                              n_plus_one=bool(
+                                  request.args.get('n_plus_one', type=int)))
+  return jsonify({'enabled': recorder.enabled,
+                  'summary': recorder.summary(),
+                  'queries': queries})
+
+
+@main.route('/debug/fragments', methods=['GET', 'DELETE'])  # 片段缓存统计
+@login_required
+@admin_required
+@csrf_required
+def debug_fragments():
+  store = current_app.extensions['fragment_cache']
+  if request.method == 'DELETE':
+    store.clear()
+  return jsonify(store.stats())
+
+
+@main.route('/debug/replica')  # 读写分离统计
+@login_required
+@admin_required
+def debug_replica():
+  return jsonify(current_app.extensions['replica'].stats())
+
+
+@main.route('/debug/identity', methods=['GET', 'DELETE'])  # 当前用户缓存统计
+@login_required
+@admin_required
+@csrf_required
+def debug_identity():
+  cache = identity_cache()
+  if request.method == 'DELETE':
+    cache.invalidate(list(cache.cache.entries))
+  return jsonify(cache.stats())
+
+
+@main.route('/debug/timings', methods=['GET', 'DELETE'])  # 各端点的阶段耗时
+@login_required
+@admin_required
+@csrf_required
+def debug_timings():
+  metrics = current_app.extensions['metrics']
+  if request.method == 'DELETE':
+    metrics.reset()
+  return jsonify(metrics.summary())
+
+
+@main.route('/debug/profile', methods=['GET', 'POST', 'DELETE'])  # 采样分析器
+@login_required
+@admin_required
+@csrf_required
+def debug_profile():
+  profiler = current_app.extensions['profiler']
+  if request.method == 'POST':
+    seconds = min(request.args.get('seconds', profiler.default_seconds,
+                                   type=int), profiler.max_seconds)
+    if not profiler.start(hz=request.args.get('hz', type=int),
+                          seconds=seconds):
+      return jsonify(profiler.stats()), 409  # 已经在运行
+  elif request.method == 'DELETE':
+    profiler.stop()
+  elif request.args.get('format') == 'folded':
+    return current_app.response_class(
+        profiler.folded(request.args.get('endpoint')), mimetype='text/plain')
+  return jsonify(profiler.stats())
+
+
+@main.route('/metrics')  # Prometheus指标, 合并所有worker
+def metrics():
+  token = current_app.config['APP_METRICS_TOKEN']
+  if not token and current_app.config['APP_METRICS_REQUIRE_TOKEN']:
+    abort(403)
+  if token and not hmac.compare_digest(
+          request.headers.get('Authorization', '').encode('utf-8'),
+          ('Bearer ' + token).encode('utf-8')):
+    abort(403)
+  return current_app.response_class(
+      current_app.extensions['metrics'].prometheus(),
+      mimetype='text/plain; version=0.0.4')
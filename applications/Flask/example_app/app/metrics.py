@@ -0,0 +1,509 @@
+# 请求计时和指标
+#
+# 一直开启的低开销计时(APP_METRICS), 每个请求按阶段累计耗时:
+# - db: 执行SQL; template: render_template(包括模板中触发的查询);
+#   markdown: 同步渲染Markdown; auth: 校验密码/令牌
+# - 响应头Server-Timing(APP_SERVER_TIMING), 浏览器开发者工具中可见
+# - 每个端点的总耗时和各阶段耗时的直方图: 对数分桶, 每个2倍区间
+#   SUB个桶(相对误差<19%), 内存与请求数无关
+# - /metrics: Prometheus文本格式. 多个gunicorn worker时每个进程每
+#   APP_METRICS_FLUSH_INTERVAL秒把自己的指标写到APP_METRICS_DIR,
+#   /metrics合并所有进程的文件; APP_METRICS_MAX_AGE秒没有更新的文件
+#   (进程已退出)的请求数和直方图合并到归档文件, 计数器不会变小
+#
+# 另外导出各扩展stats()中的计数(缓存命中, 邮件队列, 副本等), 按进程求和;
+# 比例和分位数不能相加, 不导出.
+
+import atexit
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+  import fcntl
+except ImportError:  # Windows: 不加锁
+  fcntl = None
+
+from flask import before_render_template, g, has_request_context, request, \
+    template_rendered
+
+PHASES = ('db', 'template', 'markdown', 'auth')
+
+# 退出的进程的计数(APP_METRICS_DIR中)
+ARCHIVE = 'metrics-archive.json'
+
+# 导出stats()的扩展: app.extensions中的键 -> 方法
+STATS_EXTENSIONS = {
+    'queries': 'summary',
+    'fragment_cache': 'stats',
+    'api_response_cache': 'stats',
+    'identity_cache': 'stats',
+    'pagination_count': 'stats',
+    'password_hasher': 'stats',
+    'replica': 'stats',
+    'last_seen': 'stats',
+    'mail_queue': 'stats',
+}
+
+
+class Histogram:
+  """对数分桶的直方图(秒)
+
+  桶i的上界为MIN * 2 ** ((i + 1) / SUB), 最后一个桶记录更大的值.
+  """
+  SUB = 4
+  MIN = 50e-6
+  BUCKETS = 22 * SUB  # 上界到MIN * 2 ** 22, 约210秒
+
+  def __init__(self):
+    self.counts = {}  # 稀疏: 桶 -> 次数
+    self.count = 0
+    self.sum = 0.0
+
+  @classmethod
+  def index(cls, value):
+    if value <= cls.MIN:
+      return 0
+    i = math.ceil(math.log2(value / cls.MIN) * cls.SUB) - 1
+    return min(max(i, 0), cls.BUCKETS)
+
+  @classmethod
+  def upper(cls, i):
+    return cls.MIN * 2 ** ((i + 1) / cls.SUB) if i < cls.BUCKETS \
+        else math.inf
+
+  def add(self, value):
+    i = self.index(value)
+    self.counts[i] = self.counts.get(i, 0) + 1
+    self.count += 1
+    self.sum += value
+
+  def merge(self, other):
+    for i, n in other.counts.items():
+      self.counts[i] = self.counts.get(i, 0) + n
+    self.count += other.count
+    self.sum += other.sum
+
+  def percentile(self, p):
+    """桶的上界, 没有数据时为None"""
+    if not self.count:
+      return None
+    rank = max(1, math.ceil(self.count * p))
+    seen = 0
+    for i in sorted(self.counts):
+      seen += self.counts[i]
+      if seen >= rank:
+        return self.upper(i)
+    return None
+
+  def cumulative(self, every=SUB):
+    """Prometheus的桶: [(上界, 累计次数)], 每every个桶一个上界"""
+    buckets = []
+    seen = 0
+    counts = self.counts
+    for i in range(self.BUCKETS):
+      seen += counts.get(i, 0)
+      if (i + 1) % every == 0:
+        buckets.append((self.upper(i), seen))
+    return buckets
+
+  def to_dict(self):
+    return {'counts': self.counts, 'count': self.count, 'sum': self.sum}
+
+  @classmethod
+  def from_dict(cls, data):
+    h = cls()
+    h.counts = {int(i): n for i, n in data['counts'].items()}
+    h.count = data['count']
+    h.sum = data['sum']
+    return h
+
+
+################################################################################
+# 请求内计时
+################################################################################
+
+class RequestTimer:
+  """一个请求的各阶段耗时: g._timer"""
+
+  __slots__ = ('start', 'phases', 'counts', 'active', 'rendering',
+               'render_start', 'recorded')
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.phases = {}
+    self.counts = {}
+    self.active = set()
+    # 嵌套的render_template(如渲染邮件)只计外层
+    self.rendering = 0
+    self.render_start = None
+    self.recorded = False
+
+  def add(self, phase, duration):
+    self.phases[phase] = self.phases.get(phase, 0.0) + duration
+    self.counts[phase] = self.counts.get(phase, 0) + 1
+
+
+def _timer():
+  if not has_request_context():
+    return None
+  return g.get('_timer')
+
+
+class timed:
+  """with timed('markdown'): 把耗时计入当前请求的阶段; 同一阶段嵌套时只计外层"""
+
+  __slots__ = ('phase', 'timer', 'start')
+
+  def __init__(self, phase):
+    self.phase = phase
+
+  def __enter__(self):
+    timer = self.timer = _timer()
+    if timer is None or self.phase in timer.active:
+      self.timer = None
+      return self
+    timer.active.add(self.phase)
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    timer = self.timer
+    if timer is not None:
+      timer.add(self.phase, time.perf_counter() - self.start)
+      timer.active.discard(self.phase)
+    return False
+
+
+def server_timing(timer, total):
+  """Server-Timing头: 毫秒"""
+  parts = []
+  for phase in PHASES:
+    duration = timer.phases.get(phase)
+    if duration is not None:
+      parts.append('%s;dur=%.1f;desc="%d"' % (
+          phase, duration * 1000, timer.counts[phase]))
+  parts.append('total;dur=%.1f' % (total * 1000))
+  return ', '.join(parts)
+
+
+################################################################################
+# 扩展
+################################################################################
+
+class Metrics:
+  """请求计时扩展: app.extensions['metrics']"""
+
+  def __init__(self, app=None):
+    self.lock = threading.Lock()
+    self.histograms = {}
+    self.requests = {}
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    config = app.config
+    self.enabled = config['APP_METRICS']
+    self.server_timing = config['APP_SERVER_TIMING']
+    self.directory = config['APP_METRICS_DIR']
+    self.flush_interval = config['APP_METRICS_FLUSH_INTERVAL']
+    self.max_age = config['APP_METRICS_MAX_AGE']
+    self.app = app
+    self.reset()
+    self.flushed = time.monotonic()
+    app.extensions['metrics'] = self
+    if not self.enabled:
+      return
+    from . import db
+    with app.app_context():
+      for engine in db.engines.values():
+        db.event.listen(engine, 'before_cursor_execute',
+                        self._before_cursor_execute)
+        db.event.listen(engine, 'after_cursor_execute',
+                        self._after_cursor_execute)
+    before_render_template.connect(self._before_render, app)
+    template_rendered.connect(self._after_render, app)
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+    app.teardown_request(self._teardown_request)
+    if self.directory:
+      atexit.register(self.flush)
+
+  def reset(self):
+    with self.lock:
+      self.histograms.clear()
+      self.requests.clear()
+
+  ##############################################################################
+  # 记录
+  ##############################################################################
+
+  def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+    if context is not None:
+      context._timer_start = time.perf_counter()
+
+  def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                            context, executemany):
+    start = getattr(context, '_timer_start', None)
+    if start is None:
+      return
+    timer = _timer()
+    if timer is not None:
+      timer.add('db', time.perf_counter() - start)
+
+  def _before_render(self, sender, template, context, **extra):
+    timer = _timer()
+    if timer is not None:
+      if not timer.rendering:
+        timer.render_start = time.perf_counter()
+      timer.rendering += 1
+
+  def _after_render(self, sender, template, context, **extra):
+    timer = _timer()
+    if timer is not None and timer.rendering:
+      timer.rendering -= 1
+      if not timer.rendering:
+        timer.add('template', time.perf_counter() - timer.render_start)
+
+  def _before_request(self):
+    # 应用上下文可能跨多个请求(测试), 按请求重新开始
+    g._timer = RequestTimer()
+
+  def _after_request(self, response):
+    timer = g.get('_timer')
+    if timer is not None:
+      total = time.perf_counter() - timer.start
+      if self.server_timing:
+        response.headers['Server-Timing'] = server_timing(timer, total)
+      self.record(request.endpoint or '<unknown>', response.status_code,
+                  total, timer.phases)
+      timer.recorded = True
+    return response
+
+  def _teardown_request(self, exc):
+    timer = g.pop('_timer', None)
+    if timer is not None and not timer.recorded:
+      # 未处理的异常: 没有经过after_request
+      self.record(request.endpoint or '<unknown>', 500,
+                  time.perf_counter() - timer.start, timer.phases)
+    if self.directory and \
+            time.monotonic() - self.flushed >= self.flush_interval:
+      self.flush()
+
+  def record(self, endpoint, status, total, phases):
+    with self.lock:
+      key = (endpoint, status)
+      self.requests[key] = self.requests.get(key, 0) + 1
+      for phase, duration in (('total', total),) + tuple(phases.items()):
+        h = self.histograms.get((endpoint, phase))
+        if h is None:
+          h = self.histograms[(endpoint, phase)] = Histogram()
+        h.add(duration)
+
+  ##############################################################################
+  # 多进程
+  ##############################################################################
+
+  def snapshot(self):
+    """本进程的指标(可序列化为JSON)"""
+    with self.lock:
+      histograms = [[endpoint, phase, h.to_dict()]
+                    for (endpoint, phase), h in self.histograms.items()]
+      requests = [[endpoint, status, n]
+                  for (endpoint, status), n in self.requests.items()]
+    return {'pid': os.getpid(), 'histograms': histograms,
+            'requests': requests, 'stats': collect_stats(self.app)}
+
+  def _path(self, pid):
+    return os.path.join(self.directory, 'metrics-%d.json' % pid)
+
+  def _archive(self, path):
+    """把退出的进程的请求数和直方图合并到归档文件, 删除它的文件
+
+    先改名认领文件, 多个进程同时发现时只有一个合并; 归档文件的读-改-写
+    持有文件锁. stats中有当前值(缓存大小等), 不归档.
+    """
+    claimed = path + '.archiving'
+    try:
+      os.rename(path, claimed)
+    except OSError:
+      return
+    try:
+      with open(claimed) as f:
+        snapshot = json.load(f)
+      archive = os.path.join(self.directory, ARCHIVE)
+      with open(archive + '.lock', 'a') as lock:
+        if fcntl is not None:
+          fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshots = [dict(snapshot, stats={})]
+        if os.path.exists(archive):
+          with open(archive) as f:
+            snapshots.append(json.load(f))
+        histograms, requests, _ = merge(snapshots)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+          json.dump({'pid': None,
+                     'histograms': [[endpoint, phase, h.to_dict()]
+                                    for (endpoint, phase), h
+                                    in histograms.items()],
+                     'requests': [[endpoint, status, n]
+                                  for (endpoint, status), n
+                                  in requests.items()],
+                     'stats': {}}, f)
+        os.replace(tmp, archive)
+    except (OSError, ValueError) as e:
+      self.app.logger.error('Archive metrics failed: %s', e)
+    finally:
+      try:
+        os.remove(claimed)
+      except OSError:
+        pass
+
+  def flush(self):
+    """把本进程的指标写到APP_METRICS_DIR"""
+    self.flushed = time.monotonic()
+    if not self.directory:
+      return
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(self.snapshot(), f)
+      os.replace(tmp, self._path(os.getpid()))
+    except (OSError, TypeError, ValueError) as e:
+      self.app.logger.error('Flush metrics failed: %s', e)
+
+  def _snapshots(self):
+    """所有进程的指标: 本进程使用内存中的, 其他进程读文件"""
+    snapshots = [self.snapshot()]
+    if not self.directory or not os.path.isdir(self.directory):
+      return snapshots
+    mine = self._path(os.getpid())
+    now = time.time()
+    # 很久没有更新: 进程已经退出, 先归档再读取
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if name.endswith('.json') and name != ARCHIVE and path != mine:
+        try:
+          if now - os.path.getmtime(path) > self.max_age:
+            self._archive(path)
+        except OSError:
+          continue
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if not name.endswith('.json') or path == mine:
+        continue
+      try:
+        with open(path) as f:
+          snapshots.append(json.load(f))
+      except (OSError, ValueError):
+        continue
+    return snapshots
+
+  def merged(self):
+    """合并所有进程: (直方图, 请求数, stats)"""
+    return merge(self._snapshots())
+
+  ##############################################################################
+  # 输出
+  ##############################################################################
+
+  def summary(self):
+    """每个端点各阶段的次数, 平均值, p50/p90/p99(秒)"""
+    histograms, _, _ = self.merged()
+    endpoints = {}
+    for (endpoint, phase), h in sorted(histograms.items()):
+      endpoints.setdefault(endpoint, {})[phase] = {
+          'count': h.count, 'mean': h.sum / h.count,
+          'p50': h.percentile(0.5), 'p90': h.percentile(0.9),
+          'p99': h.percentile(0.99)}
+    return endpoints
+
+  def prometheus(self):
+    """Prometheus文本格式"""
+    histograms, requests, stats = self.merged()
+    lines = ['# HELP app_requests_total Requests by endpoint and status.',
+             '# TYPE app_requests_total counter']
+    for (endpoint, status), n in sorted(requests.items()):
+      lines.append('app_requests_total{endpoint="%s",status="%d"} %d'
+                   % (label(endpoint), status, n))
+    for name, phase_filter, help in (
+        ('app_request_duration_seconds', lambda p: p == 'total',
+         'Request duration by endpoint.'),
+        ('app_request_phase_seconds', lambda p: p != 'total',
+         'Time spent per phase (db, template, markdown, auth) '
+         'in requests where it occurred.')):
+      lines.append('# HELP %s %s' % (name, help))
+      lines.append('# TYPE %s histogram' % name)
+      for (endpoint, phase), h in sorted(histograms.items()):
+        if not phase_filter(phase):
+          continue
+        labels = 'endpoint="%s"' % label(endpoint)
+        if phase != 'total':
+          labels += ',phase="%s"' % phase
+        for upper, n in h.cumulative():
+          lines.append('%s_bucket{%s,le="%.6g"} %d'
+                       % (name, labels, upper, n))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, h.count))
+        lines.append('%s_sum{%s} %.6f' % (name, labels, h.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, h.count))
+    for name, value in sorted(stats.items()):
+      lines.append('# TYPE %s untyped' % name)
+      lines.append('%s %s' % (name, repr(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def merge(snapshots):
+  """合并进程的指标: (直方图, 请求数, stats)"""
+  histograms = {}
+  requests = {}
+  stats = {}
+  for snapshot in snapshots:
+    for endpoint, phase, data in snapshot['histograms']:
+      h = Histogram.from_dict(data)
+      merged = histograms.get((endpoint, phase))
+      if merged is None:
+        merged = histograms[(endpoint, phase)] = Histogram()
+      merged.merge(h)
+    for endpoint, status, n in snapshot['requests']:
+      key = (endpoint, int(status))
+      requests[key] = requests.get(key, 0) + n
+    for name, value in snapshot['stats'].items():
+      stats[name] = stats.get(name, 0) + value
+  return histograms, requests, stats
+
+
+def label(value):
+  return str(value).replace('\\', r'\\').replace('"', r'\"') \
+      .replace('\n', r'\n')
+
+
+_NAME = re.compile(r'[^a-zA-Z0-9_]')
+_NOT_ADDITIVE = re.compile(r'(hit_rate|p\d+|lag)$')
+
+
+def collect_stats(app):
+  """扩展的stats()中的数值, 展开为app_<扩展>_<键>"""
+  values = {}
+
+  def add(prefix, value):
+    if isinstance(value, dict):
+      for key, item in value.items():
+        add('%s_%s' % (prefix, _NAME.sub('_', str(key))), item)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool) \
+            and not _NOT_ADDITIVE.search(prefix):
+      values[prefix] = value
+
+  for key, method in STATS_EXTENSIONS.items():
+    extension = app.extensions.get(key)
+    if extension is not None and hasattr(extension, method):
+      try:
+        add('app_' + key, getattr(extension, method)())
+      except Exception as e:
+        app.logger.warning('Collect %s stats failed: %s', key, e)
+  return values
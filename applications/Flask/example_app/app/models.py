@@ -1,14 +1,14 @@
 # 数据模型
 
-import bleach
-from markdown import markdown
 from app import db
 
-from werkzeug.security import generate_password_hash, check_password_hash
-
 from flask_login import UserMixin, AnonymousUserMixin
 
-from . import login_manager, exceptions
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import login_manager, exceptions, follows, fragments, hashing, \
+    identity, rendering, replicas, roles
+from .last_seen import last_seen_buffer
 
 # deprecated: https://itsdangerous.palletsprojects.com/en/stable/changes/
 # from itsdangerous import TimedJSONWebSignatureSerializer as Serializer # JWT
@@ -19,14 +19,37 @@ from datetime import datetime, timezone
 import hashlib
 
 
+################################################################################
+# 序列化
+################################################################################
+
+class UrlTemplates:
+  """批量序列化时每个端点只调用一次url_for, 之后按id替换"""
+  SENTINEL = 2147483647
+
+  def __init__(self):
+    self.templates = {}
+
+  def __call__(self, endpoint, id):
+    template = self.templates.get(endpoint)
+    if template is None:
+      template = url_for(endpoint, id=self.SENTINEL).replace(
+          str(self.SENTINEL), '{}')
+      self.templates[endpoint] = template
+    return template.format(id)
+
+
 ################################################################################
 # 用户, 角色, 权限
 ################################################################################
 
 @login_manager.user_loader
 def load_user(user_id):
-  """登录管理器的加载用户函数"""
-  return User.query.get(int(user_id))
+  """登录管理器的加载用户函数: 缓存的快照, 不查询数据库"""
+  snapshot = identity.identity_cache().get(int(user_id))
+  if snapshot is None:
+    return None
+  return CurrentUser(snapshot)
 
 #######
 # 关注
@@ -39,9 +62,9 @@ class Follow(db.Model):
   # 关注人
   follower_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                           primary_key=True)
-  # 被关注人
+  # 被关注人: 单独索引, 扇出写时按被关注人查找关注者
   followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),
-                          primary_key=True)
+                          primary_key=True, index=True)
   # 关注时间
   timestamp = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
@@ -70,6 +93,15 @@ class User(UserMixin, db.Model):
   # 头像
   avatar_hash = db.Column(db.String(32))
 
+  # 关注者过多时不扇出写, 关注者读时间线时直接查询其帖子
+  fanout_on_read = db.Column(db.Boolean, default=False, nullable=False)
+
+  # 计数器: 由Post, Follow的插入/删除事件维护, flask recount重建
+  post_count = db.Column(db.Integer, default=0, nullable=False)
+  # 关注者数, 关注数(都包括自己)
+  follower_count = db.Column(db.Integer, default=0, nullable=False)
+  followed_count = db.Column(db.Integer, default=0, nullable=False)
+
   # 角色外键
   role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
 
@@ -101,15 +133,29 @@ class User(UserMixin, db.Model):
 
   def __init__(self, **kwargs):
     super(User, self).__init__(**kwargs)
-    if self.role is None:
+    if self.role is None and self.role_id is None:
+      # 使用角色缓存, 不查询roles表
+      cache = roles.role_cache()
       if self.email == current_app.config['APP_ADMIN']:
-        self.role = Role.query.filter_by(name='Administrator').first()
-      if self.role is None:
-        self.role = Role.query.filter_by(default=True).first()
+        self.role_id = cache.id_for('Administrator')
+      if self.role_id is None:
+        self.role_id = cache.default_id()
 
     # 自己关注自己
     self.follow(self)
 
+  @staticmethod
+  def recount():
+    """按实际数据重建用户的计数器"""
+    db.session.execute(db.update(User).values(
+        post_count=db.select(db.func.count()).select_from(Post)
+        .where(Post.author_id == User.id).scalar_subquery(),
+        follower_count=db.select(db.func.count()).select_from(Follow)
+        .where(Follow.followed_id == User.id).scalar_subquery(),
+        followed_count=db.select(db.func.count()).select_from(Follow)
+        .where(Follow.follower_id == User.id).scalar_subquery()))
+    db.session.commit()
+
   @staticmethod
   def add_self_follows():
     for user in User.query.all():
@@ -125,11 +171,20 @@ class User(UserMixin, db.Model):
   @password.setter
   def password(self, password):
     """密码: 只写属性"""
-    self.password_hash = generate_password_hash(password)
+    self.password_hash = hashing.password_hasher().hash(password)
 
   def verify_password(self, password):
-    """验证密码"""
-    return check_password_hash(self.password_hash, password)
+    """验证密码; 成功且哈希的成本不是APP_PASSWORD_METHOD时重新哈希
+    (由调用者提交; 名额已满时跳过, 下次登录再升级)"""
+    hasher = hashing.password_hasher()
+    if not hasher.verify(self.password_hash, password):
+      return False
+    if hasher.needs_rehash(self.password_hash):
+      try:
+        self.password = password
+      except exceptions.PasswordHashingBusy:
+        pass
+    return True
 
   def generate_confirmation_token(self, expiration=3600):
     """生成确认令牌"""
@@ -154,16 +209,30 @@ class User(UserMixin, db.Model):
     db.session.add(self)
 
   def can(self, perm):
-    return self.role is not None and self.role.has_permission(perm)
+    """权限检查: 按role_id从角色缓存取权限位, 不加载self.role"""
+    role_id = self.role_id
+    if role_id is None:
+      # 还未flush的新用户: 使用已设置的角色对象
+      role = self.__dict__.get('role')
+      if role is None:
+        return False
+      if role.id is None:
+        return role.has_permission(perm)
+      role_id = role.id
+    return roles.role_cache().permissions(role_id) & perm == perm
 
   def is_administrator(self):
     return self.can(Permission.ADMIN)
 
   def ping(self):
-    """refresh user's last visit time"""
-    self.last_seen = datetime.now(timezone.utc)
-    db.session.add(self)
-    db.session.commit()
+    """refresh user's last visit time
+
+    延迟批量写入, 见last_seen.LastSeenBuffer
+    """
+    now = datetime.now(timezone.utc)
+    # 只修改内存中的值, 不标记为已修改
+    set_committed_value(self, 'last_seen', now)
+    last_seen_buffer().touch(self.id, now)
 
   def change_email(self, token):
     s = Serializer(current_app.config['SECRET_KEY'])
@@ -199,53 +268,84 @@ class User(UserMixin, db.Model):
 
   def is_following(self, user):
     """是否关注别人"""
-    if user.id is None:
-      return False
-    # 我关注的关系中: 被关注者是别人
-    return self.followed.filter_by(followed_id=user.id).first() is not None
+    return follows.is_following(self, user)
 
   def is_followed_by(self, user):
     """是否被别人关注"""
-    if user.id is None:
-      return False
-    # 关注我的关注关系中: 关注者是别人
-    return self.followers.filter_by(follower_id=user.id).fist() is not None
+    return follows.is_following(user, self)
 
   def follow(self, user):
     """关注别人"""
-    if not self.is_following(user):
-      f = Follow(follower=self, followed=user)
-      db.session.add(f)
+    follows.follow(self, user)
+
+  def unfollow(self, user):
+    """取消关注"""
+    follows.unfollow(self, user)
+
+  @property
+  def followed_posts(self):
+    """关注的人的帖子: 物化的时间线 + 读时扇出的大V帖子"""
+    return TimelineEntry.posts_for(self)[0]
+
+  @property
+  def timeline(self):
+    """(关注的人的帖子查询, 分页的键), 见TimelineEntry.posts_for"""
+    return TimelineEntry.posts_for(self)
 
   def generate_auth_token(self, expiration):
+    """生成API令牌, expiration秒后过期"""
     s = Serializer(current_app.config['SECRET_KEY'])
-    return s.dumps({'id': self.id})  # .decode('utf-8')
+    return s.dumps({'id': self.id, 'exp': expiration})  # .decode('utf-8')
 
   @staticmethod
-  def verify_auth_token(token):
+  def load_auth_token(token):
+    """校验令牌签名和有效期: 返回(用户id, 剩余秒数), 无效返回None"""
     s = Serializer(current_app.config['SECRET_KEY'])
+    max_age = current_app.config['APP_AUTH_TOKEN_MAX_AGE']
     try:
-      data = s.loads(token)
-    except:
+      data, issued = s.loads(token, max_age=max_age, return_timestamp=True)
+    except Exception:
+      return None
+    age = (datetime.now(timezone.utc) - issued).total_seconds()
+    remaining = min(data.get('exp', max_age), max_age) - age
+    if remaining <= 0:
+      return None
+    return data['id'], remaining
+
+  @staticmethod
+  def verify_auth_token(token):
+    loaded = User.load_auth_token(token)
+    if loaded is None:
       return None
-    return User.query.get(data['id'])
+    return db.session.get(User, loaded[0])
 
   def __repr__(self):
     return '<User %r>' % self.username
 
-  def to_json(self):
+  def etag_parts(self):
+    """决定JSON表示的值"""
+    return (self.id, self.username, self.member_since, self.last_seen,
+            self.post_count)
+
+  def to_json(self, url=url_for):
     json_user = {
-        'url': url_for('api.get_user', id=self.id),
+        'url': url('api.get_user', id=self.id),
         'username': self.username,
         'member_since': self.member_since,
         'last_seen': self.last_seen,
-        'posts_url': url_for('api.get_user_posts', id=self.id),
-        # 'followed_posts_url': url_for('api.get_user_followed_posts',
-        #                               id=self.id),
-        'post_count': self.posts.count()
+        'posts_url': url('api.get_user_posts', id=self.id),
+        'followed_posts_url': url('api.get_user_followed_posts',
+                                  id=self.id),
+        'post_count': self.post_count
     }
     return json_user
 
+  @staticmethod
+  def to_json_list(users):
+    """批量序列化"""
+    url = UrlTemplates()
+    return [u.to_json(url=url) for u in users]
+
 
 class AnonymousUser(AnonymousUserMixin):
   """匿名用户"""
@@ -261,6 +361,90 @@ class AnonymousUser(AnonymousUserMixin):
 login_manager.anonymous_user = AnonymousUser
 
 
+class UserSnapshot:
+  """已认证用户的只读快照: 不属于任何会话, 可以在请求间缓存"""
+  is_authenticated = True
+  is_active = True
+  is_anonymous = False
+
+  def __init__(self, id, username, email, confirmed, role_id,
+               avatar_hash=None):
+    self.id = id
+    self.username = username
+    self.email = email
+    self.confirmed = confirmed
+    self.role_id = role_id
+    self.avatar_hash = avatar_hash
+
+  @staticmethod
+  def from_user(user):
+    return UserSnapshot(user.id, user.username, user.email, user.confirmed,
+                        user.role_id, user.avatar_hash)
+
+  def get_id(self):
+    return str(self.id)
+
+  def can(self, perm):
+    return roles.role_cache().permissions(self.role_id) & perm == perm
+
+  def is_administrator(self):
+    return self.can(Permission.ADMIN)
+
+  def generate_auth_token(self, expiration):
+    return User.generate_auth_token(self, expiration)
+
+  def __eq__(self, other):
+    if isinstance(other, (User, UserSnapshot)):
+      return self.id == other.id
+    return NotImplemented
+
+  def __hash__(self):
+    return hash((User, self.id))
+
+  def __repr__(self):
+    return '<UserSnapshot %r>' % self.username
+
+
+class CurrentUser(UserSnapshot):
+  """current_user: 缓存的快照的副本(每个请求一个)
+
+  模板和权限检查只读快照; 快照没有的属性和方法(资料, 确认, 关注等)
+  按主键加载User, 每个请求最多一次. 修改用户使用load()返回的User.
+  """
+
+  def __init__(self, snapshot):
+    super().__init__(snapshot.id, snapshot.username, snapshot.email,
+                     snapshot.confirmed, snapshot.role_id,
+                     snapshot.avatar_hash)
+    self._user = None
+
+  def load(self):
+    """会话中的User"""
+    if self._user is None:
+      self._user = db.session.get(User, self.id)
+    return self._user
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self.load(), name)
+
+  gravatar_hash = User.gravatar_hash
+  gravatar = User.gravatar
+  is_following = User.is_following
+  is_followed_by = User.is_followed_by
+  unfollow = User.unfollow
+  followed_posts = User.followed_posts
+  timeline = User.timeline
+
+  def ping(self):
+    """同User.ping, 只记录访问时间"""
+    last_seen_buffer().touch(self.id, datetime.now(timezone.utc))
+
+  def __repr__(self):
+    return '<CurrentUser %r>' % self.username
+
+
 class Role(db.Model):
   __tablename__ = 'roles'
   id = db.Column(db.Integer, primary_key=True)
@@ -317,6 +501,20 @@ class Role(db.Model):
     return '<Role %r>' % self.name
 
 
+# 角色修改后使角色缓存失效
+db.event.listen(Role, 'after_insert', roles.on_role_changed)
+db.event.listen(Role, 'after_update', roles.on_role_changed)
+db.event.listen(Role, 'after_delete', roles.on_role_changed)
+db.event.listen(db.session, 'after_commit', roles.on_after_commit)
+db.event.listen(db.session, 'after_rollback', roles.on_after_rollback)
+
+# 当前用户的缓存: 用户修改提交后失效
+db.event.listen(User, 'after_update', identity.on_user_changed)
+db.event.listen(User, 'after_delete', identity.on_user_changed)
+db.event.listen(db.session, 'after_commit', identity.on_after_commit)
+db.event.listen(db.session, 'after_rollback', identity.on_after_rollback)
+
+
 class Permission:
   FOLLOW = 1
   COMMENT = 2
@@ -340,30 +538,60 @@ class Post(db.Model):
   # 作者外键
   author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
+  # 用户页, 大V的时间线: 按作者取最近的帖子
+  __table_args__ = (
+      db.Index('ix_posts_author_timestamp', 'author_id', 'timestamp'),
+  )
+
+  # 计数器: 由Comment的插入/删除事件维护, flask recount重建
+  comment_count = db.Column(db.Integer, default=0, nullable=False)
+
+  # 行版本: 每次修改加1, 用于API的ETag
+  version = db.Column(db.Integer, default=1, nullable=False)
+
   # 评论关联
   comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
+  # body_html允许的标签
+  ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                  'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                  'h1', 'h2', 'h3', 'p']
+
   @staticmethod
   def on_changed_body(target, value, oldvalue, initiator):
-    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                    'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                    'h1', 'h2', 'h3', 'p']
-    target.body_html = bleach.linkify(bleach.clean(
-        markdown(value, output_format='html'),
-        tags=allowed_tags, strip=True))
-
-  def to_json(self):
+    rendering.set_body_html(target, value, Post.ALLOWED_TAGS)
+    fragments.invalidate('post', target.id)
+
+  def etag_parts(self):
+    """决定JSON表示的值"""
+    return (self.id, self.version, self.comment_count)
+
+  def to_json(self, url=url_for):
     json_post = {
-        'url': url_for('api.get_post', id=self.id),
+        'url': url('api.get_post', id=self.id),
         'body': self.body,
         'body_html': self.body_html,
         'timestamp': self.timestamp,
-        'author_url': url_for('api.get_user', id=self.author_id),
-        'comments_url': url_for('api.get_post_comments', id=self.id),
-        'comment_count': self.comments.count()
+        'author_url': url('api.get_user', id=self.author_id),
+        'comments_url': url('api.get_post_comments', id=self.id),
+        'comment_count': self.comment_count
     }
     return json_post
 
+  @staticmethod
+  def to_json_list(posts):
+    """批量序列化"""
+    url = UrlTemplates()
+    return [p.to_json(url=url) for p in posts]
+
+  @staticmethod
+  def recount():
+    """按实际数据重建帖子的计数器"""
+    db.session.execute(db.update(Post).values(
+        comment_count=db.select(db.func.count()).select_from(Comment)
+        .where(Comment.post_id == Post.id).scalar_subquery()))
+    db.session.commit()
+
   @staticmethod
   def from_json(json_post):
     body = json_post.get('body')
@@ -389,25 +617,39 @@ class Comment(db.Model):
   author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
   post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
 
+  # 行版本: 每次修改加1, 用于API的ETag
+  version = db.Column(db.Integer, default=1, nullable=False)
+
+  # body_html允许的标签
+  ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
+                  'strong']
+
   @staticmethod
   def on_change_body(target, value, oldvalue, initiator):
-    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                    'strong']
-    target.body_html = bleach.linkify(bleach.clean(
-        markdown(value, output_format='html'),
-        tags=allowed_tags, strip=True))
+    rendering.set_body_html(target, value, Comment.ALLOWED_TAGS)
+    fragments.invalidate('comment', target.id)
 
-  def to_json(self):
+  def etag_parts(self):
+    """决定JSON表示的值"""
+    return (self.id, self.version)
+
+  def to_json(self, url=url_for):
     json_comment = {
-        'url': url_for('api.get_comment', id=self.id),
-        'post_url': url_for('api.get_post', id=self.post_id),
+        'url': url('api.get_comment', id=self.id),
+        'post_url': url('api.get_post', id=self.post_id),
         'body': self.body,
         'body_html': self.body_html,
         'timestamp': self.timestamp,
-        'author_url': url_for('api.get_user', id=self.author_id),
+        'author_url': url('api.get_user', id=self.author_id),
     }
     return json_comment
 
+  @staticmethod
+  def to_json_list(comments):
+    """批量序列化"""
+    url = UrlTemplates()
+    return [c.to_json(url=url) for c in comments]
+
   @staticmethod
   def from_json(json_comment):
     body = json_comment.get('body')
@@ -417,3 +659,255 @@ class Comment(db.Model):
 
 
 db.event.listen(Comment.body, 'set', Comment.on_change_body)
+
+
+def bump_version(mapper, connection, target):
+  """有列修改时增加行版本"""
+  if db.inspect(target).session.is_modified(
+      target, include_collections=False):
+    target.version = (target.version or 0) + 1
+
+
+db.event.listen(Post, 'before_update', bump_version)
+db.event.listen(Comment, 'before_update', bump_version)
+
+# 异步渲染: 提交后把待渲染的行交给进程池
+db.event.listen(db.session, 'after_flush', rendering.on_after_flush)
+db.event.listen(db.session, 'after_commit', rendering.on_after_commit)
+db.event.listen(db.session, 'after_rollback', rendering.on_after_rollback)
+
+# 读写分离: 写入后本请求和该用户之后的请求读主库
+db.event.listen(db.session, 'after_flush', replicas.on_after_flush)
+db.event.listen(db.session, 'after_commit', replicas.on_after_commit)
+
+
+################################################################################
+# 计数器
+################################################################################
+
+def _increment(connection, table, column, id, delta):
+  """在当前事务中原子地增减计数器"""
+  if id is None:
+    return
+  connection.execute(table.update().where(table.c.id == id)
+                     .values({column: table.c[column] + delta}))
+
+
+def on_post_inserted(mapper, connection, target):
+  _increment(connection, User.__table__, 'post_count', target.author_id, 1)
+
+
+def on_post_deleted(mapper, connection, target):
+  _increment(connection, User.__table__, 'post_count', target.author_id, -1)
+
+
+def on_comment_inserted(mapper, connection, target):
+  _increment(connection, Post.__table__, 'comment_count', target.post_id, 1)
+
+
+def on_comment_deleted(mapper, connection, target):
+  _increment(connection, Post.__table__, 'comment_count', target.post_id, -1)
+
+
+def on_follow_inserted(mapper, connection, target):
+  _increment(connection, User.__table__, 'follower_count',
+             target.followed_id, 1)
+  _increment(connection, User.__table__, 'followed_count',
+             target.follower_id, 1)
+
+
+def on_follow_deleted(mapper, connection, target):
+  _increment(connection, User.__table__, 'follower_count',
+             target.followed_id, -1)
+  _increment(connection, User.__table__, 'followed_count',
+             target.follower_id, -1)
+
+
+db.event.listen(Post, 'after_insert', on_post_inserted)
+db.event.listen(Post, 'after_delete', on_post_deleted)
+db.event.listen(Comment, 'after_insert', on_comment_inserted)
+db.event.listen(Comment, 'after_delete', on_comment_deleted)
+db.event.listen(Follow, 'after_insert', on_follow_inserted)
+db.event.listen(Follow, 'after_delete', on_follow_deleted)
+
+# 请求内的关注关系备忘
+db.event.listen(Follow, 'after_insert', follows.on_follow_inserted)
+db.event.listen(Follow, 'after_delete', follows.on_follow_deleted)
+db.event.listen(db.session, 'after_rollback', follows.on_after_rollback)
+
+
+################################################################################
+# 时间线
+################################################################################
+
+
+class TimelineEntry(db.Model):
+  """物化的时间线: 发帖时扇出写到每个关注者
+
+  关注者超过APP_TIMELINE_FANOUT_LIMIT的作者标记为fanout_on_read,
+  其帖子不再扇出, 读时间线时按关注关系直接查询.
+  """
+  __tablename__ = 'timeline_entries'
+  # 时间线所有者
+  owner_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                       primary_key=True)
+  post_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
+                      primary_key=True)
+  # 冗余帖子作者和时间, 重建和排序不需要联接posts
+  author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+  timestamp = db.Column(db.DateTime)
+
+  __table_args__ = (
+      db.Index('ix_timeline_entries_owner_timestamp', 'owner_id', 'timestamp'),
+  )
+
+  @staticmethod
+  def feed(user):
+    """时间线的(id, timestamp)子查询: 物化的条目 UNION ALL 大V的帖子
+
+    按timestamp排序时两部分分别使用(owner_id, timestamp)和
+    (author_id, timestamp)索引合并, 分页只读取需要的行.
+    """
+    heavy_authors = db.select(Follow.followed_id) \
+        .join(User, User.id == Follow.followed_id) \
+        .where(Follow.follower_id == user.id,
+               User.fanout_on_read.is_(True))
+    # 刚切换为读时扇出的作者以前扇出的条目不再使用, 避免重复
+    entries = db.select(TimelineEntry.post_id.label('id'),
+                        TimelineEntry.timestamp) \
+        .where(TimelineEntry.owner_id == user.id,
+               TimelineEntry.author_id.not_in(heavy_authors))
+    heavy = db.select(Post.id, Post.timestamp) \
+        .where(Post.author_id.in_(heavy_authors))
+    return db.union_all(entries, heavy).subquery('feed')
+
+  @staticmethod
+  def posts_for(user):
+    """用户的时间线: (帖子查询, 分页的键)
+
+    分页/排序必须使用返回的键(子查询的列), 按Post.timestamp排序时
+    数据库会按时间遍历整个posts表.
+    """
+    feed = TimelineEntry.feed(user)
+    query = Post.query.join(feed, feed.c.id == Post.id)
+    return query, (feed.c.timestamp, feed.c.id)
+
+  @staticmethod
+  def on_post_inserted(mapper, connection, target):
+    """新帖子扇出写到作者的关注者(包括作者自己)的时间线"""
+    if target.author_id is None:
+      return
+    follows = Follow.__table__
+    users = User.__table__
+    follower_count = connection.scalar(
+        db.select(users.c.follower_count)
+        .where(users.c.id == target.author_id))
+    if follower_count > current_app.config['APP_TIMELINE_FANOUT_LIMIT']:
+      connection.execute(
+          users.update()
+          .where(users.c.id == target.author_id,
+                 users.c.fanout_on_read.is_(False))
+          .values(fanout_on_read=True))
+      return
+    posts = Post.__table__
+    select = db.select(follows.c.follower_id, posts.c.id,
+                       posts.c.author_id, posts.c.timestamp) \
+        .join(posts, posts.c.author_id == follows.c.followed_id) \
+        .where(posts.c.id == target.id)
+    connection.execute(TimelineEntry.__table__.insert().from_select(
+        ['owner_id', 'post_id', 'author_id', 'timestamp'], select))
+
+  @staticmethod
+  def on_follow_inserted(mapper, connection, target):
+    """新关注: 把被关注人最近的帖子补到关注者的时间线"""
+    TimelineEntry._fill(connection, target.follower_id,
+                        author_id=target.followed_id)
+
+  @staticmethod
+  def on_follow_deleted(mapper, connection, target):
+    """取消关注: 从关注者的时间线移除被关注人的帖子"""
+    entries = TimelineEntry.__table__
+    connection.execute(entries.delete().where(
+        entries.c.owner_id == target.follower_id,
+        entries.c.author_id == target.followed_id))
+
+  @staticmethod
+  def _fill(connection, owner_id, author_id=None):
+    """按关注关系把最近APP_TIMELINE_LENGTH条帖子写入owner的时间线"""
+    follows = Follow.__table__
+    posts = Post.__table__
+    users = User.__table__
+    entries = TimelineEntry.__table__
+    select = db.select(follows.c.follower_id, posts.c.id,
+                       posts.c.author_id, posts.c.timestamp) \
+        .join(posts, posts.c.author_id == follows.c.followed_id) \
+        .join(users, users.c.id == follows.c.followed_id) \
+        .where(follows.c.follower_id == owner_id,
+               users.c.fanout_on_read.is_(False))
+    if author_id is not None:
+      select = select.where(follows.c.followed_id == author_id)
+    # 已存在的条目跳过
+    select = select.where(~db.exists().where(
+        entries.c.owner_id == owner_id, entries.c.post_id == posts.c.id))
+    select = select.order_by(posts.c.timestamp.desc()) \
+        .limit(current_app.config['APP_TIMELINE_LENGTH'])
+    connection.execute(entries.insert().from_select(
+        ['owner_id', 'post_id', 'author_id', 'timestamp'], select))
+
+  @staticmethod
+  def rebuild(user_ids=None):
+    """重建时间线: 删除后按关注关系重新填充, 返回处理的用户数
+
+    重建全部时先按实际关注者数重新计算fanout_on_read(批量导入不触发事件).
+    """
+    if user_ids is None:
+      TimelineEntry._update_fanout()
+      user_ids = db.session.scalars(db.select(User.id)).all()
+    connection = db.session.connection()
+    entries = TimelineEntry.__table__
+    for user_id in user_ids:
+      connection.execute(entries.delete().where(entries.c.owner_id == user_id))
+      TimelineEntry._fill(connection, user_id)
+    db.session.commit()
+    return len(user_ids)
+
+  @staticmethod
+  def repair():
+    """按实际关注者数重新计算fanout_on_read, 重建受影响关注者的时间线
+
+    返回(切换了扇出方式的作者数, 重建的时间线数)
+    """
+    changed = TimelineEntry._update_fanout()
+    db.session.commit()
+    if not changed:
+      return 0, 0
+    owners = db.session.scalars(
+        db.select(Follow.follower_id).distinct()
+        .where(Follow.followed_id.in_(changed))).all()
+    return len(changed), TimelineEntry.rebuild(owners)
+
+  @staticmethod
+  def _update_fanout():
+    """按实际关注者数设置fanout_on_read(不提交), 返回改变了的用户id"""
+    limit = current_app.config['APP_TIMELINE_FANOUT_LIMIT']
+    users = User.__table__
+    heavy = db.select(Follow.followed_id).group_by(Follow.followed_id) \
+        .having(db.func.count() > limit)
+    to_heavy = db.and_(users.c.fanout_on_read.is_(False),
+                       users.c.id.in_(heavy))
+    to_light = db.and_(users.c.fanout_on_read.is_(True),
+                       users.c.id.not_in(heavy))
+    changed = db.session.scalars(
+        db.select(users.c.id).where(db.or_(to_heavy, to_light))).all()
+    if changed:
+      db.session.execute(users.update().where(to_heavy)
+                         .values(fanout_on_read=True))
+      db.session.execute(users.update().where(to_light)
+                         .values(fanout_on_read=False))
+    return changed
+
+
+# 新帖子, 新关注时维护时间线
+db.event.listen(Post, 'after_insert', TimelineEntry.on_post_inserted)
+db.event.listen(Follow, 'after_insert', TimelineEntry.on_follow_inserted)
+db.event.listen(Follow, 'after_delete', TimelineEntry.on_follow_deleted)
@@ -0,0 +1,126 @@
+# 批量审核评论
+#
+# 按id列表或条件(作者, 帖子, 时间范围)取消/恢复评论:
+# - 每批一次SELECT找出需要修改的行, 一次UPDATE ... WHERE id IN,
+#   每批提交, 写锁只持有一批的时间
+# - 批量UPDATE不触发模型事件: 这里增加行版本, 删除评论片段,
+#   使API响应缓存失效, 标记本请求已写入(读写分离)
+
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from . import db, fragments
+from .api.caching import mark_changed
+from .exceptions import ValidationError
+from .models import Comment, User
+from .replicas import mark_written
+
+
+def parse_time(value, name):
+  """ISO 8601时间, 有时区的转换为UTC(数据库中保存的是无时区的UTC)"""
+  if value is None or value == '':
+    return None
+  try:
+    t = datetime.fromisoformat(value)
+  except (TypeError, ValueError):
+    raise ValidationError('invalid %s: %r' % (name, value))
+  if t.tzinfo is not None:
+    t = t.astimezone(timezone.utc).replace(tzinfo=None)
+  return t
+
+
+def filters(author_id=None, post_id=None, since=None, until=None):
+  """条件列表; until不包括"""
+  conditions = []
+  if author_id is not None:
+    conditions.append(Comment.author_id == author_id)
+  if post_id is not None:
+    conditions.append(Comment.post_id == post_id)
+  if since is not None:
+    conditions.append(Comment.timestamp >= since)
+  if until is not None:
+    conditions.append(Comment.timestamp < until)
+  return conditions
+
+
+def _update_batch(conditions, disabled, batch_size, after_id=None):
+  """修改一批, 返回(找到的最大id, 修改的行数); 没有需要修改的行时id为None"""
+  changed = db.func.coalesce(Comment.disabled, False) != disabled
+  query = db.select(Comment.id, Comment.post_id).where(changed, *conditions)
+  if after_id is not None:
+    query = query.where(Comment.id > after_id)
+  rows = db.session.execute(
+      query.order_by(Comment.id).limit(batch_size)).all()
+  if not rows:
+    return None, 0
+  ids = [id for id, _ in rows]
+  table = Comment.__table__
+  result = db.session.execute(
+      table.update().where(table.c.id.in_(ids), changed)
+      .values(disabled=disabled, version=table.c.version + 1))
+  mark_changed([('comment', id) for id in ids] +
+               [('post', post_id) for post_id in {p for _, p in rows}])
+  mark_written()
+  db.session.commit()
+  for id in ids:
+    fragments.invalidate('comment', id)
+  return ids[-1], result.rowcount
+
+
+def set_disabled(disabled, ids=None, author_id=None, post_id=None,
+                 since=None, until=None, batch_size=None):
+  """取消(disabled=True)或恢复评论, 返回修改的行数
+
+  ids和条件同时给出时取交集; 都没有时抛出ValidationError, 不修改所有评论.
+  """
+  conditions = filters(author_id, post_id, since, until)
+  if ids is None and not conditions:
+    raise ValidationError('no comment ids or filters given')
+  batch_size = batch_size or current_app.config['APP_MODERATION_BATCH_SIZE']
+  count = 0
+  if ids is not None:
+    ids = sorted(set(ids))
+    for i in range(0, len(ids), batch_size):
+      _, n = _update_batch(
+          conditions + [Comment.id.in_(ids[i:i + batch_size])],
+          disabled, batch_size)
+      count += n
+    return count
+  after_id = None
+  while True:
+    after_id, n = _update_batch(conditions, disabled, batch_size, after_id)
+    if after_id is None:
+      return count
+    count += n
+
+
+def from_json(json_request):
+  """API请求 -> set_disabled的参数"""
+  disabled = json_request.get('disabled')
+  if not isinstance(disabled, bool):
+    raise ValidationError('disabled must be true or false')
+  kwargs = {'disabled': disabled}
+  ids = json_request.get('ids')
+  if ids is not None:
+    if not isinstance(ids, list) or \
+            not all(isinstance(id, int) and not isinstance(id, bool)
+                    for id in ids):
+      raise ValidationError('ids must be a list of integers')
+    if len(ids) > current_app.config['APP_MODERATION_MAX_IDS']:
+      raise ValidationError('too many ids')
+    kwargs['ids'] = ids
+  author = json_request.get('author')
+  if author is not None:
+    user = User.query.filter_by(username=author).first()
+    if user is None:
+      raise ValidationError('unknown author: %r' % author)
+    kwargs['author_id'] = user.id
+  post_id = json_request.get('post_id')
+  if post_id is not None:
+    if not isinstance(post_id, int):
+      raise ValidationError('post_id must be an integer')
+    kwargs['post_id'] = post_id
+  kwargs['since'] = parse_time(json_request.get('since'), 'since')
+  kwargs['until'] = parse_time(json_request.get('until'), 'until')
+  return kwargs
@@ -0,0 +1,188 @@
+# 键集(游标)分页
+#
+# 按(timestamp, id)等唯一有序键定位页面, 避免OFFSET扫描;
+# 总数只在需要时查询, 并按APP_PAGINATION_COUNT_TTL缓存在应用中.
+
+import base64
+import json
+from datetime import datetime
+
+from flask import current_app, request
+
+from .cache import TTLCache
+from .exceptions import ValidationError
+
+
+def encode_cursor(direction, page, values):
+  """生成不透明的游标"""
+  values = [['d', v.isoformat()] if isinstance(v, datetime) else v
+            for v in values]
+  data = json.dumps([direction, page, values], separators=(',', ':'))
+  return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii') \
+      .rstrip('=')
+
+
+def decode_cursor(cursor):
+  """解析游标: (方向, 页码, 键值)"""
+  try:
+    data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    direction, page, values = json.loads(data)
+    values = [datetime.fromisoformat(v[1]) if isinstance(v, list) else v
+              for v in values]
+  except Exception:
+    raise ValidationError('invalid cursor')
+  if direction not in ('next', 'prev') or not isinstance(page, int):
+    raise ValidationError('invalid cursor')
+  return direction, page, values
+
+
+class CountCache:
+  """查询总数的TTL缓存, 按SQL语句和参数区分
+
+  键包含用户/帖子id等参数, 条目数有上限(LRU).
+  """
+
+  def __init__(self, maxsize=10000):
+    self.cache = TTLCache(maxsize)
+
+  def get(self, query, ttl):
+    query = query.order_by(None)
+    if ttl <= 0:
+      return query.count()
+    compiled = query.statement.compile()
+    key = (str(compiled), repr(sorted(compiled.params.items())))
+    total = self.cache.get(key)
+    if total is None:
+      total = query.count()
+      self.cache.set(key, total, ttl=ttl)
+    return total
+
+  def stats(self):
+    return self.cache.stats()
+
+
+def count_cache():
+  """当前应用的总数缓存"""
+  cache = current_app.extensions.get('pagination_count')
+  if cache is None:
+    cache = current_app.extensions.setdefault(
+        'pagination_count',
+        CountCache(current_app.config['APP_PAGINATION_COUNT_CACHE_SIZE']))
+  return cache
+
+
+def _after(keys, values, desc):
+  """键集比较: (k1, k2, ...) 在 values 之后"""
+  clause = None
+  for key, value in reversed(list(zip(keys, values))):
+    step = key < value if desc else key > value
+    clause = step if clause is None else step | ((key == value) & clause)
+  return clause
+
+
+class KeysetPagination:
+  """与Flask-SQLAlchemy的Pagination接口兼容的键集分页
+
+  keys: 唯一有序的列, 例如(Post.timestamp, Post.id)
+  cursor: 上一页返回的next_cursor/prev_cursor; 没有游标时按page使用OFFSET,
+          保持页码URL可用
+  total: 已知的总数; 否则访问total/pages时从缓存中获取
+  key_values: 取一行的键值的函数, 默认按键的列名取属性
+  """
+
+  def __init__(self, query, keys, per_page, desc=True, cursor=None, page=1,
+               total=None, key_values=None):
+    self.query = query
+    self.keys = keys
+    if key_values is not None:
+      self._key_values = key_values
+    self.per_page = per_page
+    self.desc = desc
+    self._total = total
+
+    if cursor:
+      direction, self.page, values = decode_cursor(cursor)
+      if len(values) != len(keys):
+        raise ValidationError('invalid cursor')
+      forward = direction == 'next'
+      q = query.filter(_after(keys, values, desc == forward))
+    else:
+      forward = True
+      self.page = max(page, 1)
+      q = query
+    order = [k.desc() if desc == forward else k.asc() for k in keys]
+    q = q.order_by(None).order_by(*order)
+    if not cursor and self.page > 1:
+      q = q.offset((self.page - 1) * per_page)
+    # 多取一行判断是否还有下一页
+    rows = q.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if forward:
+      self.items = rows
+      self.has_next = more
+      self.has_prev = self.page > 1
+    else:
+      self.items = rows[::-1]
+      self.has_next = True
+      self.has_prev = more
+
+  def _key_values(self, item):
+    return [getattr(item, k.key) for k in self.keys]
+
+  @property
+  def next_cursor(self):
+    if not self.has_next or not self.items:
+      return None
+    return encode_cursor('next', self.page + 1,
+                         self._key_values(self.items[-1]))
+
+  @property
+  def prev_cursor(self):
+    if not self.has_prev or not self.items:
+      return None
+    return encode_cursor('prev', self.page - 1,
+                         self._key_values(self.items[0]))
+
+  @property
+  def next_num(self):
+    return self.page + 1 if self.has_next else None
+
+  @property
+  def prev_num(self):
+    return self.page - 1 if self.has_prev else None
+
+  @property
+  def total(self):
+    if self._total is None:
+      self._total = count_cache().get(
+          self.query, current_app.config['APP_PAGINATION_COUNT_TTL'])
+    return self._total
+
+  @property
+  def pages(self):
+    if self.total == 0:
+      return 0
+    return (self.total - 1) // self.per_page + 1
+
+  def iter_pages(self, left_edge=2, left_current=2, right_current=4,
+                 right_edge=2):
+    """页码部件的页码, None表示省略"""
+    pages = max(self.pages, self.page)
+    last = 0
+    for num in range(1, pages + 1):
+      if num <= left_edge or \
+              self.page - left_current <= num < self.page + right_current or \
+              num > pages - right_edge:
+        if last + 1 != num:
+          yield None
+        yield num
+        last = num
+
+
+def paginate(query, keys, per_page, desc=True, total=None, key_values=None):
+  """按请求参数cursor/page分页"""
+  return KeysetPagination(query, keys, per_page, desc=desc,
+                          cursor=request.args.get('cursor'),
+                          page=request.args.get('page', 1, type=int),
+                          total=total, key_values=key_values)
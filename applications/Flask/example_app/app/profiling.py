@@ -0,0 +1,183 @@
+# 采样分析器
+#
+# cProfile(ProfilerMiddleware)跟踪每次函数调用, 请求慢2-5倍, 而且每个请求
+# 一个.prof文件. 采样模式:
+# - 后台线程每秒APP_PROFILE_HZ次读取处理请求的线程的调用栈
+#   (sys._current_frames), 被采样的代码不做任何额外的事; 墙上时间,
+#   等待数据库/网络的时间也计入
+# - 按端点累计折叠的栈("a;b;c 次数"), 可以直接用flamegraph.pl,
+#   speedscope, inferno等生成火焰图
+# - 运行中的worker可以通过/debug/profile开始/停止, 到时自动停止,
+#   结果写到APP_PROFILE_DIR/<端点>.<pid>.folded
+#
+# 不用信号(SIGPROF): 信号处理函数只在主线程执行, 多线程的服务器中
+# 采不到其他线程.
+
+import os
+import re
+import sys
+import threading
+import time
+
+from flask import request
+
+_FILENAME = re.compile(r'[^A-Za-z0-9_.-]')
+
+TRUNCATED = '[truncated]'
+
+
+def frame_name(frame):
+  """栈帧: 模块:函数"""
+  return '%s:%s' % (frame.f_globals.get('__name__', '?'),
+                    frame.f_code.co_qualname)
+
+
+class StackSampler:
+  """采样分析器扩展: app.extensions['profiler']"""
+
+  def __init__(self, app=None):
+    self.lock = threading.Lock()
+    self.requests = {}  # 线程id -> 端点
+    self.samples = {}  # 端点 -> {折叠的栈: 次数}
+    self.thread = None
+    self.stop_event = threading.Event()
+    self.hz = None
+    self.started = None
+    self.sampled = 0
+    self.dropped = 0
+    self.files = []
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    self.stop()
+    config = app.config
+    self.default_hz = config['APP_PROFILE_HZ']
+    self.default_seconds = config['APP_PROFILE_SECONDS']
+    self.max_seconds = config['APP_PROFILE_MAX_SECONDS']
+    self.max_stacks = config['APP_PROFILE_MAX_STACKS']
+    self.directory = config['APP_PROFILE_DIR']
+    self.app = app
+    app.extensions['profiler'] = self
+    app.before_request(self._before_request)
+    app.teardown_request(self._teardown_request)
+
+  def _before_request(self):
+    self.requests[threading.get_ident()] = request.endpoint or '<unknown>'
+
+  def _teardown_request(self, exc):
+    self.requests.pop(threading.get_ident(), None)
+
+  @property
+  def running(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  ##############################################################################
+  # 开始/停止
+  ##############################################################################
+
+  def start(self, hz=None, seconds=None):
+    """开始采样, seconds秒后自动停止(None: 直到stop); 已经在运行时返回False"""
+    hz = min(max(hz or self.default_hz, 1), 1000)
+    with self.lock:
+      if self.running:
+        return False
+      self.samples = {}
+      self.sampled = 0
+      self.dropped = 0
+      self.files = []
+      self.hz = hz
+      self.started = time.time()
+      self.stop_event = threading.Event()
+      deadline = time.monotonic() + seconds if seconds else None
+      self.thread = threading.Thread(target=self._run,
+                                     args=(1.0 / hz, deadline),
+                                     name='stack-sampler', daemon=True)
+      self.thread.start()
+    return True
+
+  def stop(self):
+    """停止采样, 返回写入的文件"""
+    thread = self.thread
+    if thread is not None:
+      self.stop_event.set()
+      thread.join()
+      self.thread = None
+    return self.files
+
+  def _run(self, interval, deadline):
+    names = {}  # 代码对象 -> 名称
+    me = threading.get_ident()
+    while not self.stop_event.wait(interval):
+      if deadline is not None and time.monotonic() >= deadline:
+        break
+      frames = sys._current_frames()
+      for ident, endpoint in list(self.requests.items()):
+        frame = frames.get(ident)
+        if frame is None or ident == me:
+          continue
+        stack = []
+        while frame is not None:
+          name = names.get(frame.f_code)
+          if name is None:
+            name = names[frame.f_code] = frame_name(frame)
+          stack.append(name)
+          frame = frame.f_back
+        stack.reverse()
+        self.add(endpoint, ';'.join(stack))
+      del frames
+    try:
+      self.files = self.dump()
+    except OSError as e:
+      self.app.logger.error('Write profiles failed: %s', e)
+
+  def add(self, endpoint, stack, n=1):
+    with self.lock:
+      stacks = self.samples.setdefault(endpoint, {})
+      if stack not in stacks and len(stacks) >= self.max_stacks:
+        # 不同的栈太多: 不再增加新的栈, 只计数
+        self.dropped += n
+        stack = TRUNCATED
+      stacks[stack] = stacks.get(stack, 0) + n
+      self.sampled += n
+
+  ##############################################################################
+  # 输出
+  ##############################################################################
+
+  def folded(self, endpoint=None):
+    """折叠的栈; endpoint为None时所有端点, 端点作为根帧"""
+    with self.lock:
+      if endpoint is not None:
+        items = list(self.samples.get(endpoint, {}).items())
+      else:
+        items = [('%s;%s' % (name, stack), n)
+                 for name, stacks in self.samples.items()
+                 for stack, n in stacks.items()]
+    items.sort(key=lambda item: -item[1])
+    return ''.join('%s %d\n' % item for item in items)
+
+  def dump(self, directory=None):
+    """每个端点写一个<端点>.<pid>.folded, 返回文件路径"""
+    directory = directory or self.directory
+    if not directory:
+      return []
+    os.makedirs(directory, exist_ok=True)
+    with self.lock:
+      endpoints = list(self.samples)
+    files = []
+    for endpoint in endpoints:
+      path = os.path.join(directory, '%s.%d.folded' % (
+          _FILENAME.sub('_', endpoint), os.getpid()))
+      with open(path, 'w') as f:
+        f.write(self.folded(endpoint))
+      files.append(path)
+    return files
+
+  def stats(self):
+    with self.lock:
+      endpoints = {endpoint: sum(stacks.values())
+                   for endpoint, stacks in self.samples.items()}
+    return {'running': self.running, 'hz': self.hz, 'started': self.started,
+            'sampled': self.sampled, 'dropped': self.dropped,
+            'endpoints': endpoints, 'files': self.files}
@@ -0,0 +1,211 @@
+# 查询统计
+#
+# 不再记录并逐条输出每个查询, 而是:
+# - 把SQL规范化为指纹(字面量, 参数列表替换为占位符)
+# - 按(端点, 指纹)聚合次数, 总耗时, 最近耗时的环形缓冲(p50/p99)
+# - 一个请求中同一指纹的SELECT重复多次: 标记为N+1
+# - 超过APP_SLOW_DB_QUERY_TIME的查询写日志
+#
+# 每个查询只有两次计时和一次(缓存的)指纹计算, 可以在生产环境开启.
+
+import functools
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from flask import current_app, g, has_request_context, request
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ROWS = re.compile(r'\(\?\.\.\.\)(?:\s*,\s*\(\?\.\.\.\))+')
+_SPACE = re.compile(r'\s+')
+_COLUMNS = re.compile(r'^SELECT (?:DISTINCT )?.+? FROM ')
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(statement):
+  """规范化SQL: 同一类查询得到相同的指纹"""
+  s = _SPACE.sub(' ', statement).strip()
+  s = _STRING.sub('?', s)
+  s = _NUMBER.sub('?', s)
+  # IN (?, ?, ?) 和多行VALUES
+  s = _LIST.sub('(?...)', s)
+  s = _ROWS.sub('(?...)', s)
+  return s
+
+
+def abbreviate(fingerprint, width=120):
+  """用于显示: 省略SELECT的列"""
+  s = _COLUMNS.sub('SELECT ... FROM ', fingerprint, count=1)
+  return s if len(s) <= width else s[:width - 3] + '...'
+
+
+def percentile(values, p):
+  """已排序列表的百分位数"""
+  if not values:
+    return None
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def request_queries():
+  """当前请求已执行的[(语句, 耗时)]"""
+  return g.get('_queries') or []
+
+
+class QueryStats:
+  """一个(端点, 指纹)的统计"""
+
+  __slots__ = ('count', 'total', 'max', 'durations', 'requests',
+               'n_plus_one', 'max_repeat')
+
+  def __init__(self, sample_size):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    # 最近的耗时, 用于计算百分位数
+    self.durations = deque(maxlen=sample_size)
+    self.requests = 0
+    # 被标记为N+1的请求数, 一个请求中最多重复次数
+    self.n_plus_one = 0
+    self.max_repeat = 0
+
+  def add(self, duration):
+    self.count += 1
+    self.total += duration
+    self.max = max(self.max, duration)
+    self.durations.append(duration)
+
+  def to_dict(self):
+    durations = sorted(self.durations)
+    return {
+        'count': self.count,
+        'requests': self.requests,
+        'total': self.total,
+        'mean': self.total / self.count if self.count else None,
+        'p50': percentile(durations, 0.5),
+        'p99': percentile(durations, 0.99),
+        'max': self.max,
+        'n_plus_one': self.n_plus_one,
+        'max_repeat': self.max_repeat,
+    }
+
+
+class QueryRecorder:
+  """查询统计扩展: app.extensions['queries']"""
+
+  def __init__(self, app=None):
+    self.lock = threading.Lock()
+    self.enabled = False
+    self.stats = {}
+    self.requests = 0
+    self.queries = 0
+    self.dropped = 0
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    self.reset()
+    config = app.config
+    self.enabled = config['APP_QUERY_RECORDER']
+    self.sample_size = config['APP_QUERY_SAMPLE_SIZE']
+    self.max_fingerprints = config['APP_QUERY_MAX_FINGERPRINTS']
+    self.n_plus_one_threshold = config['APP_QUERY_N_PLUS_ONE']
+    self.slow_query_time = config['APP_SLOW_DB_QUERY_TIME']
+    app.extensions['queries'] = self
+    if not self.enabled:
+      return
+    from . import db
+    with app.app_context():
+      for engine in db.engines.values():
+        db.event.listen(engine, 'before_cursor_execute',
+                        self._before_cursor_execute)
+        db.event.listen(engine, 'after_cursor_execute',
+                        self._after_cursor_execute)
+    app.teardown_request(self._teardown_request)
+
+  ##############################################################################
+  # 记录
+  ##############################################################################
+
+  def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+    if context is not None:
+      context._query_start = time.perf_counter()
+
+  def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                            context, executemany):
+    start = getattr(context, '_query_start', None)
+    if start is None or not has_request_context():
+      return
+    duration = time.perf_counter() - start
+    if duration >= self.slow_query_time:
+      current_app.logger.warning(
+          'Slow query (%fs) in %s: %s\nParameters: %s',
+          duration, request.endpoint, statement, parameters)
+    queries = g.get('_queries')
+    if queries is None:
+      queries = g._queries = []
+    queries.append((statement, duration))
+
+  def _teardown_request(self, exc):
+    queries = g.pop('_queries', None)
+    if queries:
+      self.collect(request.endpoint or '<unknown>', queries)
+
+  def collect(self, endpoint, queries):
+    """聚合一个请求的[(语句, 耗时)]"""
+    repeats = Counter()
+    with self.lock:
+      self.requests += 1
+      for statement, duration in queries:
+        self.queries += 1
+        key = (endpoint, fingerprint(statement))
+        stats = self.stats.get(key)
+        if stats is None:
+          if len(self.stats) >= self.max_fingerprints:
+            self.dropped += 1
+            continue
+          stats = self.stats[key] = QueryStats(self.sample_size)
+        stats.add(duration)
+        repeats[key] += 1
+      for key, repeat in repeats.items():
+        stats = self.stats[key]
+        stats.requests += 1
+        stats.max_repeat = max(stats.max_repeat, repeat)
+        if repeat >= self.n_plus_one_threshold and \
+                key[1].startswith('SELECT'):
+          if not stats.n_plus_one:
+            current_app.logger.warning(
+                'Possible N+1 in %s: %d x %s', key[0], repeat, key[1])
+          stats.n_plus_one += 1
+
+  ##############################################################################
+  # 查询结果
+  ##############################################################################
+
+  def snapshot(self, endpoint=None, sort='total', limit=None,
+               n_plus_one=False):
+    """统计列表, 按sort(total, count, p50, p99, max, n_plus_one)降序
+
+    n_plus_one: 只返回被标记为N+1的指纹
+    """
+    with self.lock:
+      items = [dict(stats.to_dict(), endpoint=key[0], fingerprint=key[1])
+               for key, stats in self.stats.items()
+               if (endpoint is None or key[0] == endpoint) and
+               (not n_plus_one or stats.n_plus_one)]
+    items.sort(key=lambda item: item[sort] or 0, reverse=True)
+    return items[:limit] if limit else items
+
+  def summary(self):
+    return {'requests': self.requests, 'queries': self.queries,
+            'fingerprints': len(self.stats), 'dropped': self.dropped}
+
+  def reset(self):
+    with self.lock:
+      self.stats.clear()
+      self.requests = 0
+      self.queries = 0
+      self.dropped = 0
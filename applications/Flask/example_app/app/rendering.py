@@ -0,0 +1,257 @@
+# Markdown渲染
+#
+# markdown() + bleach.clean() + bleach.linkify()是写入时最耗CPU的操作:
+# - 渲染结果按(允许的标签, 内容)的hash缓存: 进程内LRU, 可选磁盘缓存
+# - 可选把渲染放到进程池中, 提交后再回写body_html
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import bleach
+from markdown import markdown
+
+from .metrics import timed
+
+
+def render(body, allowed_tags):
+  """渲染并清理Markdown, 可以在工作进程中执行"""
+  return bleach.linkify(bleach.clean(
+      markdown(body, output_format='html'),
+      tags=allowed_tags, strip=True))
+
+
+def cache_key(body, allowed_tags):
+  data = ','.join(sorted(allowed_tags)) + '\0' + body
+  return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+  """渲染缓存: 进程内LRU, directory不为空时使用磁盘作为第二层
+
+  可替换为任何提供get(key)/set(key, html)的对象.
+  """
+
+  def __init__(self, maxsize=1024, directory=None):
+    self.maxsize = maxsize
+    self.directory = directory
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key):
+    with self.lock:
+      html = self.entries.get(key)
+      if html is not None:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return html
+    if self.directory:
+      try:
+        with open(self._path(key), encoding='utf-8') as f:
+          html = f.read()
+      except OSError:
+        html = None
+      if html is not None:
+        self._remember(key, html)
+        with self.lock:
+          self.hits += 1
+        return html
+    with self.lock:
+      self.misses += 1
+    return None
+
+  def set(self, key, html):
+    self._remember(key, html)
+    if self.directory:
+      # 先写临时文件再改名, 多进程并发写入也不会读到半个文件
+      path = self._path(key)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+      with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(html)
+      os.replace(tmp, path)
+
+  def _remember(self, key, html):
+    with self.lock:
+      self.entries[key] = html
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+
+class Renderer:
+  """渲染扩展: app.extensions['renderer']"""
+
+  def __init__(self, app=None):
+    self.cache = None
+    self.executor = None
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    self.cache = RenderCache(app.config['APP_RENDER_CACHE_SIZE'],
+                             app.config['APP_RENDER_CACHE_DIR'])
+    self.offload = app.config['APP_RENDER_OFFLOAD']
+    self.workers = app.config['APP_RENDER_WORKERS']
+    app.extensions['renderer'] = self
+
+  def get_executor(self):
+    if self.executor is None:
+      self.executor = ProcessPoolExecutor(max_workers=self.workers)
+    return self.executor
+
+  def render(self, body, allowed_tags):
+    """同步渲染, 优先使用缓存"""
+    key = cache_key(body, allowed_tags)
+    html = self.cache.get(key)
+    if html is None:
+      with timed('markdown'):
+        html = render(body, allowed_tags)
+      self.cache.set(key, html)
+    return html
+
+  def cached(self, body, allowed_tags):
+    """只查缓存, 未命中返回None"""
+    return self.cache.get(cache_key(body, allowed_tags))
+
+  def submit(self, table, id, body, allowed_tags):
+    """在进程池中渲染, 完成后回写body_html(内容未被再次修改时)"""
+    from flask import current_app
+    app = current_app._get_current_object()
+    future = self.get_executor().submit(render, body, allowed_tags)
+
+    def done(future):
+      if future.exception() is not None:
+        app.logger.error(
+            'Render %s %s failed: %s', table.name, id, future.exception())
+        return
+      html = future.result()
+      self.cache.set(cache_key(body, allowed_tags), html)
+      from . import db
+      with app.app_context():
+        with db.engine.begin() as conn:
+          conn.execute(table.update()
+                       .where(table.c.id == id, table.c.body == body)
+                       .values(body_html=html, version=table.c.version + 1))
+    future.add_done_callback(done)
+    return future
+
+  def render_many(self, rows, allowed_tags, parallel=None):
+    """批量渲染[(id, body)], 返回[(id, html)]; parallel时使用进程池
+
+    先查缓存, 只把未命中的内容(去重后)交给进程池, 结果放回缓存.
+    """
+    if parallel is None:
+      parallel = self.offload
+    bodies = [body or '' for _, body in rows]
+    if not parallel:
+      return [(id, self.render(body, allowed_tags))
+              for (id, _), body in zip(rows, bodies)]
+    keys = [cache_key(body, allowed_tags) for body in bodies]
+    htmls = {}
+    misses = {}  # 键 -> 内容
+    for key, body in zip(keys, bodies):
+      if key not in htmls and key not in misses:
+        html = self.cache.get(key)
+        if html is None:
+          misses[key] = body
+        else:
+          htmls[key] = html
+    if misses:
+      rendered = self.get_executor().map(
+          render, misses.values(), [allowed_tags] * len(misses),
+          chunksize=32)
+      for key, html in zip(misses, rendered):
+        self.cache.set(key, html)
+        htmls[key] = html
+    return [(id, htmls[key]) for (id, _), key in zip(rows, keys)]
+
+  def shutdown(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+
+  def rerender(self, model, batch_size=500, only_missing=False,
+               parallel=None):
+    """按id分批重新渲染模型的body_html, 返回处理的行数"""
+    from . import db
+    count = 0
+    last_id = 0
+    while True:
+      query = db.select(model.id, model.body).where(model.id > last_id)
+      if only_missing:
+        query = query.where(model.body_html.is_(None))
+      rows = db.session.execute(
+          query.order_by(model.id).limit(batch_size)).all()
+      if not rows:
+        break
+      rendered = self.render_many(rows, model.ALLOWED_TAGS, parallel)
+      # 按主键批量UPDATE(executemany), 增加行版本
+      table = model.__table__
+      db.session.execute(
+          table.update().where(table.c.id == db.bindparam('row_id'))
+          .values(body_html=db.bindparam('html'),
+                  version=table.c.version + 1),
+          [{'row_id': id, 'html': html} for id, html in rendered])
+      db.session.commit()
+      count += len(rows)
+      last_id = rows[-1][0]
+    return count
+
+
+################################################################################
+# 模型事件
+################################################################################
+
+def set_body_html(target, body, allowed_tags):
+  """设置body时更新body_html
+
+  开启offload且缓存未命中时body_html暂时为空(模板显示原文),
+  提交后由进程池渲染并回写.
+  """
+  from flask import current_app
+  from . import db
+  renderer = current_app.extensions['renderer']
+  if body is None:
+    target.body_html = None
+  elif not renderer.offload:
+    target.body_html = renderer.render(body, allowed_tags)
+  else:
+    target.body_html = renderer.cached(body, allowed_tags)
+    if target.body_html is None:
+      db.session.info.setdefault('pending_renders', {})[target] = \
+          allowed_tags
+
+
+def on_after_flush(session, flush_context):
+  """刷新后才有id: 记录待渲染的行"""
+  pending = session.info.get('pending_renders')
+  if not pending:
+    return
+  jobs = session.info.setdefault('render_jobs', [])
+  for target, allowed_tags in list(pending.items()):
+    if target in session and target.id is not None:
+      jobs.append((target.__table__, target.id, target.body, allowed_tags))
+      del pending[target]
+
+
+def on_after_commit(session):
+  jobs = session.info.pop('render_jobs', None)
+  if jobs:
+    from flask import current_app
+    renderer = current_app.extensions['renderer']
+    for job in jobs:
+      renderer.submit(*job)
+
+
+def on_after_rollback(session):
+  session.info.pop('pending_renders', None)
+  session.info.pop('render_jobs', None)
@@ -0,0 +1,228 @@
+# 读写分离
+#
+# 配置了只读副本(SQLALCHEMY_BINDS['replica'], 见APP_DB_REPLICA_URL)时,
+# 满足以下条件的SELECT使用副本, 其他语句使用主库:
+# - GET/HEAD请求, 且不是auth蓝本或@use_primary标记的视图
+# - 本请求还没有写入(flush)
+# - 客户端最近APP_DB_REPLICA_STICKY秒内没有提交过写入(读自己的写):
+#   提交时间保存在客户端, 不依赖处理请求的worker. 浏览器保存在会话中,
+#   API的响应头X-DB-Last-Write返回提交时间, 客户端在之后的请求中带上
+# - 副本健康: 每APP_DB_REPLICA_CHECK_INTERVAL秒检查一次连接和复制延迟,
+#   延迟超过APP_DB_REPLICA_MAX_LAG或出错时回退到主库
+# - 副本上的读出错: 回滚会话(本请求还没有写入), 在主库上重试一次,
+#   故障切换不返回500
+
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import DBAPIError
+
+REPLICA = 'replica'
+
+# 最近一次提交写入的时间(time.time()): 会话中的键, API的请求/响应头
+LAST_WRITE_KEY = '_db_last_write'
+LAST_WRITE_HEADER = 'X-DB-Last-Write'
+
+# 整个蓝本都使用主库: 登录, 注册, 确认等读取刚写入的数据
+PRIMARY_BLUEPRINTS = {'auth'}
+
+
+class ReplicaRouter:
+  """副本的健康状态, 粘滞的用户, 路由统计: app.extensions['replica']"""
+
+  def __init__(self, app=None):
+    self.lock = threading.Lock()
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    config = app.config
+    self.enabled = REPLICA in (config.get('SQLALCHEMY_BINDS') or {})
+    self.max_lag = config['APP_DB_REPLICA_MAX_LAG']
+    self.check_interval = config['APP_DB_REPLICA_CHECK_INTERVAL']
+    self.sticky = config['APP_DB_REPLICA_STICKY']
+    self.healthy = True
+    self.lag = None
+    self.checked = None
+    # 指标
+    self.replica_reads = 0
+    self.primary_reads = 0
+    self.fallbacks = 0
+    self.sticky_reads = 0
+    self.errors = 0
+    app.extensions['replica'] = self
+    if not self.enabled:
+      return
+    from . import db
+    with app.app_context():
+      self.engine = db.engines[REPLICA]
+    db.event.listen(self.engine, 'handle_error', self._on_error)
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+
+  def _before_request(self):
+    # 应用上下文可能跨多个请求(测试), 写入标记按请求重置
+    g.pop('_db_wrote', None)
+    g.pop('_db_committed', None)
+
+  def _after_request(self, response):
+    # 本请求提交了写入: 把时间交给客户端
+    committed = g.pop('_db_committed', None)
+    if committed is not None:
+      response.headers[LAST_WRITE_HEADER] = '%.3f' % committed
+      if request.blueprint != 'api':
+        session[LAST_WRITE_KEY] = committed
+    return response
+
+  ##############################################################################
+  # 健康检查
+  ##############################################################################
+
+  def _replication_lag(self, conn):
+    """副本落后主库的秒数, 不能测量时为None"""
+    if conn.dialect.name == 'postgresql':
+      return conn.exec_driver_sql(
+          'SELECT EXTRACT(EPOCH FROM now() - '
+          'pg_last_xact_replay_timestamp())').scalar()
+    conn.exec_driver_sql('SELECT 1')
+    return None
+
+  def check(self):
+    """检查连接和延迟, 返回副本是否可用"""
+    try:
+      with self.engine.connect() as conn:
+        lag = self._replication_lag(conn)
+    except Exception as e:
+      current_app.logger.warning('Replica check failed: %s', e)
+      healthy, lag = False, None
+    else:
+      healthy = lag is None or lag <= self.max_lag
+      if not healthy:
+        current_app.logger.warning('Replica lag %.1fs exceeds %.1fs',
+                                   lag, self.max_lag)
+    with self.lock:
+      self.healthy = healthy
+      self.lag = lag
+      self.checked = time.monotonic()
+    return healthy
+
+  def available(self):
+    checked = self.checked
+    if checked is None or time.monotonic() - checked >= self.check_interval:
+      return self.check()
+    return self.healthy
+
+  def _on_error(self, context):
+    # 副本出错: 到下次检查前使用主库
+    with self.lock:
+      self.errors += 1
+      self.healthy = False
+      self.checked = time.monotonic()
+    if has_request_context():
+      g._replica_failed = True
+
+  ##############################################################################
+  # 路由
+  ##############################################################################
+
+  def use_replica(self):
+    """当前请求的读是否使用副本"""
+    if not self.enabled or not has_request_context():
+      return False
+    if request.method not in ('GET', 'HEAD') or \
+            request.blueprint in PRIMARY_BLUEPRINTS or \
+            g.get('_db_wrote'):
+      return False
+    view = current_app.view_functions.get(request.endpoint)
+    if getattr(view, 'use_primary', False):
+      return False
+    written = last_write()
+    if written is not None and time.time() - written < self.sticky:
+      self.sticky_reads += 1
+      return False
+    if not self.available():
+      self.fallbacks += 1
+      return False
+    return True
+
+  def stats(self):
+    return {'enabled': self.enabled, 'healthy': self.healthy,
+            'lag': self.lag, 'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'fallbacks': self.fallbacks, 'sticky_reads': self.sticky_reads,
+            'errors': self.errors}
+
+
+def last_write():
+  """客户端最近一次提交写入的时间: 请求头或会话中的值, 没有时为None"""
+  value = request.headers.get(LAST_WRITE_HEADER) or \
+      session.get(LAST_WRITE_KEY)
+  try:
+    return float(value) if value is not None else None
+  except ValueError:
+    return None
+
+
+class RoutingSession(Session):
+  """读语句按ReplicaRouter选择副本, 写和flush使用主库"""
+
+  def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+    if bind is None and not self._flushing and \
+            getattr(clause, 'is_select', False) and has_request_context():
+      router = current_app.extensions.get('replica')
+      if router is not None and router.enabled:
+        if router.use_replica():
+          router.replica_reads += 1
+          return router.engine
+        router.primary_reads += 1
+    return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                            **kwargs)
+
+  def _retry_on_primary(self, method, *args, **kwargs):
+    """执行; 副本上出错时回滚, 在主库上重试(副本已标记为不健康)"""
+    if not has_request_context():
+      return method(*args, **kwargs)
+    g.pop('_replica_failed', None)
+    try:
+      return method(*args, **kwargs)
+    except DBAPIError:
+      if not g.pop('_replica_failed', False) or \
+              self.new or self.dirty or self.deleted:
+        raise
+      current_app.logger.warning('Replica read failed, retrying on primary')
+      self.rollback()
+      return method(*args, **kwargs)
+
+  def execute(self, *args, **kwargs):
+    return self._retry_on_primary(super().execute, *args, **kwargs)
+
+  def scalar(self, *args, **kwargs):
+    return self._retry_on_primary(super().scalar, *args, **kwargs)
+
+  def scalars(self, *args, **kwargs):
+    return self._retry_on_primary(super().scalars, *args, **kwargs)
+
+
+################################################################################
+# 事件: 记录写入
+################################################################################
+
+def mark_written():
+  """本请求写入了数据库(包括不经过flush的批量UPDATE)"""
+  if has_request_context():
+    g._db_wrote = True
+
+
+def on_after_flush(session, flush_context):
+  mark_written()
+
+
+def on_after_commit(session):
+  # 提交了写入: 该客户端之后的请求在一段时间内读主库(见_after_request)
+  if not has_request_context() or not g.get('_db_wrote'):
+    return
+  router = current_app.extensions.get('replica')
+  if router is not None and router.enabled:
+    g._db_committed = time.time()
@@ -0,0 +1,104 @@
+# 角色缓存
+#
+# 角色表很小且很少修改: 一次查询全部角色缓存在进程中(每个应用一份),
+# 权限检查只做位运算. 角色提交修改后失效, APP_ROLE_CACHE_TTL限制其他
+# 进程(gunicorn worker)中的缓存最多过期多久.
+
+import threading
+import time
+
+from flask import current_app
+
+
+class RoleCache:
+  """角色id -> (名称, 权限, 是否默认)"""
+
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.roles = None
+    self.expires = 0
+    # 每次失效加1: 查询期间发生过失效的结果不放入缓存
+    self.generation = 0
+
+  def _fresh(self):
+    roles = self.roles
+    if roles is not None and time.monotonic() < self.expires:
+      return roles
+    return None
+
+  def load(self):
+    roles = self._fresh()
+    if roles is not None:
+      return roles
+    from . import db
+    from .models import Role
+    with self.lock:
+      # 等锁期间其他线程可能已经加载: 并发的冷请求只查询一次
+      roles = self._fresh()
+      if roles is not None:
+        return roles
+      generation = self.generation
+      rows = db.session.execute(
+          db.select(Role.id, Role.name, Role.permissions, Role.default)).all()
+      roles = {id: (name, permissions or 0, bool(default))
+               for id, name, permissions, default in rows}
+      if self.generation == generation:
+        self.roles = roles
+        self.expires = time.monotonic() + self.ttl
+      return roles
+
+  def invalidate(self):
+    with self.lock:
+      self.generation += 1
+      self.roles = None
+
+  def permissions(self, role_id):
+    """角色的权限位, 角色不存在时为0"""
+    role = self.load().get(role_id)
+    return role[1] if role is not None else 0
+
+  def id_for(self, name):
+    for id, role in self.load().items():
+      if role[0] == name:
+        return id
+    return None
+
+  def default_id(self):
+    for id, role in self.load().items():
+      if role[2]:
+        return id
+    return None
+
+  def choices(self):
+    """按名称排序的(id, 名称), 用于表单"""
+    return sorted(((id, role[0]) for id, role in self.load().items()),
+                  key=lambda choice: choice[1])
+
+
+def role_cache():
+  """当前应用的角色缓存"""
+  cache = current_app.extensions.get('role_cache')
+  if cache is None:
+    cache = current_app.extensions.setdefault(
+        'role_cache', RoleCache(current_app.config['APP_ROLE_CACHE_TTL']))
+  return cache
+
+
+################################################################################
+# 模型事件
+################################################################################
+
+def on_role_changed(mapper, connection, target):
+  """角色有修改: 提交后失效"""
+  from . import db
+  db.session.info['roles_changed'] = True
+
+
+def on_after_commit(session):
+  if session.info.pop('roles_changed', False):
+    role_cache().invalidate()
+
+
+def on_after_rollback(session):
+  session.info.pop('roles_changed', None)
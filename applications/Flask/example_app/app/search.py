@@ -0,0 +1,148 @@
+# 全文搜索
+#
+# posts.body和comments.body的FTS5索引(外部内容表, 不重复保存正文):
+# - 触发器在INSERT/DELETE/UPDATE OF body时同步索引, Core批量插入(flask fake)
+#   也会同步
+# - 按BM25排序(FTS5的rank列), 键集分页的键是(rank, id); 对所有匹配行排序,
+#   APP_SEARCH_MAX_CANDIDATES只限制能翻到的结果数(最相关的n个)
+# - flask search reindex: 创建缺少的表和触发器, 按内容表重建索引
+#   (SQLite的batch迁移会重建posts/comments表, 触发器随之删除, 迁移后需要执行)
+# 非SQLite数据库退化为LIKE查询.
+
+import re
+
+from flask import current_app
+
+from . import db
+from .exceptions import ValidationError
+from .models import Comment, Post
+
+# 内容表 -> FTS5表
+FTS_TABLES = {'posts': 'posts_fts', 'comments': 'comments_fts'}
+
+# 搜索词: 字母数字, 以*结尾表示前缀查询
+_TERM = re.compile(r'\w+\*?')
+
+
+def create_statements(table):
+  """创建FTS5表和同步触发器的语句"""
+  statements = [
+      # 前缀索引: 2, 3个字符的前缀查询不扫描词表
+      "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+      "body, content='{table}', content_rowid='id', prefix='2 3')",
+      "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+      "INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END",
+      "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+      "INSERT INTO {fts}({fts}, rowid, body) "
+      "VALUES ('delete', old.id, old.body); END",
+      "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF body ON {table} "
+      "BEGIN "
+      "INSERT INTO {fts}({fts}, rowid, body) "
+      "VALUES ('delete', old.id, old.body); "
+      "INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END",
+  ]
+  return [s.format(table=table, fts=FTS_TABLES[table]) for s in statements]
+
+
+def drop_statements(table):
+  fts = FTS_TABLES[table]
+  return ['DROP TRIGGER IF EXISTS %s_au' % fts,
+          'DROP TRIGGER IF EXISTS %s_ad' % fts,
+          'DROP TRIGGER IF EXISTS %s_ai' % fts,
+          'DROP TABLE IF EXISTS %s' % fts]
+
+
+def _on_create(target, connection, **kw):
+  if connection.dialect.name == 'sqlite':
+    for statement in create_statements(target.name):
+      connection.exec_driver_sql(statement)
+
+
+def _on_drop(target, connection, **kw):
+  if connection.dialect.name == 'sqlite':
+    for statement in drop_statements(target.name):
+      connection.exec_driver_sql(statement)
+
+
+def include_name(name, type_, parent_names):
+  """Alembic自动生成迁移时忽略FTS5表和它的影子表(posts_fts_data等)"""
+  if type_ == 'table':
+    return not any(name == fts or name.startswith(fts + '_')
+                   for fts in FTS_TABLES.values())
+  return True
+
+
+# db.create_all()/drop_all()时一起创建/删除
+for model in (Post, Comment):
+  db.event.listen(model.__table__, 'after_create', _on_create)
+  db.event.listen(model.__table__, 'before_drop', _on_drop)
+
+
+def terms(text):
+  """用户输入中的搜索词, 最多APP_SEARCH_MAX_TERMS个"""
+  words = _TERM.findall(text or '')
+  if not words:
+    raise ValidationError('empty search query')
+  return words[:current_app.config['APP_SEARCH_MAX_TERMS']]
+
+
+def fts_query(words):
+  """FTS5查询: 每个词加引号, 词之间是AND
+
+  不使用FTS5的运算符和列过滤, 避免语法错误和昂贵的查询.
+  """
+  return ' '.join('"%s"*' % t[:-1] if t.endswith('*') else '"%s"' % t
+                  for t in words)
+
+
+def search_query(model, text):
+  """搜索model(Post或Comment)的body
+
+  返回(查询, 键): 查询的行是(对象, rank), rank越小越相关;
+  键用于KeysetPagination(升序).
+  """
+  words = terms(text)
+  if db.session.get_bind().dialect.name != 'sqlite':
+    rank = db.literal(0.0)
+    q = db.session.query(model, rank.label('rank'))
+    for word in words:
+      q = q.filter(model.body.ilike('%%%s%%' % word.rstrip('*')))
+  else:
+    fts = db.table(FTS_TABLES[model.__tablename__], db.column('rowid'),
+                   db.column('rank'))
+    match = db.literal_column(fts.name)
+    # 候选行: 所有匹配行按rank(BM25)排序, 有上限时只保留最相关的n个;
+    # 排序结果与不限制时的前n个相同
+    candidates = db.select(fts.c.rowid, fts.c.rank) \
+        .where(match.match(fts_query(words))) \
+        .order_by(fts.c.rank, fts.c.rowid)
+    limit = current_app.config['APP_SEARCH_MAX_CANDIDATES']
+    if limit:
+      candidates = candidates.limit(limit)
+    candidates = candidates.subquery()
+    rank = candidates.c.rank
+    q = db.session.query(model, rank) \
+        .join(candidates, candidates.c.rowid == model.id)
+  if model is Comment:
+    q = q.filter(Comment.disabled.is_not(True))
+  return q, (rank, model.id)
+
+
+def key_values(row):
+  """搜索结果行的分页键值"""
+  return [row.rank, row[0].id]
+
+
+def reindex(model, optimize=True):
+  """创建缺少的表和触发器, 按内容表重建model的索引, 返回索引的行数"""
+  table = model.__tablename__
+  fts = FTS_TABLES[table]
+  with db.engine.begin() as conn:
+    for statement in create_statements(table):
+      conn.exec_driver_sql(statement)
+    conn.exec_driver_sql("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts))
+    if optimize:
+      # 合并所有b-tree段, 查询只需读一个段
+      conn.exec_driver_sql(
+          "INSERT INTO %s(%s) VALUES ('optimize')" % (fts, fts))
+    return conn.exec_driver_sql('SELECT count(*) FROM %s' % table).scalar()
@@ -0,0 +1,167 @@
+# SQLite生产配置
+#
+# 多个gunicorn进程写同一个SQLite文件时(APP_SQLITE_TUNING):
+# - journal_mode=WAL: 读不阻塞写, 写不阻塞读
+# - synchronous=NORMAL: WAL模式下只在检查点fsync, 断电最多丢失最近的事务
+# - busy_timeout: 等待锁, 而不是立即返回database is locked
+# - mmap_size, cache_size: 每个连接的内存映射和页缓存, 减少read()
+# - 写请求(非GET/HEAD, 或@use_primary标记的视图)的事务以BEGIN IMMEDIATE
+#   开始: 延迟事务先读后写, 升级为写锁时不等待busy_timeout, 直接失败
+#   (SQLITE_BUSY)
+#
+# flask sqlite bench: 多进程读-改-写, 比较默认连接与调优后的吞吐量
+
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+
+from .queries import percentile
+
+
+def is_write_request():
+  """当前请求会写入: 事务以BEGIN IMMEDIATE开始
+
+  GET中写入的视图(follow, moderate_enable等)用@use_primary标记, 与
+  ReplicaRouter.use_replica的判断相同.
+  """
+  if not has_request_context():
+    return False
+  if request.method not in ('GET', 'HEAD'):
+    return True
+  view = current_app.view_functions.get(request.endpoint)
+  return getattr(view, 'use_primary', False)
+
+
+def tune(engine, pragmas, immediate=is_write_request):
+  """给SQLite引擎的每个新连接设置pragmas, 由SQLAlchemy发出BEGIN
+
+  immediate(): 返回True时事务以BEGIN IMMEDIATE开始
+  """
+  def on_connect(dbapi_connection, connection_record):
+    # 不使用pysqlite的隐式事务(在第一个DML前才BEGIN)
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+      cursor.execute('PRAGMA %s=%s' % (name, value))
+    cursor.close()
+
+  def on_begin(conn):
+    # 直接在DBAPI连接上执行, 不计入查询统计
+    conn.connection.dbapi_connection.execute(
+        'BEGIN IMMEDIATE' if immediate() else 'BEGIN')
+
+  event.listen(engine, 'connect', on_connect)
+  event.listen(engine, 'begin', on_begin)
+
+
+class SQLiteTuning:
+  """对文件SQLite引擎应用APP_SQLITE_PRAGMAS: app.extensions['sqlite']"""
+
+  def __init__(self, app=None):
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    self.engines = []
+    app.extensions['sqlite'] = self
+    if not app.config['APP_SQLITE_TUNING']:
+      return
+    from . import db
+    with app.app_context():
+      for engine in db.engines.values():
+        if engine.dialect.name == 'sqlite' and \
+                engine.url.database not in (None, '', ':memory:'):
+          tune(engine, app.config['APP_SQLITE_PRAGMAS'])
+          self.engines.append(engine)
+
+  def pragmas(self, engine, names):
+    """连接上实际生效的值"""
+    with engine.connect() as conn:
+      return {name: conn.exec_driver_sql('PRAGMA %s' % name).scalar()
+              for name in names}
+
+
+################################################################################
+# 基准测试
+################################################################################
+
+BENCH_ROWS = 1000
+
+
+def _bench_setup(path):
+  engine = create_engine('sqlite:///' + path)
+  with engine.begin() as conn:
+    conn.exec_driver_sql(
+        'CREATE TABLE counters (id INTEGER PRIMARY KEY, n INTEGER)')
+    conn.exec_driver_sql(
+        'INSERT INTO counters (id, n) VALUES %s'
+        % ','.join('(%d, 0)' % i for i in range(BENCH_ROWS)))
+  engine.dispose()
+
+
+def _bench_worker(task):
+  """一个进程: seconds秒内执行读或读-改-写事务"""
+  path, pragmas, seconds, write_ratio, seed = task
+  rng = random.Random(seed)
+  engine = create_engine('sqlite:///' + path)
+  writing = [False]
+  if pragmas is not None:
+    tune(engine, pragmas, immediate=lambda: writing[0])
+  ops = errors = 0
+  durations = []
+  deadline = time.perf_counter() + seconds
+  while True:
+    start = time.perf_counter()
+    if start >= deadline:
+      break
+    writing[0] = rng.random() < write_ratio
+    id = rng.randrange(BENCH_ROWS)
+    try:
+      with engine.begin() as conn:
+        n = conn.exec_driver_sql(
+            'SELECT n FROM counters WHERE id = ?', (id,)).scalar()
+        if writing[0]:
+          conn.exec_driver_sql(
+              'UPDATE counters SET n = ? WHERE id = ?', (n + 1, id))
+    except OperationalError:
+      # database is locked
+      errors += 1
+      continue
+    ops += 1
+    durations.append(time.perf_counter() - start)
+  engine.dispose()
+  return ops, errors, durations
+
+
+def benchmark(pragmas, processes=4, seconds=5.0, write_ratio=0.2, seed=None):
+  """比较默认连接和pragmas调优后的多进程吞吐量
+
+  返回{'default': 结果, 'tuned': 结果}, 结果包括每秒事务数, 锁错误数,
+  事务耗时的p50/p99(秒).
+  """
+  seed = random.randrange(1 << 30) if seed is None else seed
+  results = {}
+  for name, profile in (('default', None), ('tuned', pragmas)):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'bench.sqlite')
+      _bench_setup(path)
+      tasks = [(path, profile, seconds, write_ratio, seed + i)
+               for i in range(processes)]
+      with ProcessPoolExecutor(max_workers=processes) as executor:
+        rows = list(executor.map(_bench_worker, tasks))
+    durations = sorted(d for _, _, ds in rows for d in ds)
+    ops = sum(row[0] for row in rows)
+    results[name] = {
+        'ops': ops,
+        'ops_per_second': ops / seconds,
+        'errors': sum(row[1] for row in rows),
+        'p50': percentile(durations, 0.5),
+        'p99': percentile(durations, 0.99),
+    }
+  return results
@@ -20,12 +20,120 @@ class Config:
     APP_MAIL_SUBJECT_PREFIX = '[example_app]'
     APP_MAIL_SENDER = 'Admin <example_app@example.com>'
     APP_ADMIN = os.environ.get('APP_ADMIN')
+    # 邮件发送: smtp, file(写入APP_MAIL_FILE_DIR), debug(写日志)
+    APP_MAIL_BACKEND = os.environ.get('APP_MAIL_BACKEND') or 'smtp'
+    APP_MAIL_FILE_DIR = os.environ.get('APP_MAIL_FILE_DIR') or \
+        os.path.join(basedir, 'tmp', 'mail')
+    # 队列长度, 队列满时等待的秒数
+    APP_MAIL_QUEUE_SIZE = 1000
+    APP_MAIL_ENQUEUE_TIMEOUT = 1
+    # 工作线程数, 每批发送的邮件数, 连接空闲多久后关闭(秒)
+    APP_MAIL_WORKERS = 2
+    APP_MAIL_BATCH_SIZE = 20
+    APP_MAIL_IDLE_TIMEOUT = 30
+    # 失败重试次数, 第一次重试的等待秒数(之后每次加倍)
+    APP_MAIL_MAX_RETRIES = 3
+    APP_MAIL_RETRY_DELAY = 5
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    # 记录查询
-    SQLALCHEMY_RECORD_QUERIES = True
-    # 数据库慢查询时间
+    # 不保存每个查询, 由APP_QUERY_RECORDER聚合统计
+    SQLALCHEMY_RECORD_QUERIES = False
+    # 只读副本: 设置后GET请求的读使用副本, 写入使用主库(见app/replicas.py)
+    APP_DB_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    SQLALCHEMY_BINDS = {'replica': APP_DB_REPLICA_URL} \
+        if APP_DB_REPLICA_URL else {}
+    # 客户端提交写入后多少秒内读主库(读自己的写; 时间保存在会话或
+    # X-DB-Last-Write请求头中)
+    APP_DB_REPLICA_STICKY = 10
+    # 副本检查间隔(秒), 复制延迟超过多少秒时回退到主库
+    APP_DB_REPLICA_CHECK_INTERVAL = 5
+    APP_DB_REPLICA_MAX_LAG = 5
+    # SQLite: 连接时设置的pragmas(见app/sqlite.py), 默认只在生产配置中启用
+    APP_SQLITE_TUNING = os.environ.get(
+        'APP_SQLITE_TUNING', 'false').lower() in ['true', '1', 'on']
+    APP_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # 毫秒
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # 负数: KiB
+        'temp_store': 'MEMORY',
+    }
+    # 请求计时: 各阶段耗时, 每个端点的直方图(/metrics), Server-Timing响应头
+    APP_METRICS = os.environ.get(
+        'APP_METRICS', 'true').lower() in ['true', '1', 'on']
+    APP_SERVER_TIMING = os.environ.get(
+        'APP_SERVER_TIMING', 'true').lower() in ['true', '1', 'on']
+    # 多进程(gunicorn): 每个进程每多少秒把指标写到目录中, /metrics合并;
+    # 多久没有更新的文件(进程已退出)合并到归档文件后删除(秒)
+    APP_METRICS_DIR = os.environ.get('APP_METRICS_DIR')
+    APP_METRICS_FLUSH_INTERVAL = 10
+    APP_METRICS_MAX_AGE = 3600
+    # /metrics需要的令牌(Authorization: Bearer), 空则不需要;
+    # APP_METRICS_REQUIRE_TOKEN: 没有设置令牌时拒绝所有请求
+    APP_METRICS_TOKEN = os.environ.get('APP_METRICS_TOKEN')
+    APP_METRICS_REQUIRE_TOKEN = False
+    # 采样分析器(/debug/profile, flask profile --sample): 每秒采样次数,
+    # 默认/最长运行秒数, 每个端点最多保留的不同栈数, 折叠栈文件的目录
+    APP_PROFILE_HZ = 100
+    APP_PROFILE_SECONDS = 60
+    APP_PROFILE_MAX_SECONDS = 600
+    APP_PROFILE_MAX_STACKS = 5000
+    APP_PROFILE_DIR = os.environ.get('APP_PROFILE_DIR') or \
+        os.path.join(basedir, 'tmp', 'profiles')
+    # 数据库慢查询时间(秒), 超过时写日志
     APP_SLOW_DB_QUERY_TIME = 0.5
+    # 查询统计: 按(端点, SQL指纹)聚合, 见/debug/queries
+    APP_QUERY_RECORDER = os.environ.get(
+        'APP_QUERY_RECORDER', 'true').lower() in ['true', '1', 'on']
+    # 每个指纹保留的最近耗时数(计算p50/p99), 最多统计的指纹数
+    APP_QUERY_SAMPLE_SIZE = 256
+    APP_QUERY_MAX_FINGERPRINTS = 2000
+    # 一个请求中同一SELECT执行达到此次数时标记为N+1
+    APP_QUERY_N_PLUS_ONE = 5
+    # 超过视图的查询预算(@query_budget)时抛出异常, 否则只写日志
+    APP_QUERY_BUDGET_STRICT = False
+
+    # 密码哈希: 方法和成本(登录成功时把旧的哈希升级到它),
+    # 同时进行的哈希上限(超过时返回503), 是否在进程池中计算, 进程数,
+    # 等待结果的秒数
+    APP_PASSWORD_METHOD = os.environ.get('APP_PASSWORD_METHOD') or \
+        'scrypt:32768:8:1'
+    APP_PASSWORD_MAX_PENDING = int(
+        os.environ.get('APP_PASSWORD_MAX_PENDING') or 8)
+    APP_PASSWORD_OFFLOAD = os.environ.get(
+        'APP_PASSWORD_OFFLOAD', 'false').lower() in ['true', '1', 'on']
+    APP_PASSWORD_WORKERS = 2
+    APP_PASSWORD_TIMEOUT = 10
+
+    # API令牌的最长有效期(秒)
+    APP_AUTH_TOKEN_MAX_AGE = 24 * 3600
+    # 已验证令牌的缓存: 条目数, 时间(秒, 不超过令牌剩余有效期)
+    APP_AUTH_TOKEN_CACHE_SIZE = 10000
+    APP_AUTH_TOKEN_CACHE_TTL = 300
+    # Basic认证成功结果的缓存时间(秒), 0表示不缓存. 修改密码后本进程立即
+    # 失效, 其他worker最多在这段时间内仍接受旧密码
+    APP_AUTH_BASIC_CACHE_TTL = 60
+
+    # 用户最后访问时间: 同一用户每多少秒最多写一次,
+    # 后台批量写入的间隔(秒, 0表示在请求结束时写入)
+    APP_LAST_SEEN_RESOLUTION = 60
+    APP_LAST_SEEN_FLUSH_INTERVAL = 10
+
+    # API响应缓存: 序列化后的JSON条目数, 时间(秒)
+    APP_API_CACHE_SIZE = 1000
+    APP_API_CACHE_TTL = 300
+
+    # 模板片段缓存的内存上限(字节), 0表示不缓存
+    APP_FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+    # 当前用户(load_user)的缓存: 条目数, 时间(秒): 本进程提交的修改立即
+    # 失效, 其他进程最多延迟这么久
+    APP_USER_CACHE_SIZE = 10000
+    APP_USER_CACHE_TTL = 30
+
+    # 角色缓存时间(秒): 本进程提交的修改立即失效, 其他进程最多延迟这么久
+    APP_ROLE_CACHE_TTL = 60
 
     # 帖子分页大小
     APP_POSTS_PER_PAGE = 10
@@ -33,6 +141,33 @@ class Config:
     APP_COMMENTS_PER_PAGE = 10
     # 关注人分页大小
     APP_FOLLOWERS_PERPAGE = 10
+    # 分页总数的缓存时间(秒), 0表示每次查询; 每个进程最多缓存的查询数
+    APP_PAGINATION_COUNT_TTL = 60
+    APP_PAGINATION_COUNT_CACHE_SIZE = 10000
+    # 批量审核: 每批UPDATE的评论数, API一次最多接受的id数
+    APP_MODERATION_BATCH_SIZE = 500
+    APP_MODERATION_MAX_IDS = 10000
+    # 导出: 服务器端游标每批读取的行数, 响应块的大小(字节)
+    APP_EXPORT_BATCH_SIZE = 1000
+    APP_EXPORT_CHUNK_BYTES = 64 * 1024
+    # 全文搜索: 一次查询最多使用的词数
+    APP_SEARCH_MAX_TERMS = 8
+    # 全文搜索: 最多返回的结果数(按相关性排序的前n个), 0表示不限制
+    APP_SEARCH_MAX_CANDIDATES = 1000
+
+    # Markdown渲染缓存: 进程内LRU条目数, 磁盘缓存目录(空则不用)
+    APP_RENDER_CACHE_SIZE = 4096
+    APP_RENDER_CACHE_DIR = os.environ.get('APP_RENDER_CACHE_DIR')
+    # 在进程池中渲染, 提交后回写body_html
+    APP_RENDER_OFFLOAD = os.environ.get(
+        'APP_RENDER_OFFLOAD', 'false').lower() in ['true', '1', 'on']
+    APP_RENDER_WORKERS = 2
+
+    # 时间线: 关注者超过此数的作者不扇出写, 改为读时查询
+    APP_TIMELINE_FANOUT_LIMIT = int(
+        os.environ.get('APP_TIMELINE_FANOUT_LIMIT') or 1000)
+    # 时间线: 新关注/重建时每个时间线填充的最近帖子数
+    APP_TIMELINE_LENGTH = 800
 
     @staticmethod
     def init_app(app):
@@ -49,6 +184,9 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    # 不启动后台线程, 请求结束时写入
+    APP_LAST_SEEN_FLUSH_INTERVAL = 0
+    APP_QUERY_BUDGET_STRICT = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
 
@@ -72,6 +210,19 @@ class TestingConfig(Config):
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    APP_SQLITE_TUNING = os.environ.get(
+        'APP_SQLITE_TUNING', 'true').lower() in ['true', '1', 'on']
+    APP_METRICS_DIR = os.environ.get('APP_METRICS_DIR') or \
+        os.path.join(basedir, 'tmp', 'metrics')
+    APP_METRICS_REQUIRE_TOKEN = True
+    # 每个gunicorn进程(同步worker)的连接池: 连接保留pragmas和页缓存,
+    # 等待连接不超过busy_timeout太多
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 4,
+        'max_overflow': 4,
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+    }
 
     @classmethod
     def init_app(cls, app):
@@ -1,7 +1,8 @@
 from flask_login import login_required
 from flask_migrate import Migrate, upgrade
-from app.models import Comment, Follow, Permission, Post, User, Role
+from app.models import Comment, Follow, Permission, Post, User, Role, TimelineEntry
 from app import create_app, db, main
+from app.search import include_name as search_tables
 import os
 import click
 import sys
@@ -24,14 +25,14 @@ def secret():
   return "只有登录用户才能访问的秘密页面！"
 
 
-# 数据迁移扩展
-migrate = Migrate(app, db)
+# 数据迁移扩展(FTS5表由迁移手动维护, 自动生成时忽略)
+migrate = Migrate(app, db, include_name=search_tables)
 
 
 @app.shell_context_processor  # flash shell上下文处理器
 def make_shell_context():
   return dict(db=db, User=User, Follow=Follow, Role=Role, Permission=Permission,
-              Post=Post, Comment=Comment)
+              Post=Post, Comment=Comment, TimelineEntry=TimelineEntry)
 
 
 @app.cli.command()  # unit test launcher command: flask test
@@ -70,18 +71,379 @@ def deploy():
   Role.insert_roles()
 
 
+@app.cli.command()
+@click.option('--users', default=1000, help='Number of users.')
+@click.option('--posts', default=10000, help='Number of posts.')
+@click.option('--comments', default=10000, help='Number of comments.')
+@click.option('--follows', default=10,
+              help='Average number of users each user follows.')
+@click.option('--batch-size', default=5000, help='Rows per INSERT batch.')
+@click.option('--processes', default=None, type=int,
+              help='Generator processes (default: CPU count).')
+@click.option('--alpha', default=1.0,
+              help='Power-law exponent of authors, commenters and follows.')
+@click.option('--seed', default=None, type=int, help='Random seed.')
+def fake(users, posts, comments, follows, batch_size, processes, alpha,
+         seed):
+  """Bulk-insert fake users, posts, comments and follows."""
+  from app import fake as fake_data
+  counts = fake_data.bulk(users=users, posts=posts, comments=comments,
+                          follows=follows, batch_size=batch_size,
+                          processes=processes, alpha=alpha, seed=seed)
+  print('Inserted %s.' % ', '.join('%d %s' % (count, name)
+                                   for name, count in counts.items()))
+  print("Run 'flask timeline backfill' to build the timelines.")
+
+
+@app.cli.command()
+def recount():
+  """Rebuild the denormalized post/comment/follow counters."""
+  User.recount()
+  Post.recount()
+  print('Counters rebuilt.')
+
+
+@app.cli.command()
+@click.option('--batch-size', default=500, help='Rows per UPDATE batch.')
+@click.option('--only-missing', is_flag=True,
+              help='Only render rows without body_html.')
+@click.option('--parallel/--no-parallel', default=True,
+              help='Render in the worker process pool.')
+def rerender(batch_size, only_missing, parallel):
+  """Re-render body_html of all posts and comments."""
+  from app import renderer
+  try:
+    for model in (Post, Comment):
+      count = renderer.rerender(model, batch_size=batch_size,
+                                only_missing=only_missing, parallel=parallel)
+      print('Rendered %d %s.' % (count, model.__tablename__))
+  finally:
+    renderer.shutdown()
+
+
+@app.cli.group()
+def timeline():
+  """Maintain the materialized follow timelines."""
+  pass
+
+
+@timeline.command()
+@click.option('--user-id', 'user_ids', type=int, multiple=True,
+              help='Only rebuild the timelines of these users.')
+def backfill(user_ids):
+  """Rebuild timelines from the follow graph."""
+  count = TimelineEntry.rebuild(list(user_ids) or None)
+  print('Rebuilt %d timelines.' % count)
+
+
+@timeline.command()
+def repair():
+  """Recompute fan-out-on-read authors and fix affected timelines."""
+  changed, rebuilt = TimelineEntry.repair()
+  print('%d authors switched fan-out mode, rebuilt %d timelines.'
+        % (changed, rebuilt))
+
+
+@app.cli.command('export')
+@click.argument('username')
+@click.option('--type', 'type_', default='posts',
+              type=click.Choice(['posts', 'comments']), help='Rows to export.')
+@click.option('--after', default=0, help='Resume after this id.')
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help='Output file (default: stdout).')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output.')
+def export_user(username, type_, after, output, compress):
+  """Stream a user's posts or comments as NDJSON."""
+  from app.export import export
+  user = User.query.filter_by(username=username).first()
+  if user is None:
+    sys.exit('Unknown user %s.' % username)
+  # url_for需要请求上下文: 生成相对URL, 与API相同
+  with app.test_request_context():
+    for chunk in export(type_, user.id, after, compress):
+      output.write(chunk)
+
+
+@app.cli.group()
+def hashing():
+  """Password hashing service."""
+  pass
+
+
+@hashing.command('bench')
+@click.option('--concurrency', default=16, help='Concurrent login attempts.')
+@click.option('--seconds', default=5.0, help='Duration of each run.')
+@click.option('--workers', default=None, type=int,
+              help='Process pool size (default: APP_PASSWORD_WORKERS).')
+def hashing_bench(concurrency, seconds, workers):
+  """Login throughput and latency: inline hashing vs the bounded pool."""
+  from app.hashing import PasswordHasher, benchmark
+  config = app.config
+  workers = workers or config['APP_PASSWORD_WORKERS']
+  profiles = (
+      ('inline', dict(offload=False, max_pending=None)),
+      ('pool', dict(offload=True, workers=workers,
+                    max_pending=config['APP_PASSWORD_MAX_PENDING'])),
+  )
+  print('%-8s %8s %8s %8s %8s %8s %10s' % (
+      'profile', 'ok', 'rejected', 'ok/s', 'p50 ms', 'p99 ms',
+      'reject ms'))
+  for name, kwargs in profiles:
+    hasher = PasswordHasher()
+    hasher.configure(config['APP_PASSWORD_METHOD'],
+                     timeout=config['APP_PASSWORD_TIMEOUT'], **kwargs)
+    r = benchmark(hasher, concurrency, seconds)
+    hasher.shutdown()
+    print('%-8s %8d %8d %8.1f %8.1f %8.1f %10.2f' % (
+        name, r['verified'], r['rejected'], r['per_second'],
+        (r['p50'] or 0) * 1000, (r['p99'] or 0) * 1000,
+        (r['rejected_p99'] or 0) * 1000))
+
+
+@app.cli.group()
+def search():
+  """Maintain the full-text search indexes."""
+  pass
+
+
+@search.command()
+@click.option('--optimize/--no-optimize', default=True,
+              help='Merge the index segments after rebuilding.')
+def reindex(optimize):
+  """Create missing FTS5 tables/triggers and rebuild them from the bodies."""
+  from app.search import reindex as rebuild
+  for model in (Post, Comment):
+    count = rebuild(model, optimize=optimize)
+    print('Indexed %d %s.' % (count, model.__tablename__))
+
+
+@app.cli.group()
+def sqlite():
+  """SQLite production tuning."""
+  pass
+
+
+@sqlite.command()
+def check():
+  """Show the pragmas in effect on a pooled connection."""
+  names = list(app.config['APP_SQLITE_PRAGMAS'])
+  tuning = app.extensions['sqlite']
+  if not tuning.engines:
+    print('APP_SQLITE_TUNING is disabled, showing defaults.')
+  for name, value in tuning.pragmas(db.engine, names).items():
+    print('%-14s %s' % (name, value))
+
+
+@sqlite.command('bench')
+@click.option('--processes', default=4, help='Concurrent processes.')
+@click.option('--seconds', default=5.0, help='Duration of each run.')
+@click.option('--writes', default=0.2,
+              help='Fraction of transactions that update a row.')
+@click.option('--seed', default=None, type=int, help='Random seed.')
+def sqlite_bench(processes, seconds, writes, seed):
+  """Compare multi-process throughput with and without the pragmas."""
+  from app.sqlite import benchmark
+  results = benchmark(app.config['APP_SQLITE_PRAGMAS'], processes=processes,
+                      seconds=seconds, write_ratio=writes, seed=seed)
+  print('%-8s %8s %8s %8s %8s' % ('profile', 'tx/s', 'locked', 'p50 ms',
+                                   'p99 ms'))
+  for name, r in results.items():
+    print('%-8s %8.0f %8d %8.2f %8.2f' % (
+        name, r['ops_per_second'], r['errors'], (r['p50'] or 0) * 1000,
+        (r['p99'] or 0) * 1000))
+
+
+@app.cli.group()
+def loadtest():
+  """Load testing against a local gunicorn."""
+  pass
+
+
+@loadtest.command('seed')
+@click.option('--size', default='small',
+              type=click.Choice(['small', 'medium', 'large']),
+              help='Dataset preset.')
+@click.option('--users', default=None, type=int, help='Override: users.')
+@click.option('--posts', default=None, type=int, help='Override: posts.')
+@click.option('--comments', default=None, type=int,
+              help='Override: comments.')
+@click.option('--follows', default=None, type=int,
+              help='Override: average follows per user.')
+@click.option('--seed', 'seed_', default=0, help='Random seed.')
+def loadtest_seed(size, users, posts, comments, follows, seed_):
+  """Insert a dataset for load testing (every password is "password")."""
+  from app.loadtest import seed
+  counts = seed(size, users=users, posts=posts, comments=comments,
+                follows=follows, seed=seed_)
+  print('Inserted %s.' % ', '.join('%d %s' % (count, name)
+                                   for name, count in counts.items()))
+
+
+@loadtest.command('run')
+@click.option('--url', default=None,
+              help='Test a running server instead of starting gunicorn.')
+@click.option('--workers', default=4, help='gunicorn workers.')
+@click.option('--clients', default=16, help='Concurrent clients.')
+@click.option('--seconds', default=30.0, help='Measured duration.')
+@click.option('--warmup', default=5.0, help='Unmeasured warm-up duration.')
+@click.option('--mix', default=None,
+              help='Scenario weights, e.g. browse=50,api=25,post=5,'
+                   'comment=10,follow=10.')
+@click.option('--think', default=0.0,
+              help='Mean think time between scenarios (seconds).')
+@click.option('--seed', 'seed_', default=0, help='Random seed.')
+@click.option('-o', '--output', default=None, type=click.Path(),
+              help='Save the results as JSON.')
+def loadtest_run(url, workers, clients, seconds, warmup, mix, think, seed_,
+                 output):
+  """Drive a scenario mix and report RPS and latency per endpoint."""
+  import contextlib
+  import json
+  from app import loadtest as lt
+  try:
+    mix = lt.parse_mix(mix) if mix else lt.MIX
+  except ValueError as e:
+    raise click.BadParameter(str(e), param_hint='--mix')
+  data = lt.dataset(limit=max(clients * 10, 1000), seed=seed_)
+  if not data['users'] or not data['posts']:
+    sys.exit("No users or posts: run 'flask loadtest seed' first.")
+  db.session.remove()
+  server = contextlib.nullcontext(url) if url else \
+      lt.server(workers, cwd=os.path.dirname(os.path.abspath(__file__)))
+  with server as target:
+    print('%d clients, %.0fs warm-up, %.0fs measured against %s' % (
+        clients, warmup, seconds, target))
+    results = lt.run(target, data, clients=clients, seconds=seconds,
+                     warmup=warmup, mix=mix, think=think, seed=seed_)
+  results.update(lt.environment())
+  results['options'] = {'url': url, 'workers': None if url else workers,
+                        'clients': clients, 'seconds': seconds,
+                        'warmup': warmup, 'mix': mix, 'think': think,
+                        'seed': seed_}
+  results['dataset'] = data['counts']
+
+  print('%-36s %7s %7s %7s %8s %8s %8s' % (
+      'endpoint', 'req', 'errors', 'rps', 'p50 ms', 'p90 ms', 'p99 ms'))
+  rows = list(results['endpoints'].items()) + [('total', results['total'])]
+  for label, r in rows:
+    print('%-36s %7d %7d %7.1f %8.1f %8.1f %8.1f' % (
+        label[:36], r['requests'], r['errors'], r['rps'],
+        (r['p50'] or 0) * 1000, (r['p90'] or 0) * 1000,
+        (r['p99'] or 0) * 1000))
+  if output:
+    with open(output, 'w') as f:
+      json.dump(results, f, indent=2)
+    print('Saved %s' % output)
+
+
+@loadtest.command('compare')
+@click.argument('base', type=click.File())
+@click.argument('new', type=click.File())
+@click.option('--threshold', default=0.1,
+              help='Relative change in RPS, p99 or error rate counted as a '
+              'regression.')
+def loadtest_compare(base, new, threshold):
+  """Compare two saved results; exit with 1 on regressions."""
+  import json
+  from app.loadtest import compare, error_rate
+  base, new = json.load(base), json.load(new)
+  print('base %s, new %s' % (base.get('commit'), new.get('commit')))
+  rows, regressed = compare(base, new, threshold)
+  print('%-36s %8s %8s %8s %8s %8s %8s %8s' % (
+      'endpoint', 'base rps', 'new rps', 'base p99', 'new p99', 'base err',
+      'new err', ''))
+
+  def fmt(r, key, scale=1):
+    return '%8.1f' % (r[key] * scale) if r and r[key] is not None \
+        else '%8s' % '-'
+
+  def fmt_errors(r):
+    return '%7.1f%%' % (error_rate(r) * 100) if r else '%8s' % '-'
+  for label, a, b, worse in rows:
+    print('%-36s %s %s %s %s %s %s %8s' % (
+        label[:36], fmt(a, 'rps'), fmt(b, 'rps'), fmt(a, 'p99', 1000),
+        fmt(b, 'p99', 1000), fmt_errors(a), fmt_errors(b),
+        'WORSE' if worse else ''))
+  if regressed:
+    sys.exit(1)
+
+
+@app.cli.command()
+@click.argument('paths', nargs=-1)
+@click.option('--repeat', default=1, help='Requests per path.')
+@click.option('--user', 'email', default=None,
+              help='Email of the user to log in as.')
+@click.option('--sort', default='total',
+              type=click.Choice(['total', 'count', 'p50', 'p99', 'max',
+                                 'n_plus_one']),
+              help='Sort key.')
+@click.option('--limit', default=20, help='Number of fingerprints to show.')
+@click.option('--n-plus-one', is_flag=True,
+              help='Only show fingerprints flagged as N+1.')
+@click.option('--json', 'as_json', is_flag=True, help='Dump as JSON.')
+def queries(paths, repeat, email, sort, limit, n_plus_one, as_json):
+  """Request PATHS and dump the per-endpoint query statistics."""
+  from app.queries import abbreviate
+  recorder = app.extensions['queries']
+  if not recorder.enabled:
+    sys.exit('APP_QUERY_RECORDER is disabled.')
+  client = app.test_client()
+  if email:
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+      sys.exit('Unknown user %s.' % email)
+    with client.session_transaction() as session:
+      session['_user_id'] = str(user.id)
+      session['_fresh'] = True
+  for path in paths:
+    for _ in range(repeat):
+      response = client.get(path)
+      if response.status_code >= 400:
+        print('%s: %d' % (path, response.status_code), file=sys.stderr)
+  items = recorder.snapshot(sort=sort, limit=limit, n_plus_one=n_plus_one)
+  if as_json:
+    import json
+    print(json.dumps({'summary': recorder.summary(), 'queries': items},
+                     indent=2))
+    return
+  print('%(requests)d requests, %(queries)d queries, '
+        '%(fingerprints)d fingerprints' % recorder.summary())
+  print('%-24s %6s %8s %8s %9s %5s  %s' % (
+      'endpoint', 'count', 'p50 ms', 'p99 ms', 'total ms', 'N+1',
+      'fingerprint'))
+  for item in items:
+    print('%-24s %6d %8.2f %8.2f %9.2f %5s  %s' % (
+        item['endpoint'][:24], item['count'], item['p50'] * 1000,
+        item['p99'] * 1000, item['total'] * 1000,
+        item['max_repeat'] if item['n_plus_one'] else '',
+        abbreviate(item['fingerprint'])))
+
+
 @app.cli.command()
 @click.option('--length', default=25,
               help='Number of functions to include in the profiler report.')
 @click.option('--profile-dir', default=None,
               help='Directory where profiler data files are saved.')
+@click.option('--sample', is_flag=True,
+              help='Use the sampling profiler and write folded stacks per '
+                   'endpoint instead of cProfile.')
+@click.option('--hz', default=None, type=int,
+              help='Samples per second (default APP_PROFILE_HZ).')
 # profile
-def profile(length, profile_dir):
+def profile(length, profile_dir, sample, hz):
   """Start the application under the code profiler."""
-  # https://werkzeug.palletsprojects.com/en/stable/middleware/profiler/
-  from werkzeug.middleware.profiler import ProfilerMiddleware
-  app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[length],
-                                    profile_dir=profile_dir)
+  profiler = None
+  if sample:
+    # 采样: 停止(Ctrl-C)时写<端点>.<pid>.folded, 用flamegraph.pl等生成火焰图
+    profiler = app.extensions['profiler']
+    if profile_dir:
+      profiler.directory = profile_dir
+    profiler.start(hz=hz)
+  else:
+    # https://werkzeug.palletsprojects.com/en/stable/middleware/profiler/
+    from werkzeug.middleware.profiler import ProfilerMiddleware
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[length],
+                                      profile_dir=profile_dir)
 
   # WARNING
   # Ignoring a call to 'app.run()' that would block the current 'flask' CLI command.
@@ -89,3 +451,7 @@ def profile(length, profile_dir):
   # https://github.com/pallets/flask/issues/2776
   del os.environ["FLASK_RUN_FROM_CLI"]
   app.run(port=15000)
+
+  if profiler is not None:
+    for path in profiler.stop():
+      print('Wrote %s' % path)
@@ -0,0 +1,58 @@
+"""empty message
+
+Revision ID: 553093a4bc35
+Revises: d8b539770831
+Create Date: 2026-10-18 20:49:48.361550
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '553093a4bc35'
+down_revision = 'd8b539770831'
+branch_labels = None
+depends_on = None
+
+
+# FTS5全文索引(外部内容表)和同步触发器, 与app/search.py一致
+TABLES = {'posts': 'posts_fts', 'comments': 'comments_fts'}
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table, fts in TABLES.items():
+        op.execute(
+            "CREATE VIRTUAL TABLE {fts} USING fts5("
+            "body, content='{table}', content_rowid='id', prefix='2 3')"
+            .format(table=table, fts=fts))
+        op.execute(
+            "CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+            "INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END"
+            .format(table=table, fts=fts))
+        op.execute(
+            "CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+            "INSERT INTO {fts}({fts}, rowid, body) "
+            "VALUES ('delete', old.id, old.body); END"
+            .format(table=table, fts=fts))
+        op.execute(
+            "CREATE TRIGGER {fts}_au AFTER UPDATE OF body ON {table} BEGIN "
+            "INSERT INTO {fts}({fts}, rowid, body) "
+            "VALUES ('delete', old.id, old.body); "
+            "INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END"
+            .format(table=table, fts=fts))
+        # 索引已有的行
+        op.execute("INSERT INTO {fts}({fts}) VALUES ('rebuild')"
+                   .format(fts=fts))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for fts in TABLES.values():
+        op.execute('DROP TRIGGER IF EXISTS %s_au' % fts)
+        op.execute('DROP TRIGGER IF EXISTS %s_ad' % fts)
+        op.execute('DROP TRIGGER IF EXISTS %s_ai' % fts)
+        op.execute('DROP TABLE IF EXISTS %s' % fts)
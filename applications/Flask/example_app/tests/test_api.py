@@ -4,6 +4,8 @@ import unittest
 
 from app import create_app, db
 from app.models import User, Role, Post, Comment
+from app.pagination import count_cache
+import gzip
 import json
 import re
 from base64 import b64encode
@@ -159,14 +161,14 @@ class APITestCase(unittest.TestCase):
     self.assertEqual(json_response['posts'][0], json_post)
 
     # get the post from the user as a follower
-    # response = self.client.get(
-    #     '/api/v1/users/{}/timeline/'.format(u.id),
-    #     headers=self.get_api_headers('john@example.com', 'cat'))
-    # self.assertEqual(response.status_code, 200)
-    # json_response = json.loads(response.get_data(as_text=True))
-    # self.assertIsNotNone(json_response.get('posts'))
-    # self.assertEqual(json_response.get('count', 0), 1)
-    # self.assertEqual(json_response['posts'][0], json_post)
+    response = self.client.get(
+        '/api/v1/users/{}/timeline/'.format(u.id),
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    self.assertEqual(response.status_code, 200)
+    json_response = json.loads(response.get_data(as_text=True))
+    self.assertIsNotNone(json_response.get('posts'))
+    self.assertEqual(json_response.get('count', 0), 1)
+    self.assertEqual(json_response['posts'][0], json_post)
 
     # edit post
     response = self.client.put(
@@ -266,3 +268,319 @@ class APITestCase(unittest.TestCase):
     json_response = json.loads(response.get_data(as_text=True))
     self.assertIsNotNone(json_response.get('comments'))
     self.assertEqual(json_response.get('count', 0), 2)
+
+  def test_bulk_moderation(self):
+    r = Role.query.filter_by(name='User').first()
+    m = Role.query.filter_by(name='Moderator').first()
+    u1 = User(email='john@example.com', username='john',
+              password='cat', confirmed=True, role=r)
+    u2 = User(email='susan@example.com', username='susan',
+              password='dog', confirmed=True, role=m)
+    db.session.add_all([u1, u2])
+    post = Post(body='body of the post', author=u1)
+    db.session.add_all([Comment(body='spam %d' % i, author=u1, post=post)
+                        for i in range(7)] +
+                       [Comment(body='ham', author=u2, post=post)])
+    db.session.commit()
+    ids = [c.id for c in Comment.query.order_by(Comment.id)]
+    self.app.config['APP_MODERATION_BATCH_SIZE'] = 3
+
+    # 缓存的评论在审核后失效
+    url = '/api/v1/comments/{}'.format(ids[0])
+    response = self.client.get(
+        url, headers=self.get_api_headers('susan@example.com', 'dog'))
+    etag = response.headers['ETag']
+
+    # 没有权限
+    response = self.client.post(
+        '/api/v1/comments/moderation',
+        headers=self.get_api_headers('john@example.com', 'cat'),
+        data=json.dumps({'disabled': True, 'ids': ids}))
+    self.assertEqual(response.status_code, 403)
+
+    # 按id列表
+    response = self.client.post(
+        '/api/v1/comments/moderation',
+        headers=self.get_api_headers('susan@example.com', 'dog'),
+        data=json.dumps({'disabled': True, 'ids': ids[:2]}))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.get_data(as_text=True))['updated'],
+                     2)
+    response = self.client.get(
+        url, headers=self.get_api_headers('susan@example.com', 'dog'))
+    self.assertNotEqual(response.headers['ETag'], etag)
+
+    # 按作者和时间范围, 已取消的不再计数
+    response = self.client.post(
+        '/api/v1/comments/moderation',
+        headers=self.get_api_headers('susan@example.com', 'dog'),
+        data=json.dumps({'disabled': True, 'author': 'john',
+                         'since': '2000-01-01T00:00:00+00:00'}))
+    self.assertEqual(json.loads(response.get_data(as_text=True))['updated'],
+                     5)
+    self.assertEqual(Comment.query.filter_by(disabled=True).count(), 7)
+
+    # 没有条件, 错误的参数
+    for data in ({'disabled': False}, {'disabled': 'yes', 'ids': ids},
+                 {'disabled': False, 'author': 'nobody'},
+                 {'disabled': False, 'since': 'yesterday'}):
+      response = self.client.post(
+          '/api/v1/comments/moderation',
+          headers=self.get_api_headers('susan@example.com', 'dog'),
+          data=json.dumps(data))
+      self.assertEqual(response.status_code, 400)
+
+  def test_export(self):
+    r = Role.query.filter_by(name='User').first()
+    u = User(email='john@example.com', username='john', password='cat',
+             confirmed=True, role=r)
+    db.session.add(u)
+    db.session.add_all([Post(body='post %d' % i, author=u)
+                        for i in range(25)])
+    db.session.commit()
+    # 小的批和块: 多次读取, 多个块
+    self.app.config['APP_EXPORT_BATCH_SIZE'] = 4
+    self.app.config['APP_EXPORT_CHUNK_BYTES'] = 1000
+
+    url = '/api/v1/users/{}/export'.format(u.id)
+    response = self.client.get(
+        url, headers=self.get_api_headers('john@example.com', 'cat'))
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response.is_streamed)
+    self.assertEqual(response.mimetype, 'application/x-ndjson')
+    items = [json.loads(line) for line in
+             response.get_data(as_text=True).splitlines()]
+    self.assertEqual([item['body'] for item in items],
+                     ['post %d' % i for i in range(25)])
+    self.assertEqual(items[0]['url'],
+                     '/api/v1/posts/{}'.format(items[0]['id']))
+
+    # 从id继续, gzip
+    headers = self.get_api_headers('john@example.com', 'cat')
+    headers['Accept-Encoding'] = 'gzip'
+    response = self.client.get(url + '?after={}'.format(items[19]['id']),
+                               headers=headers)
+    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+    lines = gzip.decompress(response.get_data()).decode('utf-8').splitlines()
+    self.assertEqual([json.loads(line)['id'] for line in lines],
+                     [item['id'] for item in items[20:]])
+
+    response = self.client.get(
+        url + '?type=followers',
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    self.assertEqual(response.status_code, 400)
+
+  def test_cursor_pagination(self):
+    # add a user with some posts
+    r = Role.query.filter_by(name='User').first()
+    u = User(email='john@example.com', password='cat', confirmed=True,
+             role=r)
+    db.session.add(u)
+    db.session.add_all([Post(body='post %d' % i, author=u)
+                        for i in range(25)])
+    db.session.commit()
+
+    # walk forward through all pages
+    urls = []
+    url = '/api/v1/posts/'
+    bodies = []
+    while url:
+      response = self.client.get(
+          url, headers=self.get_api_headers('john@example.com', 'cat'))
+      self.assertEqual(response.status_code, 200)
+      json_response = json.loads(response.get_data(as_text=True))
+      self.assertEqual(json_response['count'], 25)
+      bodies.extend(post['body'] for post in json_response['posts'])
+      urls.append(url)
+      url = json_response['next']
+    self.assertEqual(len(urls), 3)
+    self.assertEqual(bodies, ['post %d' % i for i in reversed(range(25))])
+
+    # walk back from the last page
+    response = self.client.get(
+        urls[-1], headers=self.get_api_headers('john@example.com', 'cat'))
+    json_response = json.loads(response.get_data(as_text=True))
+    response = self.client.get(
+        json_response['prev'],
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    json_response = json.loads(response.get_data(as_text=True))
+    self.assertEqual([post['body'] for post in json_response['posts']],
+                     bodies[10:20])
+    self.assertIsNotNone(json_response['next'])
+
+    # page numbers still work
+    response = self.client.get(
+        '/api/v1/posts/?page=3',
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    json_response = json.loads(response.get_data(as_text=True))
+    self.assertEqual([post['body'] for post in json_response['posts']],
+                     bodies[20:])
+    self.assertIsNone(json_response['next'])
+
+    # bad cursor
+    response = self.client.get(
+        '/api/v1/posts/?cursor=garbage',
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    self.assertEqual(response.status_code, 400)
+
+    # 总数缓存的条目数有上限
+    cache = count_cache()
+    cache.cache.maxsize = 2
+    for i in range(5):
+      cache.get(Post.query.filter(Post.id > i), 60)
+    self.assertEqual(len(cache.cache), 2)
+    self.assertEqual(cache.get(Post.query.filter(Post.id > 4), 60),
+                     Post.query.filter(Post.id > 4).count())
+
+  def test_post_list_serialization_queries(self):
+    # add a user with commented posts
+    r = Role.query.filter_by(name='User').first()
+    u = User(email='john@example.com', password='cat', confirmed=True,
+             role=r)
+    db.session.add(u)
+    posts = [Post(body='post %d' % i, author=u) for i in range(10)]
+    db.session.add_all(posts)
+    db.session.add_all([Comment(body='comment', author=u, post=p)
+                        for p in posts[:3]])
+    db.session.commit()
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+      statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+      response = self.client.get(
+          '/api/v1/posts/',
+          headers=self.get_api_headers('john@example.com', 'cat'))
+    finally:
+      db.event.remove(db.engine, 'before_cursor_execute', record)
+    self.assertEqual(response.status_code, 200)
+    json_response = json.loads(response.get_data(as_text=True))
+    self.assertEqual(sorted(p['comment_count']
+                            for p in json_response['posts']),
+                     [0] * 7 + [1] * 3)
+    # comment counts come from the posts.comment_count counter
+    self.assertEqual(
+        len([s for s in statements if 'FROM comments' in s]), 0)
+
+  def test_token_expiration(self):
+    # add a user
+    r = Role.query.filter_by(name='User').first()
+    u = User(email='john@example.com', password='cat', confirmed=True,
+             role=r)
+    db.session.add(u)
+    db.session.commit()
+
+    # tokens carry their own expiration
+    token = u.generate_auth_token(expiration=3600)
+    self.assertEqual(User.verify_auth_token(token), u)
+    token = u.generate_auth_token(expiration=-1)
+    self.assertIsNone(User.verify_auth_token(token))
+    response = self.client.get(
+        '/api/v1/posts/', headers=self.get_api_headers(token, ''))
+    self.assertEqual(response.status_code, 401)
+
+  def test_auth_cache(self):
+    # add a user
+    r = Role.query.filter_by(name='User').first()
+    u = User(email='john@example.com', password='cat', confirmed=True,
+             role=r)
+    db.session.add(u)
+    db.session.commit()
+    token = u.generate_auth_token(expiration=3600)
+
+    for _ in range(3):
+      response = self.client.get(
+          '/api/v1/posts/', headers=self.get_api_headers(token, ''))
+      self.assertEqual(response.status_code, 200)
+      response = self.client.get(
+          '/api/v1/posts/',
+          headers=self.get_api_headers('john@example.com', 'cat'))
+      self.assertEqual(response.status_code, 200)
+    caches = self.app.extensions['auth_caches']
+    self.assertEqual(caches['token'].stats()['hits'], 2)
+    self.assertEqual(caches['basic'].stats()['hits'], 2)
+
+    # a flushed but rolled back change keeps the cached credentials
+    u.password = 'dog'
+    db.session.flush()
+    db.session.rollback()
+    response = self.client.get(
+        '/api/v1/posts/',
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(caches['basic'].stats()['hits'], 3)
+
+    # changing the password drops the cached credentials
+    u.password = 'dog'
+    db.session.commit()
+    response = self.client.get(
+        '/api/v1/posts/',
+        headers=self.get_api_headers('john@example.com', 'cat'))
+    self.assertEqual(response.status_code, 401)
+
+    # unconfirming the account drops the cached token
+    u.confirmed = False
+    db.session.commit()
+    response = self.client.get(
+        '/api/v1/posts/', headers=self.get_api_headers(token, ''))
+    self.assertEqual(response.status_code, 403)
+
+  def test_conditional_get(self):
+    r = Role.query.filter_by(name='User').first()
+    u = User(email='john@example.com', password='cat', confirmed=True,
+             role=r)
+    db.session.add(u)
+    db.session.commit()
+    headers = self.get_api_headers('john@example.com', 'cat')
+    response = self.client.post('/api/v1/posts/', headers=headers,
+                                data=json.dumps({'body': 'body'}))
+    self.assertEqual(response.status_code, 201)
+    url = response.headers.get('Location')
+
+    for path in ('/api/v1/posts/', url):
+      response = self.client.get(path, headers=headers)
+      self.assertEqual(response.status_code, 200)
+      etag = response.headers.get('ETag')
+      self.assertIsNotNone(etag)
+      self.assertIn('no-cache', response.headers.get('Cache-Control'))
+      # 未修改: 304, 没有内容
+      response = self.client.get(
+          path, headers=dict(headers, **{'If-None-Match': etag}))
+      self.assertEqual(response.status_code, 304)
+      self.assertEqual(response.get_data(), b'')
+
+    # 第二次请求使用缓存的JSON
+    cache = self.app.extensions['api_response_cache']
+    hits = cache.hits
+    response = self.client.get('/api/v1/posts/', headers=headers)
+    self.assertEqual(cache.hits, hits + 1)
+    self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 1)
+
+    # 修改帖子: 版本增加, ETag改变, 缓存条目失效
+    response = self.client.get(url, headers=headers)
+    etag = response.headers.get('ETag')
+    size = len(cache)
+    response = self.client.put(url, headers=headers,
+                               data=json.dumps({'body': 'updated'}))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(len(cache), size - 2)
+    response = self.client.get(
+        url, headers=dict(headers, **{'If-None-Match': etag}))
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response.headers.get('ETag'), etag)
+    self.assertEqual(
+        json.loads(response.get_data(as_text=True))['body'], 'updated')
+    self.assertEqual(Post.query.first().version, 2)
+
+    # 新评论改变帖子的评论数
+    etag = response.headers.get('ETag')
+    response = self.client.post(url + '/comments/', headers=headers,
+                                data=json.dumps({'body': 'comment'}))
+    self.assertEqual(response.status_code, 201)
+    response = self.client.get(
+        url, headers=dict(headers, **{'If-None-Match': etag}))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(
+        json.loads(response.get_data(as_text=True))['comment_count'], 1)
@@ -1,8 +1,12 @@
 # Flask Test Client
 
 import unittest
+from flask import g
 from app import create_app, db
-from app.models import User, Role
+from app.decorators import query_budget
+from app.exceptions import QueryBudgetExceeded
+from app.fragments import FragmentStore
+from app.models import User, Role, Post, Comment
 import re
 
 
@@ -63,3 +67,201 @@ class FlaskClientTestCase(unittest.TestCase):
     self.assertEqual(response.status_code, 200)
     self.assertTrue(
         'You have been logged out' in response.get_data(as_text=True))
+
+  def test_query_budgets(self):
+    admin = Role.query.filter_by(name='Administrator').first()
+    me = User(email='john@example.com', username='john', password='cat',
+              confirmed=True, role=admin)
+    users = [User(email='u%d@example.com' % i, username='u%d' % i,
+                  password='cat', confirmed=True) for i in range(10)]
+    db.session.add_all([me] + users)
+    db.session.commit()
+    for i, u in enumerate(users):
+      post = Post(body='post %d' % i, author=u)
+      db.session.add(post)
+      db.session.add_all([Comment(body='comment', author=v, post=post)
+                          for v in users])
+      if i % 2:
+        me.follow(u)
+    db.session.commit()
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+
+    # 每行的作者不再单独查询: 超过@query_budget时抛出QueryBudgetExceeded
+    for path in ('/', '/user/u1', '/post/%d' % post.id, '/moderate'):
+      db.session.expunge_all()
+      response = self.client.get(path)
+      self.assertEqual(response.status_code, 200)
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertEqual(data.count('>Following</span>'), 5)
+    data = self.client.get('/user/u9').get_data(as_text=True)
+    self.assertTrue('Unfollow' in data)
+    self.assertTrue('Follows you' not in data)
+
+  def test_followers_page(self):
+    self.app.config['APP_FOLLOWERS_PERPAGE'] = 50
+    me = User(email='john@example.com', username='john', password='cat',
+              confirmed=True)
+    susan = User(email='susan@example.com', username='susan',
+                 password='cat', confirmed=True)
+    users = [User(email='u%d@example.com' % i, username='u%d' % i,
+                  password='cat', confirmed=True) for i in range(49)]
+    db.session.add_all([me, susan] + users)
+    db.session.commit()
+    for i, u in enumerate(users):
+      u.follow(susan)
+      if i % 2:
+        me.follow(u)
+    db.session.commit()
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+
+    # 50行的关注状态: 一次查询(@query_budget)
+    db.session.expunge_all()
+    data = self.client.get('/followers/susan').get_data(as_text=True)
+    self.assertEqual(data.count('>Unfollow</a>'), 24)
+    self.assertEqual(data.count('>Follow</a>'), 25)
+
+    response = self.client.get('/unfollow/u1')
+    self.assertEqual(response.status_code, 302)
+    me = User.query.filter_by(username='john').first()
+    self.assertFalse(me.is_following(User.query.filter_by(
+        username='u1').first()))
+    response = self.client.get('/follow/nobody')
+    self.assertEqual(response.status_code, 302)
+
+  def test_bulk_moderation(self):
+    mod = Role.query.filter_by(name='Moderator').first()
+    me = User(email='john@example.com', username='john', password='cat',
+              confirmed=True, role=mod)
+    post = Post(body='post', author=me)
+    comments = [Comment(body='comment %d' % i, author=me, post=post)
+                for i in range(4)]
+    db.session.add_all([me, post] + comments)
+    db.session.commit()
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    data = self.client.get('/moderate').get_data(as_text=True)
+    self.assertEqual(data.count('name="ids"'), 4)
+
+    response = self.client.post('/moderate/bulk', data={
+        'action': 'disable', 'ids': [comments[0].id, comments[2].id]},
+        follow_redirects=True)
+    data = response.get_data(as_text=True)
+    self.assertIn('2 comments disabled.', data)
+    self.assertEqual(data.count('>Enable</a>'), 2)
+    self.assertEqual(Comment.query.filter_by(disabled=True).count(), 2)
+
+    # CSRF: 其他网站提交的表单被拒绝
+    self.app.config['WTF_CSRF_ENABLED'] = True
+    response = self.client.post('/moderate/bulk', data={
+        'action': 'disable', 'ids': [comments[1].id]})
+    self.assertEqual(response.status_code, 400)
+    self.assertEqual(Comment.query.filter_by(disabled=True).count(), 2)
+    data = self.client.get('/moderate').get_data(as_text=True)
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                      data).group(1)
+    response = self.client.post('/moderate/bulk', data={
+        'csrf_token': token, 'action': 'disable', 'ids': [comments[1].id]})
+    self.assertEqual(response.status_code, 302)
+    self.assertEqual(Comment.query.filter_by(disabled=True).count(), 3)
+
+  def test_identity_cache(self):
+    u = User(email='john@example.com', username='john', password='cat',
+             confirmed=True)
+    db.session.add(u)
+    db.session.commit()
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    # 测试中应用上下文跨请求: 像新的请求一样重新加载current_user
+    g.pop('_login_user', None)
+    self.client.get('/')
+
+    # current_user来自缓存的快照: 不按主键查询users
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+      statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+      g.pop('_login_user', None)
+      db.session.expunge_all()
+      data = self.client.get('/').get_data(as_text=True)
+    finally:
+      db.event.remove(db.engine, 'before_cursor_execute', record)
+    self.assertTrue(re.search(r'Hello,\s+john\s+!', data))
+    self.assertEqual([s for s in statements
+                      if re.search(r'FROM users\s+WHERE users.id = \?', s)],
+                     [])
+
+    # 修改提交后失效
+    u = User.query.filter_by(username='john').first()
+    u.username = 'johnny'
+    db.session.commit()
+    g.pop('_login_user', None)
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertTrue(re.search(r'Hello,\s+johnny\s+!', data))
+    response = self.client.post('/edit-profile', data={
+        'name': 'John Doe', 'location': '', 'about_me': ''})
+    self.assertEqual(response.status_code, 302)
+    self.assertEqual(db.session.get(User, u.id).name, 'John Doe')
+
+  def test_query_budget_exceeded(self):
+    @query_budget(1)
+    def view():
+      return ','.join(str(u.id) for u in User.query.all()) + \
+          str(Role.query.count())
+    self.app.add_url_rule('/_budget', 'budget', view)
+    with self.assertRaises(QueryBudgetExceeded):
+      self.client.get('/_budget')
+
+  def test_fragment_cache(self):
+    store = self.app.extensions['fragment_cache']
+    admin = Role.query.filter_by(name='Administrator').first()
+    u = User(email='john@example.com', username='john', password='cat',
+             confirmed=True)
+    a = User(email='admin@example.com', username='admin', password='cat',
+             confirmed=True, role=admin)
+    db.session.add_all([u, a])
+    db.session.add_all([Post(body='post %d' % i, author=u) for i in range(3)])
+    db.session.commit()
+
+    self.client.get('/')
+    self.assertEqual(store.stats()['fragments']['post']['misses'], 3)
+    response = self.client.get('/')
+    self.assertEqual(store.stats()['fragments']['post']['hits'], 3)
+    self.assertTrue('post 2' in response.get_data(as_text=True))
+    self.assertTrue('Edit' not in response.get_data(as_text=True))
+
+    # 修改body: 删除该帖子的片段
+    post = Post.query.filter_by(body='post 2').first()
+    entries = store.stats()['entries']
+    post.body = 'changed'
+    self.assertEqual(store.stats()['entries'], entries - 1)
+    db.session.commit()
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertTrue('changed' in data)
+    self.assertTrue('post 2' not in data)
+
+    # 管理员看到的片段与匿名用户不同
+    self.client.post('/auth/login', data={
+        'email': 'admin@example.com', 'password': 'cat'})
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertEqual(data.count('Edit [Admin]'), 3)
+
+  def test_fragment_store_lru(self):
+    store = FragmentStore(max_bytes=1000)
+    value = 'x' * 300
+    for i in range(5):
+      store.set('post', 'key %d' % i, value, tag=('post', i))
+    self.assertLessEqual(store.bytes, 1000)
+    evicted = 5 - len(store.entries)
+    self.assertGreater(evicted, 0)
+    self.assertEqual(store.stats()['fragments']['post']['evictions'],
+                     evicted)
+    # 最早的被淘汰
+    self.assertIsNone(store.get('post', 'key 0'))
+    self.assertEqual(store.get('post', 'key 4'), value)
+    store.invalidate('post', 4)
+    self.assertIsNone(store.get('post', 'key 4'))
+    self.assertEqual(store.index.get(('post', 4)), None)
@@ -0,0 +1,117 @@
+# 邮件队列测试
+
+import os
+import shutil
+import tempfile
+import unittest
+from flask_mail import Message
+from app import create_app, mail
+from app.email import MailQueue, send_email, mail_queue
+
+
+class FlakyBackend:
+  """前几次发送失败的后端"""
+
+  def __init__(self, failures):
+    self.failures = failures
+    self.connects = 0
+    self.sent = []
+
+  def connect(self):
+    self.connects += 1
+    return self
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def send(self, msg):
+    if self.failures > 0:
+      self.failures -= 1
+      raise IOError('connection reset')
+    self.sent.append(msg)
+
+
+class MailQueueTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app.config['APP_MAIL_RETRY_DELAY'] = 0.01
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+
+  def tearDown(self):
+    if 'mail_queue' in self.app.extensions:
+      self.app.extensions['mail_queue'].shutdown()
+    self.app_context.pop()
+
+  def message(self, i=0):
+    return Message('subject %d' % i, sender='admin@example.com',
+                   recipients=['john@example.com'], body='body')
+
+  def test_file_backend(self):
+    directory = tempfile.mkdtemp()
+    try:
+      self.app.config['APP_MAIL_BACKEND'] = 'file'
+      self.app.config['APP_MAIL_FILE_DIR'] = directory
+      with self.app.test_request_context():
+        for _ in range(5):
+          self.assertTrue(send_email('john@example.com', 'Confirm',
+                                     'auth/email/confirm',
+                                     user=None, token='token'))
+      self.assertTrue(mail_queue().drain(5))
+      self.assertEqual(len(os.listdir(directory)), 5)
+      self.assertEqual(mail_queue().stats()['sent'], 5)
+    finally:
+      shutil.rmtree(directory)
+
+  def test_batches_share_connection(self):
+    self.app.config['APP_MAIL_WORKERS'] = 1
+    q = MailQueue(self.app)
+    q.backend = backend = FlakyBackend(0)
+    q.queue.put((self.message(), 0, 0))  # 在启动工作线程前入队
+    for i in range(9):
+      q.queue.put((self.message(i), 0, 0))
+    q.start()
+    self.assertTrue(q.drain(5))
+    self.assertEqual(len(backend.sent), 10)
+    self.assertEqual(backend.connects, 1)
+    q.shutdown()
+
+  def test_retry(self):
+    q = MailQueue(self.app)
+    q.backend = backend = FlakyBackend(2)
+    q.put(self.message())
+    self.assertTrue(q.drain(5))
+    self.assertEqual(len(backend.sent), 1)
+    stats = q.stats()
+    self.assertEqual((stats['sent'], stats['retried'], stats['failed']),
+                     (1, 2, 0))
+    q.shutdown()
+
+  def test_give_up(self):
+    self.app.config['APP_MAIL_MAX_RETRIES'] = 1
+    q = MailQueue(self.app)
+    q.backend = FlakyBackend(5)
+    q.put(self.message())
+    self.assertTrue(q.drain(5))
+    self.assertEqual(q.stats()['failed'], 1)
+    q.shutdown()
+
+  def test_queue_full(self):
+    self.app.config['APP_MAIL_QUEUE_SIZE'] = 1
+    q = MailQueue(self.app)
+    q.threads = ['started']  # 不启动工作线程
+    self.assertTrue(q.put(self.message()))
+    self.assertFalse(q.put(self.message(), timeout=0.01))
+    self.assertEqual(q.stats()['rejected'], 1)
+    self.assertEqual(q.stats()['depth'], 1)
+
+  def test_smtp_suppressed_in_testing(self):
+    q = MailQueue(self.app)
+    with mail.record_messages() as outbox:
+      q.put(self.message())
+      self.assertTrue(q.drain(5))
+    self.assertEqual(len(outbox), 1)
+    q.shutdown()
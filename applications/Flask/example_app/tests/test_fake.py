@@ -0,0 +1,59 @@
+# 批量生成测试数据
+
+import random
+import unittest
+from app import create_app, db, fake
+from app.models import User, Role, Post, Comment, Follow
+
+
+class FakeTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_power_law(self):
+    sampler = fake.PowerLaw(100)
+    rng = random.Random(0)
+    samples = [sampler.sample(rng) for _ in range(10000)]
+    self.assertTrue(all(0 <= k < 100 for k in samples))
+    # 第一个的权重是第十个的10倍
+    self.assertGreater(samples.count(0), 5 * samples.count(9))
+
+  def test_bulk(self):
+    fake.users(3)
+    counts = fake.bulk(users=50, posts=100, comments=100, follows=5,
+                       batch_size=30, processes=2, seed=1, log=None)
+    self.assertEqual(counts['users'], 50)
+    self.assertEqual(counts['posts'], 100)
+    self.assertEqual(counts['comments'], 100)
+    self.assertEqual(User.query.count(), 53)
+    # 用户名/邮箱: 名称_id, 不同id不会拼出相同的名称
+    for u in User.query.all():
+      self.assertEqual(u.username.rsplit('_', 1)[1], str(u.id))
+      self.assertTrue(u.email.startswith(u.username + '@'))
+    self.assertEqual(Post.query.count(), 100)
+    self.assertEqual(Comment.query.count(), 100)
+    self.assertEqual(Follow.query.count(), 3 + counts['follows'])
+
+    # 计数器已重建
+    for u in User.query.all():
+      self.assertEqual(u.post_count, u.posts.count())
+      self.assertEqual(u.follower_count, u.followers.count())
+      self.assertEqual(u.followed_count, u.followed.count())
+    for p in Post.query.all():
+      self.assertEqual(p.comment_count, p.comments.count())
+      self.assertIsNotNone(p.body_html)
+
+    # 生成的用户可以登录, 有默认角色
+    u = User.query.order_by(User.id.desc()).first()
+    self.assertTrue(u.verify_password('password'))
+    self.assertTrue(u.is_following(u))
+    self.assertEqual(u.role.name, 'User')
@@ -0,0 +1,84 @@
+# 负载测试工具的测试
+
+import threading
+import unittest
+from werkzeug.serving import make_server
+from app import create_app, db, loadtest
+from app.models import Role
+
+
+class LoadTestTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_summarize_and_compare(self):
+    samples = [('GET /', 200, 0.0, 0.010 * i) for i in range(1, 101)] + \
+        [('GET /post/<id>', 404, 0.0, 0.005)]
+    base = loadtest.summarize(samples, 10.0)
+    self.assertEqual(base['total']['requests'], 101)
+    self.assertEqual(base['total']['errors'], 1)
+    index = base['endpoints']['GET /']
+    self.assertAlmostEqual(index['rps'], 10.0)
+    self.assertAlmostEqual(index['p50'], 0.5, delta=0.011)
+    self.assertEqual(index['statuses'], {'200': 100})
+
+    rows, regressed = loadtest.compare(base, base)
+    self.assertFalse(regressed)
+    self.assertEqual(rows[0][0], 'total')
+    slower = loadtest.summarize(
+        [(label, status, start, d * 2) for label, status, start, d in samples],
+        10.0)
+    rows, regressed = loadtest.compare(base, slower)
+    self.assertTrue(regressed)
+    self.assertEqual({label for label, _, _, worse in rows if worse},
+                     {'total', 'GET /', 'GET /post/<id>'})
+
+    # 错误率上升; 基准中的端点没有请求
+    failing = loadtest.summarize(
+        [('GET /', 500 if i % 5 == 0 else 200, 0.0, 0.010 * i)
+         for i in range(1, 101)], 10.0)
+    rows, regressed = loadtest.compare(base, failing)
+    self.assertTrue(regressed)
+    self.assertEqual({label for label, _, _, worse in rows if worse},
+                     {'total', 'GET /', 'GET /post/<id>'})
+    self.assertIsNone(rows[-1][2])
+
+    self.assertEqual(loadtest.parse_mix('browse=3, api'),
+                     {'browse': 3.0, 'api': 1.0})
+    with self.assertRaises(ValueError):
+      loadtest.parse_mix('browse=1,nope=2')
+
+  def test_run(self):
+    counts = loadtest.seed('small', users=10, posts=30, comments=30,
+                           follows=3, processes=1, seed=1, log=None)
+    self.assertEqual(counts['users'], 10)
+    data = loadtest.dataset(limit=100, seed=1)
+    self.assertEqual(len(data['users']), 10)
+    self.assertEqual(data['counts']['posts'], 30)
+    db.session.remove()
+
+    server = make_server('127.0.0.1', 0, self.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      results = loadtest.run('http://127.0.0.1:%d' % server.server_port,
+                             data, clients=4, seconds=2.0, warmup=0.5,
+                             mix={name: 1 for name in loadtest.SCENARIOS},
+                             seed=1)
+    finally:
+      server.shutdown()
+    self.assertGreater(results['total']['requests'], 0)
+    # 所有场景都执行了, 没有错误
+    self.assertEqual(results['total']['errors'], 0, results['endpoints'])
+    for label in ('GET /', 'GET /api/v1/posts/', 'POST /api/v1/posts/',
+                  'POST /api/v1/posts/<id>/comments/', 'GET /followed'):
+      self.assertIn(label, results['endpoints'])
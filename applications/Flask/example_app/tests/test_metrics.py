@@ -0,0 +1,143 @@
+# 请求计时和指标测试
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from app import create_app, db
+from app.metrics import ARCHIVE, Histogram
+from app.models import Role, User, Post
+
+
+class MetricsTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    self.metrics = self.app.extensions['metrics']
+    self.client = self.app.test_client(use_cookies=True)
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_histogram(self):
+    h = Histogram()
+    for ms in range(1, 101):
+      h.add(ms / 1000)
+    self.assertEqual(h.count, 100)
+    self.assertAlmostEqual(h.sum, 5.05)
+    # 桶的上界不小于真实值, 相对误差小于2 ** (1 / SUB)
+    for p, value in ((0.5, 0.050), (0.99, 0.099)):
+      self.assertGreaterEqual(h.percentile(p), value)
+      self.assertLess(h.percentile(p), value * 2 ** (1 / Histogram.SUB))
+    self.assertEqual(Histogram.index(Histogram.MIN / 2), 0)
+    self.assertEqual(Histogram.index(1e6), Histogram.BUCKETS)
+    buckets = h.cumulative()
+    self.assertEqual([n for _, n in buckets], sorted(n for _, n in buckets))
+    self.assertEqual(buckets[-1][1], 100)
+    self.assertIsNone(Histogram().percentile(0.5))
+
+  def test_server_timing(self):
+    u = User(email='john@example.com', username='john', password='cat',
+             confirmed=True)
+    db.session.add(u)
+    db.session.add(Post(body='**hello**', author=u))
+    db.session.commit()
+    response = self.client.get('/')
+    timing = response.headers['Server-Timing']
+    self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+"')
+    self.assertRegex(timing, r'template;dur=[\d.]+')
+    self.assertRegex(timing, r'total;dur=[\d.]+$')
+
+    # 登录: 校验密码计入auth
+    response = self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    self.assertIn('auth;dur=', response.headers['Server-Timing'])
+
+    summary = self.metrics.summary()
+    self.assertEqual(summary['main.index']['total']['count'], 1)
+    self.assertIn('db', summary['main.index'])
+    self.assertIn('auth', summary['auth.login'])
+
+  def test_prometheus(self):
+    for _ in range(3):
+      self.client.get('/')
+    self.client.get('/no-such-page')
+    response = self.client.get('/metrics')
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response.mimetype.startswith('text/plain'))
+    text = response.get_data(as_text=True)
+    self.assertIn('app_requests_total{endpoint="main.index",status="200"} 3',
+                  text)
+    self.assertIn('status="404"', text)
+    self.assertIn('app_request_duration_seconds_bucket{'
+                  'endpoint="main.index",le="+Inf"} 3', text)
+    self.assertIn('app_request_duration_seconds_count{'
+                  'endpoint="main.index"} 3', text)
+    self.assertRegex(text, r'app_request_phase_seconds_bucket\{'
+                     r'endpoint="main.index",phase="db",le="[\d.e-]+"\} \d+')
+    self.assertRegex(text, r'\napp_queries_queries \d+\n')
+
+    # 令牌
+    self.app.config['APP_METRICS_TOKEN'] = 'secret'
+    self.assertEqual(self.client.get('/metrics').status_code, 403)
+    response = self.client.get(
+        '/metrics', headers={'Authorization': 'Bearer secret'})
+    self.assertEqual(response.status_code, 200)
+    # 生产配置: 没有设置令牌时拒绝
+    self.app.config['APP_METRICS_TOKEN'] = None
+    self.app.config['APP_METRICS_REQUIRE_TOKEN'] = True
+    self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+  def test_merge_processes(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    self.metrics.directory = directory
+    self.addCleanup(setattr, self.metrics, 'directory', None)
+    self.client.get('/')
+
+    # 另一个worker的文件
+    h = Histogram()
+    h.add(0.010)
+    h.add(0.020)
+    with open(os.path.join(directory, 'metrics-1.json'), 'w') as f:
+      json.dump({'pid': 1,
+                 'histograms': [['main.index', 'total', h.to_dict()]],
+                 'requests': [['main.index', 200, 2]],
+                 'stats': {'app_queries_queries': 5}}, f)
+    # 很久没有更新的文件(进程已退出): 计数合并到归档文件后删除
+    stale = os.path.join(directory, 'metrics-2.json')
+    with open(stale, 'w') as f:
+      json.dump({'pid': 2, 'histograms': [['main.index', 'total',
+                                           h.to_dict()]],
+                 'requests': [['main.index', 200, 100]],
+                 'stats': {'app_queries_queries': 7}}, f)
+    old = time.time() - self.metrics.max_age - 1
+    os.utime(stale, (old, old))
+
+    text = self.metrics.prometheus()
+    self.assertFalse(os.path.exists(stale))
+    self.assertTrue(os.path.exists(os.path.join(directory, ARCHIVE)))
+    for _ in range(2):
+      self.assertIn('app_requests_total{endpoint="main.index",status="200"} '
+                    '103', text)
+      self.assertIn('app_request_duration_seconds_count{'
+                    'endpoint="main.index"} 5', text)
+      # 归档文件不因为旧而删除
+      os.utime(os.path.join(directory, ARCHIVE), (old, old))
+      text = self.metrics.prometheus()
+
+    # 本进程的文件
+    self.metrics.flush()
+    with open(os.path.join(directory, 'metrics-%d.json' % os.getpid())) as f:
+      snapshot = json.load(f)
+    self.assertEqual(snapshot['requests'], [['main.index', 200, 1]])
+    self.assertTrue(re.match(r'\d+$', str(snapshot['stats']
+                                          ['app_queries_queries'])))
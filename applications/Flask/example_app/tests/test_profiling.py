@@ -0,0 +1,104 @@
+# 采样分析器测试
+
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from app import create_app, db
+from app.models import Role, User
+
+
+def busy_loop(seconds):
+  deadline = time.perf_counter() + seconds
+  while time.perf_counter() < deadline:
+    pass
+  return 'done'
+
+
+class StackSamplerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app.add_url_rule('/_busy', 'busy', lambda: busy_loop(0.3))
+    self.directory = tempfile.mkdtemp()
+    self.app.config['APP_PROFILE_DIR'] = self.directory
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    self.profiler = self.app.extensions['profiler']
+    self.profiler.directory = self.directory
+    self.client = self.app.test_client(use_cookies=True)
+
+  def tearDown(self):
+    self.profiler.stop()
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+    shutil.rmtree(self.directory)
+
+  def test_sample_endpoint(self):
+    self.assertTrue(self.profiler.start(hz=200))
+    self.assertFalse(self.profiler.start())
+    self.client.get('/_busy')
+    self.client.get('/')
+    files = self.profiler.stop()
+    self.assertFalse(self.profiler.running)
+
+    stats = self.profiler.stats()
+    self.assertGreater(stats['endpoints']['busy'], 10)
+    # 折叠的栈: 根在前, 被采样的函数在后
+    folded = self.profiler.folded('busy')
+    for line in folded.splitlines():
+      self.assertRegex(line, r'^\S.* \d+$')
+    self.assertIn('tests.test_profiling:busy_loop', folded)
+    self.assertIn('flask.app:Flask.wsgi_app', folded.split('busy_loop')[0])
+    # 所有端点: 端点是根帧
+    self.assertTrue(self.profiler.folded().startswith('busy;'))
+
+    path = os.path.join(self.directory, 'busy.%d.folded' % os.getpid())
+    self.assertIn(path, files)
+    with open(path) as f:
+      self.assertEqual(f.read(), folded)
+
+  def test_max_stacks(self):
+    self.profiler.max_stacks = 2
+    for i in range(5):
+      self.profiler.add('main.index', 'a;b%d' % i)
+    self.profiler.add('main.index', 'a;b0')
+    self.assertEqual(self.profiler.samples['main.index'],
+                     {'a;b0': 2, 'a;b1': 1, '[truncated]': 3})
+    self.assertEqual(self.profiler.dropped, 3)
+
+  def test_debug_endpoint(self):
+    r = Role.query.filter_by(name='Administrator').first()
+    db.session.add(User(email='admin@example.com', username='admin',
+                        password='cat', confirmed=True, role=r))
+    db.session.commit()
+    self.client.post('/auth/login', data={
+        'email': 'admin@example.com', 'password': 'cat'})
+
+    response = self.client.post('/debug/profile?seconds=1&hz=200')
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response.get_json()['running'])
+    self.assertEqual(self.client.post('/debug/profile').status_code, 409)
+    self.client.get('/_busy')
+    # 到时自动停止并写文件
+    self.profiler.thread.join(5)
+    stats = self.client.get('/debug/profile').get_json()
+    self.assertFalse(stats['running'])
+    self.assertTrue(any(re.search(r'busy\.\d+\.folded$', path)
+                        for path in stats['files']))
+    response = self.client.get('/debug/profile?format=folded&endpoint=busy')
+    self.assertIn('busy_loop', response.get_data(as_text=True))
+
+    # 跨站请求: 没有CSRF令牌的POST被拒绝
+    self.app.config['WTF_CSRF_ENABLED'] = True
+    self.assertEqual(self.client.post('/debug/profile').status_code, 400)
+    self.assertEqual(self.client.delete('/debug/profile').status_code, 400)
+    self.assertFalse(self.profiler.running)
+    token = self.client.get('/debug/profile').headers['X-CSRFToken']
+    response = self.client.post('/debug/profile?seconds=1',
+                                headers={'X-CSRFToken': token})
+    self.assertEqual(response.status_code, 200)
@@ -0,0 +1,100 @@
+# 查询统计测试
+
+import json
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post
+from app.queries import fingerprint
+
+
+class QueryRecorderTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app.add_url_rule('/_posts_n_plus_one', 'posts_n_plus_one',
+                          self.posts_n_plus_one)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    self.recorder = self.app.extensions['queries']
+    self.client = self.app.test_client(use_cookies=True)
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  @staticmethod
+  def posts_n_plus_one():
+    # 每个帖子单独查询作者
+    return ','.join(User.query.filter_by(id=post.author_id).one().username
+                    for post in Post.query.all())
+
+  def login_admin(self):
+    r = Role.query.filter_by(name='Administrator').first()
+    u = User(email='admin@example.com', username='admin', password='cat',
+             confirmed=True, role=r)
+    db.session.add(u)
+    db.session.commit()
+    response = self.client.post('/auth/login', data={
+        'email': 'admin@example.com', 'password': 'cat'})
+    self.assertEqual(response.status_code, 302)
+
+  def test_fingerprint(self):
+    self.assertEqual(
+        fingerprint("SELECT * FROM users\n  WHERE id = 12 AND name = 'o''k'"),
+        'SELECT * FROM users WHERE id = ? AND name = ?')
+    self.assertEqual(
+        fingerprint('SELECT * FROM users WHERE id IN (?, ?, ?)'),
+        fingerprint('SELECT * FROM users WHERE id IN (?)'))
+    self.assertEqual(
+        fingerprint('INSERT INTO t (a, b) VALUES (?, ?), (?, ?)'),
+        'INSERT INTO t (a, b) VALUES (?...)')
+    # 标识符中的数字不变
+    self.assertEqual(fingerprint('SELECT users_1.id FROM users AS users_1'),
+                     'SELECT users_1.id FROM users AS users_1')
+
+  def test_aggregate_and_n_plus_one(self):
+    self.login_admin()
+    u = User.query.first()
+    db.session.add_all([Post(body='post %d' % i, author=u)
+                        for i in range(6)])
+    db.session.commit()
+    self.client.delete('/debug/queries')
+    for _ in range(3):
+      response = self.client.get('/_posts_n_plus_one')
+      self.assertEqual(response.status_code, 200)
+
+    response = self.client.get('/debug/queries?n_plus_one=1')
+    self.assertEqual(response.status_code, 200)
+    data = json.loads(response.get_data(as_text=True))
+    self.assertEqual(len(data['queries']), 1)
+    item = data['queries'][0]
+    self.assertEqual(item['endpoint'], 'posts_n_plus_one')
+    self.assertTrue(item['fingerprint'].endswith(
+        'FROM users WHERE users.id = ?'), item['fingerprint'])
+    self.assertEqual(item['requests'], 3)
+    self.assertEqual(item['max_repeat'], 6)
+    self.assertEqual(item['n_plus_one'], 3)
+    self.assertLessEqual(item['p50'], item['p99'])
+
+    # 按端点过滤, 重置
+    response = self.client.get('/debug/queries?endpoint=posts_n_plus_one')
+    data = json.loads(response.get_data(as_text=True))
+    # 每个请求: 帖子, 6次作者
+    self.assertEqual(sum(q['count'] for q in data['queries']), 3 * 7)
+    response = self.client.delete('/debug/queries')
+    self.assertEqual(json.loads(response.get_data(as_text=True))['queries'],
+                     0)
+
+  def test_admin_only(self):
+    response = self.client.get('/debug/queries')
+    self.assertEqual(response.status_code, 302)
+    u = User(email='john@example.com', username='john', password='cat',
+             confirmed=True)
+    db.session.add(u)
+    db.session.commit()
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    response = self.client.get('/debug/queries')
+    self.assertEqual(response.status_code, 403)
@@ -0,0 +1,106 @@
+# Markdown渲染缓存测试
+
+import shutil
+import tempfile
+import unittest
+from flask import current_app
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.rendering import RenderCache, cache_key
+
+
+class RenderingTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    self.renderer = current_app.extensions['renderer']
+
+  def tearDown(self):
+    self.renderer.offload = False
+    self.renderer.shutdown()
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_lru_eviction(self):
+    cache = RenderCache(maxsize=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+    self.assertEqual(cache.get('a'), '1')
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+  def test_disk_tier(self):
+    directory = tempfile.mkdtemp()
+    try:
+      RenderCache(directory=directory).set('abcd', '<p>x</p>')
+      # 新的进程内缓存从磁盘读取
+      self.assertEqual(RenderCache(directory=directory).get('abcd'),
+                       '<p>x</p>')
+    finally:
+      shutil.rmtree(directory)
+
+  def test_key_depends_on_tags(self):
+    self.assertNotEqual(cache_key('*x*', ['em']), cache_key('*x*', ['b']))
+    self.assertEqual(cache_key('*x*', ['em', 'b']),
+                     cache_key('*x*', ['b', 'em']))
+
+  def test_render_once(self):
+    self.renderer.cache = RenderCache()
+    Post(body='*same*')
+    p = Post(body='*same*')
+    self.assertEqual(p.body_html, '<p><em>same</em></p>')
+    self.assertEqual((self.renderer.cache.hits,
+                      self.renderer.cache.misses), (1, 1))
+
+  def test_offload(self):
+    self.renderer.offload = True
+    u = User(email='john@example.com', username='john', password='cat')
+    p = Post(body='rendered *later*', author=u)
+    db.session.add(p)
+    db.session.commit()
+    # 提交后在进程池中渲染, 回写body_html
+    self.renderer.shutdown()
+    db.session.refresh(p)
+    self.assertEqual(p.body_html, '<p>rendered <em>later</em></p>')
+    # 缓存命中时直接设置
+    c = Comment(body='rendered *later*', post=p, author=u)
+    self.assertIsNone(c.body_html)
+    p2 = Post(body='rendered *later*', author=u)
+    self.assertEqual(p2.body_html, '<p>rendered <em>later</em></p>')
+
+  def test_rerender(self):
+    u = User(email='john@example.com', username='john', password='cat')
+    posts = [Post(body='post *%d*' % i, author=u) for i in range(5)]
+    db.session.add_all(posts)
+    db.session.commit()
+    Post.query.update({'body_html': None})
+    db.session.commit()
+    self.assertEqual(self.renderer.rerender(
+        Post, batch_size=2, only_missing=True, parallel=True), 5)
+    self.assertEqual([p.body_html for p in Post.query.order_by(Post.id)],
+                     ['<p>post <em>%d</em></p>' % i for i in range(5)])
+
+  def test_render_many_cache(self):
+    tags = Post.ALLOWED_TAGS
+    self.renderer.cache = RenderCache()
+    self.renderer.render('*cached*', tags)
+    rows = [(1, '*cached*'), (2, '*new*'), (3, '*new*')]
+    self.assertEqual(self.renderer.render_many(rows, tags, parallel=True),
+                     [(1, '<p><em>cached</em></p>'),
+                      (2, '<p><em>new</em></p>'),
+                      (3, '<p><em>new</em></p>')])
+    # 只渲染了未命中的内容(一次), 结果放回缓存
+    self.assertEqual(self.renderer.cache.get(cache_key('*new*', tags)),
+                     '<p><em>new</em></p>')
+    # 全部命中时不使用进程池
+    self.renderer.shutdown()
+    self.renderer.get_executor = None
+    self.addCleanup(delattr, self.renderer, 'get_executor')
+    self.assertEqual(len(self.renderer.render_many(rows, tags,
+                                                   parallel=True)), 3)
@@ -0,0 +1,169 @@
+# 读写分离测试: 第二个SQLite文件作为副本
+
+import os
+import unittest
+from base64 import b64encode
+
+from app import create_app, db
+from app.models import Post, Role, User
+from app.replicas import LAST_WRITE_HEADER, LAST_WRITE_KEY, ReplicaRouter
+from config import TestingConfig, basedir, config
+
+REPLICA_PATH = os.path.join(basedir, 'data-test-replica.sqlite')
+
+
+class ReplicaTestingConfig(TestingConfig):
+  SQLALCHEMY_BINDS = {'replica': 'sqlite:///' + REPLICA_PATH}
+
+
+class ReplicaTestCase(unittest.TestCase):
+  def setUp(self):
+    config['testing-replica'] = ReplicaTestingConfig
+    self.app = create_app(config_name='testing-replica')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    db.metadata.create_all(db.engines['replica'])
+    Role.insert_roles()
+    self.router = self.app.extensions['replica']
+    self.client = self.app.test_client(use_cookies=True)
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    for engine in db.engines.values():
+      engine.dispose()
+    self.app_context.pop()
+    del config['testing-replica']
+    # init_app为每个bind创建了MetaData, 其他测试的应用没有这个bind
+    db.metadatas.pop('replica', None)
+    if os.path.exists(REPLICA_PATH):
+      os.remove(REPLICA_PATH)
+
+  def replicate(self):
+    """把主库复制到副本"""
+    primary = db.engines[None].raw_connection()
+    replica = db.engines['replica'].raw_connection()
+    try:
+      primary.driver_connection.backup(replica.driver_connection)
+    finally:
+      primary.close()
+      replica.close()
+
+  def test_routing(self):
+    john = User(email='john@example.com', username='john', password='cat',
+                confirmed=True)
+    susan = User(email='susan@example.com', username='susan',
+                 password='dog', confirmed=True)
+    db.session.add_all([john, susan])
+    db.session.add(Post(body='replicated', author=susan))
+    db.session.commit()
+    john_id = john.id
+    self.replicate()
+    # 副本还没有这个帖子(复制延迟)
+    db.session.add(Post(body='lagging', author=susan))
+    db.session.commit()
+    db.session.remove()
+
+    # 匿名的GET请求读副本
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertIn('replicated', data)
+    self.assertNotIn('lagging', data)
+    self.assertGreater(self.router.replica_reads, 0)
+
+    # 写入后该用户读主库
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    response = self.client.post('/', data={'body': 'mine'})
+    self.assertEqual(response.status_code, 302)
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertIn('mine', data)
+    self.assertIn('lagging', data)
+
+    # 粘滞过期后回到副本
+    with self.client.session_transaction() as sess:
+      sess[LAST_WRITE_KEY] -= self.router.sticky
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertNotIn('mine', data)
+
+    # API的GET也读副本
+    headers = {
+        'Authorization': 'Basic ' + b64encode(
+            b'susan@example.com:dog').decode('utf-8'),
+        'Accept': 'application/json'}
+    data = self.client.get('/api/v1/posts/', headers=headers) \
+        .get_data(as_text=True)
+    self.assertIn('replicated', data)
+    self.assertNotIn('lagging', data)
+
+    # 复制延迟过大: 回退到主库
+    self.router._replication_lag = lambda conn: 60
+    self.addCleanup(delattr, self.router, '_replication_lag')
+    self.router.checked = None
+    data = self.client.get('/').get_data(as_text=True)
+    self.assertIn('mine', data)
+    self.assertFalse(self.router.stats()['healthy'])
+    self.assertGreater(self.router.stats()['fallbacks'], 0)
+
+  def test_sticky_across_workers(self):
+    # 两个应用实例相当于两个gunicorn worker, 共享数据库和会话密钥
+    # 扩展对象是模块级的单例, 另一个worker需要自己的ReplicaRouter
+    other = create_app(config_name='testing-replica')
+    ReplicaRouter(other)
+    other_client = other.test_client(use_cookies=True)
+    john = User(email='john@example.com', username='john', password='cat',
+                confirmed=True)
+    db.session.add(john)
+    db.session.commit()
+    self.replicate()
+    db.session.remove()
+
+    # 在一个worker上写入, 下一个请求落到另一个worker, 仍读主库
+    self.client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    response = self.client.post('/', data={'body': 'mine'})
+    self.assertEqual(response.status_code, 302)
+    other_client.set_cookie('session',
+                            self.client.get_cookie('session').value)
+    data = other_client.get('/').get_data(as_text=True)
+    self.assertIn('mine', data)
+    self.assertGreater(other.extensions['replica'].sticky_reads, 0)
+
+    # API: 响应头返回提交时间, 客户端带上后另一个worker读主库
+    headers = {
+        'Authorization': 'Basic ' + b64encode(
+            b'john@example.com:cat').decode('utf-8'),
+        'Accept': 'application/json', 'Content-Type': 'application/json'}
+    response = self.client.post('/api/v1/posts/', headers=headers,
+                                data='{"body": "from api"}')
+    self.assertEqual(response.status_code, 201)
+    written = response.headers[LAST_WRITE_HEADER]
+    api = other.test_client()
+    data = api.get('/api/v1/posts/', headers=headers).get_data(as_text=True)
+    self.assertNotIn('from api', data)
+    data = api.get('/api/v1/posts/', headers=dict(
+        headers, **{LAST_WRITE_HEADER: written})).get_data(as_text=True)
+    self.assertIn('from api', data)
+    with other.app_context():
+      db.session.remove()
+      for engine in db.engines.values():
+        engine.dispose()
+
+  def test_replica_error(self):
+    susan = User(email='susan@example.com', username='susan',
+                 password='dog', confirmed=True)
+    db.session.add(Post(body='replicated', author=susan))
+    db.session.commit()
+    self.replicate()
+    db.session.remove()
+    self.router.check()
+    # 副本上的读出错: 在主库上重试, 不返回500
+    with db.engines['replica'].begin() as conn:
+      conn.exec_driver_sql('DROP TABLE posts')
+    response = self.client.get('/')
+    self.assertEqual(response.status_code, 200)
+    self.assertIn('replicated', response.get_data(as_text=True))
+    stats = self.router.stats()
+    self.assertEqual(stats['errors'], 1)
+    self.assertFalse(stats['healthy'])
+    self.assertGreater(stats['primary_reads'], 0)
@@ -0,0 +1,152 @@
+# 全文搜索测试
+
+import json
+import unittest
+from base64 import b64encode
+
+from app import create_app, db
+from app.exceptions import ValidationError
+from app.models import Comment, Post, Role, User
+from app.pagination import KeysetPagination
+from app.search import fts_query, key_values, reindex, search_query, terms
+
+
+class SearchTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    self.client = self.app.test_client(use_cookies=True)
+    self.user = User(email='john@example.com', username='john',
+                     password='cat', confirmed=True)
+    db.session.add(self.user)
+    db.session.commit()
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def search(self, model, text):
+    query, keys = search_query(model, text)
+    return [row[0].id for row in query.order_by(*keys).all()]
+
+  def test_fts_query(self):
+    self.assertEqual(fts_query(terms('apple "OR banana* col:x')),
+                     '"apple" "OR" "banana"* "col" "x"')
+    with self.assertRaises(ValidationError):
+      terms(' "-* ')
+
+  def test_sync(self):
+    p1 = Post(body='red apples and green pears', author=self.user)
+    p2 = Post(body='apple pie, apple cake, apple juice', author=self.user)
+    db.session.add_all([p1, p2])
+    db.session.commit()
+    # BM25: 词频高的排在前面
+    self.assertEqual(self.search(Post, 'apple'), [p2.id])
+    self.assertEqual(self.search(Post, 'appl*'), [p2.id, p1.id])
+    self.assertEqual(self.search(Post, 'green apples'), [p1.id])
+
+    # 修改, 删除
+    p1.body = 'only bananas'
+    db.session.commit()
+    self.assertEqual(self.search(Post, 'appl*'), [p2.id])
+    self.assertEqual(self.search(Post, 'bananas'), [p1.id])
+    db.session.delete(p2)
+    db.session.commit()
+    self.assertEqual(self.search(Post, 'appl*'), [])
+
+    # 取消的评论不出现
+    c1 = Comment(body='nice bananas', post=p1, author=self.user)
+    c2 = Comment(body='bad bananas', post=p1, author=self.user,
+                 disabled=True)
+    db.session.add_all([c1, c2])
+    db.session.commit()
+    self.assertEqual(self.search(Comment, 'bananas'), [c1.id])
+
+  def test_reindex(self):
+    db.session.add(Post(body='hello world', author=self.user))
+    db.session.commit()
+    # 触发器丢失(例如batch迁移重建了表)后重建
+    with db.engine.begin() as conn:
+      conn.exec_driver_sql('DROP TRIGGER posts_fts_ai')
+      conn.exec_driver_sql("INSERT INTO posts_fts(posts_fts) "
+                           "VALUES ('delete-all')")
+    self.assertEqual(self.search(Post, 'hello'), [])
+    self.assertEqual(reindex(Post), 1)
+    self.assertEqual(len(self.search(Post, 'hello')), 1)
+    db.session.add(Post(body='hello again', author=self.user))
+    db.session.commit()
+    self.assertEqual(len(self.search(Post, 'hello')), 2)
+
+  def test_max_candidates(self):
+    # 最相关的是最早的行
+    posts = [Post(body='word word word', author=self.user),
+             Post(body='word and some other text', author=self.user),
+             Post(body='word', author=self.user)]
+    db.session.add_all(posts)
+    db.session.commit()
+    self.app.config['APP_SEARCH_MAX_CANDIDATES'] = 0
+    ranked = self.search(Post, 'word')
+    self.assertEqual(len(ranked), 3)
+    self.assertEqual(ranked[0], posts[0].id)
+    # 上限只截断结果, 对所有匹配行排序
+    self.app.config['APP_SEARCH_MAX_CANDIDATES'] = 2
+    self.assertEqual(self.search(Post, 'word'), ranked[:2])
+
+  def test_pagination(self):
+    # 相关性相同的行按id排序, 游标翻页不重复不遗漏
+    db.session.add_all([Post(body='word ' * (i % 3 + 1), author=self.user)
+                        for i in range(25)])
+    db.session.commit()
+    expected = self.search(Post, 'word')
+    query, keys = search_query(Post, 'word')
+    ids = []
+    cursor = None
+    while True:
+      pagination = KeysetPagination(query, keys, 10, desc=False,
+                                    cursor=cursor, key_values=key_values)
+      ids += [row[0].id for row in pagination.items]
+      if not pagination.has_next:
+        break
+      cursor = pagination.next_cursor
+    self.assertEqual(ids, expected)
+    self.assertEqual(len(ids), 25)
+    # 返回前一页
+    pagination = KeysetPagination(query, keys, 10, desc=False,
+                                  cursor=pagination.prev_cursor,
+                                  key_values=key_values)
+    self.assertEqual([row[0].id for row in pagination.items], ids[10:20])
+
+  def test_views(self):
+    db.session.add_all([Post(body='searchable post %d' % i, author=self.user)
+                        for i in range(12)])
+    db.session.commit()
+    response = self.client.get('/search?q=searchable')
+    self.assertEqual(response.status_code, 200)
+    data = response.get_data(as_text=True)
+    self.assertEqual(data.count('class="post"'), 10)
+    self.assertIn('cursor=', data)
+    response = self.client.get('/search?q=nothing&type=comments')
+    self.assertIn('No results.', response.get_data(as_text=True))
+    response = self.client.get('/search?q=-')
+    self.assertEqual(response.status_code, 302)
+
+    # API
+    headers = {
+        'Authorization': 'Basic ' + b64encode(
+            b'john@example.com:cat').decode('utf-8'),
+        'Accept': 'application/json'}
+    response = self.client.get('/api/v1/search?q=searchable', headers=headers)
+    self.assertEqual(response.status_code, 200)
+    json_response = json.loads(response.get_data(as_text=True))
+    self.assertEqual(len(json_response['posts']), 10)
+    self.assertIsNone(json_response['prev'])
+    response = self.client.get(json_response['next'], headers=headers)
+    json_response = json.loads(response.get_data(as_text=True))
+    self.assertEqual(len(json_response['posts']), 2)
+    self.assertIsNone(json_response['next'])
+    response = self.client.get('/api/v1/search?q=', headers=headers)
+    self.assertEqual(response.status_code, 400)
@@ -0,0 +1,84 @@
+# SQLite调优测试
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from app import create_app, db
+from app.models import Role
+from app.sqlite import benchmark, is_write_request, tune
+
+
+class SQLiteTestCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(config_name='testing')
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    self.tmp = tempfile.TemporaryDirectory()
+    self.engine = create_engine(
+        'sqlite:///' + os.path.join(self.tmp.name, 'tuned.sqlite'))
+
+  def tearDown(self):
+    self.engine.dispose()
+    self.tmp.cleanup()
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_pragmas(self):
+    tuning = self.app.extensions['sqlite']
+    # 测试配置不启用
+    self.assertEqual(tuning.engines, [])
+    tune(self.engine, self.app.config['APP_SQLITE_PRAGMAS'])
+    pragmas = tuning.pragmas(self.engine, ['journal_mode', 'synchronous',
+                                           'busy_timeout', 'mmap_size'])
+    self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1,
+                               'busy_timeout': 5000,
+                               'mmap_size': 256 * 1024 * 1024})
+
+  def test_begin_immediate(self):
+    pragmas = {'journal_mode': 'WAL', 'busy_timeout': 0}
+    tune(self.engine, pragmas)
+    with self.engine.begin() as conn:
+      conn.exec_driver_sql('CREATE TABLE t (n INTEGER)')
+
+    # 写请求: 事务开始时就取得写锁, 另一个写事务不能开始
+    other = create_engine(self.engine.url)
+    tune(other, pragmas, immediate=lambda: True)
+    with self.app.test_request_context('/', method='POST'):
+      with self.engine.begin() as conn:
+        conn.exec_driver_sql('SELECT n FROM t').all()
+        with self.assertRaises(sqlite3.OperationalError):
+          with other.begin():
+            pass
+        conn.exec_driver_sql('INSERT INTO t VALUES (1)')
+    # 读请求: 延迟事务, WAL模式下读不阻塞写
+    with self.app.test_request_context('/'):
+      with self.engine.begin() as conn:
+        conn.exec_driver_sql('SELECT n FROM t').all()
+        with other.begin() as conn2:
+          conn2.exec_driver_sql('INSERT INTO t VALUES (2)')
+    other.dispose()
+
+  def test_write_request(self):
+    self.assertFalse(is_write_request())
+    with self.app.test_request_context('/'):
+      self.assertFalse(is_write_request())
+    with self.app.test_request_context('/', method='POST'):
+      self.assertTrue(is_write_request())
+    # 在GET中写入的视图
+    with self.app.test_request_context('/follow/john'):
+      self.assertTrue(is_write_request())
+
+  def test_benchmark(self):
+    results = benchmark(self.app.config['APP_SQLITE_PRAGMAS'], processes=2,
+                        seconds=0.3, seed=1)
+    self.assertEqual(set(results), {'default', 'tuned'})
+    for r in results.values():
+      self.assertGreater(r['ops'], 0)
+      self.assertLessEqual(r['p50'], r['p99'])
@@ -1,9 +1,19 @@
 # 用户模型测试
 
+import threading
+import time
 import unittest
+from datetime import datetime
 from app import create_app, db
-from app.models import User, Permission, AnonymousUser, Role
-from flask import current_app
+from app.models import User, Permission, AnonymousUser, Role, Post, Comment, \
+    TimelineEntry
+from app.exceptions import PasswordHashingBusy
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+from app.follows import followers_set, following_set, prefetch
+from app.last_seen import LastSeenBuffer, last_seen_buffer
+from app.pagination import KeysetPagination
+from app.roles import RoleCache
+from flask import current_app, g
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -42,6 +52,102 @@ class UserModelTestCase(unittest.TestCase):
     u2 = User(username='susan', password='cat')
     self.assertTrue(u1.password_hash != u2.password_hash)
 
+  def test_password_rehash(self):
+    hasher = self.app.extensions['password_hasher']
+    u = User(username='john', email='john@example.com', confirmed=True)
+    hasher.method = 'pbkdf2:sha256:1000'
+    u.password = 'cat'
+    db.session.add(u)
+    db.session.commit()
+    # 配置的成本改变: 登录成功后升级
+    hasher.method = 'pbkdf2:sha256:2000'
+    self.assertFalse(u.verify_password('dog'))
+    self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+    self.assertTrue(u.verify_password('cat'))
+    self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+    self.assertTrue(u.verify_password('cat'))
+
+    # 登录表单提交升级后的哈希
+    hasher.method = 'pbkdf2:sha256:3000'
+    client = self.app.test_client()
+    response = client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    self.assertEqual(response.status_code, 302)
+    db.session.expire_all()
+    self.assertTrue(db.session.get(User, u.id).password_hash.startswith(
+        'pbkdf2:sha256:3000$'))
+
+  def test_password_hashing_busy(self):
+    hasher = self.app.extensions['password_hasher']
+    u = User(username='john', email='john@example.com', password='cat',
+             confirmed=True)
+    db.session.add(u)
+    db.session.commit()
+    # 所有名额被占用: 立即拒绝, 返回503
+    hasher.configure(hasher.method, max_pending=1)
+    hasher.slots.acquire()
+    with self.assertRaises(PasswordHashingBusy):
+      u.verify_password('cat')
+    client = self.app.test_client()
+    response = client.post('/auth/login', data={
+        'email': 'john@example.com', 'password': 'cat'})
+    self.assertEqual(response.status_code, 503)
+    self.assertEqual(response.headers['Retry-After'], '1')
+    self.assertEqual(hasher.stats()['rejected'], 2)
+    hasher.slots.release()
+    self.assertTrue(u.verify_password('cat'))
+
+  def test_password_rehash_normalized_and_busy(self):
+    hasher = self.app.extensions['password_hasher']
+    # 没有参数的方法按werkzeug的默认参数比较
+    hasher.method = 'scrypt'
+    self.assertFalse(hasher.needs_rehash('scrypt:32768:8:1$salt$hash'))
+    hasher.method = 'pbkdf2'
+    self.assertFalse(hasher.needs_rehash(
+        'pbkdf2:sha256:%d$salt$hash' % DEFAULT_PBKDF2_ITERATIONS))
+    self.assertTrue(hasher.needs_rehash('pbkdf2:sha256:1000$salt$hash'))
+
+    # 重新哈希时名额已满: 登录仍然成功, 下次再升级
+    hasher.method = 'pbkdf2:sha256:1000'
+    u = User(username='john', password='cat')
+    old = u.password_hash
+    hasher.method = 'pbkdf2:sha256:2000'
+
+    def busy(password):
+      raise PasswordHashingBusy('busy')
+    hasher.hash = busy
+    try:
+      self.assertTrue(u.verify_password('cat'))
+    finally:
+      del hasher.hash
+    self.assertEqual(u.password_hash, old)
+
+  def test_password_offload_timeout(self):
+    hasher = self.app.extensions['password_hasher']
+    u = User(username='john', password='cat')
+    hasher.configure('pbkdf2:sha256:2000000', offload=True, workers=1,
+                     max_pending=1, timeout=0.01)
+    try:
+      with self.assertRaises(PasswordHashingBusy):
+        u.verify_password('cat')
+      self.assertEqual(hasher.stats()['timeouts'], 1)
+      # 进程中的计算结束前名额不释放
+      self.assertFalse(hasher.slots.acquire(blocking=False))
+    finally:
+      hasher.shutdown()
+    self.assertTrue(hasher.slots.acquire(blocking=False))
+
+  def test_password_offload(self):
+    hasher = self.app.extensions['password_hasher']
+    hasher.configure('pbkdf2:sha256:1000', offload=True, workers=1)
+    try:
+      u = User(username='john', password='cat')
+      self.assertTrue(u.verify_password('cat'))
+      self.assertFalse(u.verify_password('dog'))
+      self.assertIsNotNone(hasher.executor)
+    finally:
+      hasher.shutdown()
+
   def test_user_role(self):
     u = User(email='john@example.com', password='cat')
     self.assertTrue(u.can(Permission.FOLLOW))
@@ -57,3 +163,295 @@ class UserModelTestCase(unittest.TestCase):
     self.assertFalse(u.can(Permission.WRITE))
     self.assertFalse(u.can(Permission.MODERATE))
     self.assertFalse(u.can(Permission.ADMIN))
+
+  def test_follows(self):
+    u1 = User(email='john@example.com', username='john', password='cat')
+    u2 = User(email='susan@example.com', username='susan', password='dog')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    self.assertFalse(u1.is_following(u2))
+    u1.follow(u2)
+    u1.follow(u2)
+    db.session.commit()
+    self.assertTrue(u1.is_following(u2))
+    self.assertTrue(u2.is_followed_by(u1))
+    self.assertFalse(u1.is_followed_by(u2))
+    self.assertEqual(u2.follower_count, 2)
+    u1.unfollow(u2)
+    u1.unfollow(u2)
+    db.session.commit()
+    self.assertFalse(u1.is_following(u2))
+    self.assertFalse(u2.is_followed_by(u1))
+    self.assertEqual(u2.follower_count, 1)
+    # 自己关注自己的关系不变
+    self.assertTrue(u1.is_following(u1))
+
+  def test_following_set(self):
+    viewer = User(email='john@example.com', username='john', password='cat')
+    users = [User(email='u%d@example.com' % i, username='u%d' % i,
+                  password='cat') for i in range(50)]
+    db.session.add_all([viewer] + users)
+    db.session.commit()
+    for u in users[::2]:
+      viewer.follow(u)
+    for u in users[::5]:
+      u.follow(viewer)
+    db.session.commit()
+    ids = [u.id for u in users]
+    viewer_id = viewer.id
+    # 新的请求
+    g.pop('_follow_memo', None)
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+      statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+      prefetch(viewer, ids)
+      self.assertEqual(len(statements), 1)
+      self.assertEqual(following_set(viewer, ids), set(ids[::2]))
+      self.assertEqual(followers_set(viewer, ids), set(ids[::5]))
+      self.assertTrue(all(viewer.is_following(u) == (u.id in ids[::2])
+                          for u in users))
+      self.assertEqual(len(statements), 1)
+      # 备忘随关注/取消关注更新
+      viewer.unfollow(users[0])
+      viewer.follow(users[1])
+      db.session.commit()
+      self.assertEqual(viewer.id, viewer_id)
+      statements.clear()
+      self.assertEqual(following_set(viewer, ids[:2]), {ids[1]})
+      self.assertEqual(statements, [])
+    finally:
+      db.event.remove(db.engine, 'before_cursor_execute', count)
+
+  def test_timeline(self):
+    u1 = User(email='john@example.com', username='john', password='cat')
+    u2 = User(email='susan@example.com', username='susan', password='dog')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    p1 = Post(body='post by susan', author=u2)
+    db.session.add(p1)
+    db.session.commit()
+    # 关注时补齐时间线
+    u1.follow(u2)
+    db.session.commit()
+    self.assertEqual(u1.followed_posts.all(), [p1])
+    # 发帖扇出写到关注者
+    p2 = Post(body='another post by susan', author=u2)
+    db.session.add(p2)
+    db.session.commit()
+    self.assertEqual(TimelineEntry.query.filter_by(owner_id=u1.id).count(), 2)
+    self.assertEqual(set(u1.followed_posts.all()), {p1, p2})
+
+  def test_timeline_fanout_on_read(self):
+    current_app.config['APP_TIMELINE_FANOUT_LIMIT'] = 1
+    u1 = User(email='john@example.com', username='john', password='cat')
+    u2 = User(email='susan@example.com', username='susan', password='dog')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u2)
+    db.session.commit()
+    # susan有两个关注者(包括自己), 不再扇出写
+    p = Post(body='post by susan', author=u2)
+    db.session.add(p)
+    db.session.commit()
+    self.assertTrue(u2.fanout_on_read)
+    self.assertEqual(TimelineEntry.query.filter_by(post_id=p.id).count(), 0)
+    self.assertEqual(u1.followed_posts.all(), [p])
+    # 取消关注后不再可见
+    db.session.delete(u1.followed.filter_by(followed_id=u2.id).first())
+    db.session.commit()
+    self.assertEqual(u1.followed_posts.all(), [])
+
+  def test_timeline_rebuild(self):
+    u1 = User(email='john@example.com', username='john', password='cat')
+    u2 = User(email='susan@example.com', username='susan', password='dog')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u2)
+    db.session.add(Post(body='post by susan', author=u2))
+    db.session.commit()
+    TimelineEntry.query.delete()
+    db.session.commit()
+    self.assertEqual(u1.followed_posts.count(), 0)
+    self.assertEqual(TimelineEntry.rebuild(), 2)
+    self.assertEqual(u1.followed_posts.count(), 1)
+    self.assertEqual(TimelineEntry.repair(), (0, 0))
+
+    # 批量导入后重建: 按实际关注者数设置fanout_on_read
+    current_app.config['APP_TIMELINE_FANOUT_LIMIT'] = 1
+    TimelineEntry.rebuild()
+    self.assertTrue(db.session.get(User, u2.id).fanout_on_read)
+    self.assertEqual(TimelineEntry.query.filter_by(author_id=u2.id).count(),
+                     0)
+    self.assertEqual(u1.followed_posts.count(), 1)
+
+  def test_timeline_pages(self):
+    current_app.config['APP_TIMELINE_FANOUT_LIMIT'] = 2
+    u1 = User(email='john@example.com', username='john', password='cat')
+    u2 = User(email='susan@example.com', username='susan', password='dog')
+    u3 = User(email='david@example.com', username='david', password='dog')
+    db.session.add_all([u1, u2, u3])
+    db.session.commit()
+    u1.follow(u2)
+    u1.follow(u3)
+    u3.follow(u2)
+    db.session.commit()
+    # susan的帖子: 前两条扇出写, 之后读时扇出; david的帖子扇出写
+    posts = []
+    for i in range(6):
+      posts.append(Post(body='%d' % i, author=u2 if i % 2 else u3,
+                        timestamp=datetime(2020, 1, 1, i)))
+      db.session.add(posts[-1])
+      db.session.commit()
+    self.assertTrue(u2.fanout_on_read)
+    query, keys = u1.timeline
+    first = KeysetPagination(query, keys, 4)
+    self.assertEqual([p.body for p in first.items], ['5', '4', '3', '2'])
+    second = KeysetPagination(query, keys, 4, cursor=first.next_cursor)
+    self.assertEqual([p.body for p in second.items], ['1', '0'])
+    self.assertFalse(second.has_next)
+
+  def test_counters(self):
+    u1 = User(email='john@example.com', username='john', password='cat')
+    u2 = User(email='susan@example.com', username='susan', password='dog')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    self.assertEqual((u1.follower_count, u1.followed_count), (1, 1))
+    u1.follow(u2)
+    p = Post(body='post by susan', author=u2)
+    db.session.add(p)
+    db.session.commit()
+    db.session.add(Comment(body='comment', author=u1, post=p))
+    db.session.commit()
+    self.assertEqual(u2.post_count, 1)
+    self.assertEqual(u2.follower_count, 2)
+    self.assertEqual(u1.followed_count, 2)
+    self.assertEqual(p.comment_count, 1)
+    db.session.delete(p.comments.first())
+    db.session.delete(u1.followed.filter_by(followed_id=u2.id).first())
+    db.session.commit()
+    self.assertEqual(p.comment_count, 0)
+    self.assertEqual(u2.follower_count, 1)
+    # recount from the real rows
+    User.query.update({'post_count': 0, 'follower_count': 0})
+    db.session.commit()
+    User.recount()
+    Post.recount()
+    self.assertEqual(u2.post_count, 1)
+    self.assertEqual(u2.follower_count, 1)
+    self.assertEqual(p.comment_count, 0)
+
+  def test_role_cache(self):
+    u = User(email='john@example.com', username='john', password='cat')
+    db.session.add(u)
+    db.session.commit()
+    self.assertTrue(u.can(Permission.WRITE))
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+      statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+      for _ in range(10):
+        self.assertFalse(u.can(Permission.MODERATE))
+      User(email='susan@example.com', username='susan', password='dog')
+    finally:
+      db.event.remove(db.engine, 'before_cursor_execute', record)
+    self.assertFalse([s for s in statements if 'roles' in s])
+
+    # 修改角色后缓存失效
+    r = Role.query.filter_by(name='User').first()
+    r.add_permission(Permission.MODERATE)
+    db.session.commit()
+    self.assertTrue(u.can(Permission.MODERATE))
+    Role.insert_roles()
+    self.assertFalse(u.can(Permission.MODERATE))
+
+  def test_role_cache_concurrent_load(self):
+    cache = RoleCache(ttl=60)
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+      if 'FROM roles' in statement:
+        statements.append(statement)
+        time.sleep(0.05)  # 其他线程在此期间等锁
+    barrier = threading.Barrier(4)
+
+    def load():
+      with self.app.app_context():
+        barrier.wait()
+        cache.load()
+        db.session.remove()
+    db.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+      threads = [threading.Thread(target=load) for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    finally:
+      db.event.remove(db.engine, 'before_cursor_execute', record)
+    # 冷缓存的并发请求只查询一次
+    self.assertEqual(len(statements), 1)
+    self.assertEqual(len(cache.roles), Role.query.count())
+
+  def test_admin_role(self):
+    current_app.config['APP_ADMIN'] = 'admin@example.com'
+    u = User(email='admin@example.com', password='cat')
+    self.assertTrue(u.is_administrator())
+    self.assertEqual(u.role_id,
+                     Role.query.filter_by(name='Administrator').first().id)
+
+  def test_ping(self):
+    u = User(email='john@example.com', password='cat')
+    db.session.add(u)
+    db.session.commit()
+    before = u.last_seen
+
+    def stored():
+      return db.session.scalar(
+          db.select(User.last_seen).where(User.id == u.id)
+          .execution_options(populate_existing=True))
+
+    buffer = last_seen_buffer()
+    u.ping()
+    # 内存中的值已更新, 但没有写入数据库, 也没有标记为已修改
+    self.assertGreater(u.last_seen.replace(tzinfo=None), before)
+    self.assertNotIn(u, db.session.dirty)
+    self.assertEqual(stored(), before)
+    self.assertEqual(buffer.flush(), 1)
+    first = stored()
+    self.assertGreater(first, before)
+
+    # 合并时间内的访问不再写入
+    u.ping()
+    self.assertEqual(buffer.flush(), 0)
+    self.assertEqual(stored(), first)
+    self.assertEqual(buffer.stats()['coalesced'], 1)
+
+  def test_ping_flusher(self):
+    u = User(email='john@example.com', password='cat')
+    db.session.add(u)
+    db.session.commit()
+    before = u.last_seen
+    current_app.config['APP_LAST_SEEN_FLUSH_INTERVAL'] = 0.01
+    buffer = LastSeenBuffer(current_app._get_current_object())
+    buffer.touch(u.id, datetime(2030, 1, 1))
+    deadline = time.monotonic() + 5
+    while buffer.stats()['rows'] == 0 and time.monotonic() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(buffer.stats()['rows'], 1)
+
+    # 关闭时写入剩余的时间
+    buffer.stopped.set()
+    buffer.thread.join()
+    buffer.pending[u.id] = datetime(2031, 1, 1)
+    buffer.shutdown()
+    self.assertFalse(buffer.thread.is_alive())
+    self.assertEqual(buffer.stats()['pending'], 0)
+    db.session.expire_all()
+    self.assertEqual(u.last_seen, datetime(2031, 1, 1))
+    self.assertNotEqual(before, u.last_seen)